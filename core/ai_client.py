@@ -1,11 +1,57 @@
 """
 和 AI 交互
 """
+import queue
+import random
+import threading
+from collections import deque
+from time import monotonic
+import httpx
 import openai
-from typing import List, Callable, Dict, Any, Optional
+from typing import List, Callable, Dict, Any, Optional, Deque, Iterator, Set, Tuple
 from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 from enum import Enum
+from utils.json_stream import JsonObjectStream
+from core.tool_dispatcher import ToolDispatcher, ToolCallRequest, ToolResult
+from utils.general import log
+
+POLL_INTERVAL = 0.1  # 等待数据块时检查停止请求的间隔（秒）
+TTFT_WINDOW = 50  # 每个模型保留的首个数据块延迟样本数
+MIN_HEDGE_SAMPLES = 5  # 样本少于这个数量时不发送对冲请求
+HEDGE_PERCENTILE = 0.95  # 超过该分位数的首个数据块延迟后发送对冲请求
+
+# 在收到第一个数据块之前出现这些错误时，可以安全地重试
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class StreamTimeoutError(Exception):
+    """流式响应超时"""
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class RequestPolicy:
+    """请求的超时、重试和对冲设置（秒）"""
+    connect_timeout: float  # 建立连接的超时
+    read_timeout: float  # 等待第一个数据块的超时
+    chunk_timeout: float  # 两个数据块之间的超时
+    max_retries: int  # 收到第一个数据块之前，遇到临时错误的最大重试次数
+    backoff: float  # 第一次重试前的等待时间，之后每次翻倍
+    hedge: bool  # 首个数据块迟迟未到时，是否同时发送一个相同的请求
+
+    def __init__(self, connect_timeout: float = 10.0, read_timeout: float = 120.0,
+                 chunk_timeout: float = 60.0, max_retries: int = 3, backoff: float = 1.0,
+                 hedge: bool = False) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.chunk_timeout = chunk_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge = hedge
+
+    def to_dict(self) -> Dict[str, float | int | bool]:
+        return self.__dict__
 
 
 class AIModel:
@@ -32,19 +78,24 @@ class AITool:
     """
     工具信息
 
-    调用时需要在 action 中传入一个 JSON 形式的参数
+    调用时需要在 action 中传入一个 JSON 形式的参数，返回值会作为工具结果交给模型
     """
     name: str
     info: Dict[str, Any]
-    action: Callable[[str], None]
+    action: Callable[[str], Optional[str]]
+    stream_field: Optional[str]  # 需要在生成过程中实时输出的字符串参数
+    max_concurrency: int  # 同一个工具最多同时执行的次数
 
-    def __init__(self, name: str, info: Dict[str, Any], action: Callable[[str], None]) -> None:
+    def __init__(self, name: str, info: Dict[str, Any], action: Callable[[str], Optional[str]],
+                 stream_field: Optional[str] = None, max_concurrency: int = 4) -> None:
         self.name = name
         self.info = info
         self.action = action
+        self.stream_field = stream_field
+        self.max_concurrency = max_concurrency
 
-    def call(self, params: str) -> None:
-        self.action(params)
+    def call(self, params: str) -> Optional[str]:
+        return self.action(params)
 
 
 example_model = AIModel("Example Model", "example", "https://api.example.com/v1", "")
@@ -54,7 +105,8 @@ class ChatContent:
     class Type(Enum):
         REASONING = "reasoning" # 推理内容
         CONTENT = "content" # 常规内容
-        TOOL_ARGUMENT = "tool_argument" # 工具参数
+        TOOL_ARGUMENT = "tool_argument" # 工具参数（原始 JSON 片段）
+        TOOL_FIELD = "tool_field" # 从工具参数中实时解析出的字段内容（见 AITool.stream_field）
     
     type: Type
     text: str
@@ -63,57 +115,264 @@ class ChatContent:
         self.type = type
         self.text = text
 
+class StreamAttempt:
+    """一次实际发出的流式请求，在后台线程中读取数据块并放入共享的事件队列"""
+    number: int
+    create: Callable[[], Any]  # 发出请求，返回流
+    events: "queue.Queue[Tuple[StreamAttempt, str, Any]]"  # (请求, "chunk"/"done"/"error", 数据)
+    started_at: float
+    stream: Any
+    closed: bool
+    lock: threading.Lock
+
+    def __init__(self, number: int, create: Callable[[], Any],
+                 events: "queue.Queue[Tuple[StreamAttempt, str, Any]]") -> None:
+        self.number = number
+        self.create = create
+        self.events = events
+        self.started_at = monotonic()
+        self.stream = None
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name=f"ai-stream-{number}", daemon=True).start()
+
+    def run(self) -> None:
+        try:
+            stream = self.create()
+            with self.lock:
+                if self.closed:
+                    stream.close()
+                    return
+                self.stream = stream
+            for chunk in stream:
+                if self.closed:
+                    return
+                self.events.put((self, "chunk", chunk))
+            self.events.put((self, "done", None))
+        except Exception as e:
+            if not self.closed:  # 主动关闭引起的错误不需要报告
+                self.events.put((self, "error", e))
+
+    def close(self) -> None:
+        """关闭请求，正在阻塞的读取会立即结束"""
+        with self.lock:
+            self.closed = True
+            stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                log.debug(f"关闭流式请求 #{self.number} 时出错：{e}")
+
+
 class AIClient:
     """AI 模型客户端"""
+    # 每个模型最近的首个数据块延迟，用于计算对冲请求的时机
+    ttft_samples: Dict[str, Deque[float]] = {}
+    # 拒绝 stream_options 参数（返回 400）的服务，(API 地址, 模型 ID)；之后的请求不再发送
+    no_stream_options: Set[Tuple[str, str]] = set()
+
     model: AIModel
+    policy: RequestPolicy
     client: openai.OpenAI
+    attempts: List[StreamAttempt]  # 尚未关闭的请求
+    cancelled: bool  # 最近一次请求是否被中途停止
     tools: Dict[str, AITool]  # 名称到工具的映射
+    dispatcher: ToolDispatcher
+
+    # 最近一次回复的内容，用于在下一轮对话中把工具结果交给模型
+    last_response: str
+    last_tool_calls: List[ToolCallRequest]
+    last_tool_results: List[ToolResult]
+    last_usage: Optional[Dict[str, int]]  # 最近一次请求的 token 用量
 
-    def __init__(self, model: AIModel, tools: Optional[List[AITool]] = None) -> None:
+    def __init__(self, model: AIModel, tools: Optional[List[AITool]] = None,
+                 policy: Optional[RequestPolicy] = None) -> None:
         tools = tools or []
         self.model = model
+        self.policy = policy or RequestPolicy()
+        # 重试由 open_stream 负责，这里关闭 SDK 自带的重试
         self.client = openai.OpenAI(
-            api_key=model.api_key, base_url=model.api_base)
+            api_key=model.api_key, base_url=model.api_base, max_retries=0,
+            timeout=httpx.Timeout(self.policy.read_timeout, connect=self.policy.connect_timeout))
         self.tools = {tool.name: tool for tool in tools}
-        self.active_stream = None
+        self.dispatcher = ToolDispatcher(self.tools)
+        self.attempts = []
+        self.cancelled = False
+        self.last_response = ""
+        self.last_tool_calls = []
+        self.last_tool_results = []
+        self.last_usage = None
     
 
+    def hedge_delay(self) -> Optional[float]:
+        """根据该模型最近的首个数据块延迟，计算发送对冲请求前等待的时间"""
+        samples = self.ttft_samples.get(self.model.model_id)
+        if not self.policy.hedge or samples is None or len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+
+    def record_ttft(self, ttft: float) -> None:
+        samples = self.ttft_samples.setdefault(self.model.model_id, deque(maxlen=TTFT_WINDOW))
+        samples.append(ttft)
+
+    def open_stream(self, create: Callable[[], Any],
+                    should_stop: Optional[Callable[[], bool]] = None) -> Iterator[Any]:
+        """
+        发出流式请求，返回数据块。
+        在收到第一个数据块之前，临时错误和超时会按指数退避重试；开启对冲时，
+        等待超过最近的 p95 延迟后会再发出一个相同的请求，先返回数据的请求胜出。
+        收到第一个数据块后不再重试，两个数据块之间超时会抛出 StreamTimeoutError。
+        should_stop 返回 True 时立即关闭所有请求并结束，此时 self.cancelled 为 True。
+        """
+        events: "queue.Queue[Tuple[StreamAttempt, str, Any]]" = queue.Queue()
+        policy = self.policy
+        self.cancelled = False
+        self.attempts = [StreamAttempt(1, create, events)]
+        launched = 1
+        retries = 0
+        retry_at: Optional[float] = None
+        hedge_delay = self.hedge_delay()
+        hedged = False
+        winner: Optional[StreamAttempt] = None
+        last_chunk_at = monotonic()
+
+        try:
+            while True:
+                if should_stop is not None and should_stop():
+                    self.cancelled = True
+                    return
+                try:
+                    attempt, kind, data = events.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    attempt, kind, data = None, "", None
+                now = monotonic()
+
+                if attempt is not None and attempt.closed:
+                    continue  # 已经放弃的请求
+                if kind == "chunk" or (kind == "done" and winner is None):
+                    if winner is None:
+                        winner = attempt
+                        self.record_ttft(now - attempt.started_at)
+                        if len(self.attempts) > 1:
+                            log.info(f"对冲请求中第 {attempt.number} 次请求先返回了数据")
+                        for other in self.attempts:
+                            if other is not attempt:
+                                other.close()
+                        self.attempts = [attempt]
+                    if kind == "done":
+                        return
+                    last_chunk_at = now
+                    yield data
+                    continue
+                if kind == "done":
+                    return
+                if kind == "error":
+                    if attempt is winner:
+                        raise data  # 已经输出了部分内容，不能重试
+                    attempt.close()
+                    self.attempts.remove(attempt)
+                    if self.attempts:
+                        continue  # 还有其他请求在等待
+                    if not isinstance(data, TRANSIENT_ERRORS) or retries >= policy.max_retries:
+                        raise data
+                    delay = policy.backoff * 2 ** retries * random.uniform(0.8, 1.2)
+                    retries += 1
+                    retry_at = now + delay
+                    log.warning(f"请求失败（{type(data).__name__}: {data}），"
+                                f"{delay:.1f} 秒后第 {retries} 次重试")
+                    continue
+
+                # 没有新的事件：检查超时、重试和对冲
+                if winner is not None:
+                    if now - last_chunk_at > policy.chunk_timeout:
+                        raise StreamTimeoutError(f"超过 {policy.chunk_timeout} 秒没有收到新的数据")
+                    continue
+                for expired in [a for a in self.attempts
+                                if not a.closed and now - a.started_at > policy.read_timeout]:
+                    expired.close()
+                    self.attempts.remove(expired)
+                    if not self.attempts:
+                        if retries >= policy.max_retries:
+                            raise StreamTimeoutError(
+                                f"超过 {policy.read_timeout} 秒没有收到模型的回应")
+                        retries += 1
+                        retry_at = now
+                        log.warning(f"等待模型回应超时，第 {retries} 次重试")
+                if retry_at is not None and now >= retry_at:
+                    retry_at = None
+                    launched += 1
+                    self.attempts.append(StreamAttempt(launched, create, events))
+                elif (hedge_delay is not None and not hedged and len(self.attempts) == 1
+                      and now - self.attempts[0].started_at > hedge_delay):
+                    hedged = True
+                    launched += 1
+                    log.info(f"超过 {hedge_delay:.1f} 秒未收到数据，发送对冲请求")
+                    self.attempts.append(StreamAttempt(launched, create, events))
+        finally:
+            self.close_active()
+            self.attempts = []
+
     def chat_stream(self, messages: List[ChatCompletionMessageParam],
-                    temperature: float = 0.2):  # -> Generator
-        """流式调用，返回生成器"""
+                    temperature: float = 0.2,
+                    should_stop: Optional[Callable[[], bool]] = None):  # -> Generator
+        """
+        流式调用，返回生成器。
+        should_stop: 定期检查的停止条件，返回 True 时立即结束，不执行工具调用
+        """
         openai_tools = [ChatCompletionToolParam(
             **tool.info) for _, tool in self.tools.items()]
-        stream = self.client.chat.completions.create(
-            model=self.model.model_id,
-            messages=messages,
-            tools=openai_tools,
-            tool_choice="auto",
-            stream=True,
-            temperature=temperature,
-        )
-        self.active_stream = stream
-
-        full_response = ""
+
+        server = (self.model.api_base, self.model.model_id)
+
+        def request(**options: Any) -> Any:
+            return self.client.chat.completions.create(
+                model=self.model.model_id,
+                messages=messages,
+                tools=openai_tools,
+                tool_choice="auto",
+                stream=True,
+                temperature=temperature,
+                **options,
+            )
+
+        def create() -> Any:
+            if server in AIClient.no_stream_options:
+                return request()
+            try:
+                # 最后一个数据块中包含用量统计
+                return request(stream_options={"include_usage": True})
+            except openai.BadRequestError as e:
+                # 部分兼容 OpenAI 的服务不支持 stream_options，去掉后重试一次
+                log.warning(f"模型 {self.model.name} 的请求被拒绝（{e}），不请求用量统计后重试")
+                stream = request()
+                AIClient.no_stream_options.add(server)
+                return stream
+
+        response_chunks: List[str] = []
 
         class ToolCall:
             id: str
             name: str
-            args: str
+            args: JsonObjectStream  # 增量解析的参数
 
-            def __init__(self, id: str, name: str, args: str) -> None:
+            def __init__(self, id: str, name: str) -> None:
                 self.id = id
                 self.name = name
-                self.args = args
+                self.args = JsonObjectStream()
 
         tool_call_buf = dict[int, ToolCall]()
 
-        for chunk in stream:
+        for chunk in self.open_stream(create, should_stop):
+            if getattr(chunk, "usage", None) is not None:
+                self.record_usage(chunk.usage)
             if chunk.choices:
                 delta = chunk.choices[0].delta
 
                 # 文本内容
                 if delta.content:
-                    full_response += delta.content
+                    response_chunks.append(delta.content)
                     yield ChatContent(ChatContent.Type.CONTENT, delta.content)
 
                 # 推理内容
@@ -134,20 +393,57 @@ class AIClient:
                             tool_call_buf[index] = ToolCall(
                                 id=call.id or "",
                                 name=function.name or "",
-                                args=function.arguments or ""
                             )
-                        else:  # 追加参数
-                            tool_call_buf[index].args += function.arguments or ""
-                        if function.arguments is not None:
-                            yield ChatContent(ChatContent.Type.TOOL_ARGUMENT, function.arguments)
-
-        # 依次进行工具调用
-        for tool_call in tool_call_buf.values():
-            if tool_call.name not in self.tools:
-                raise ValueError(f"Unknown tool: {tool_call.name}")
-            tool = self.tools[tool_call.name]
-            tool.call(tool_call.args)
+                        tool_call = tool_call_buf[index]
+                        if not function.arguments:
+                            continue
+                        deltas = tool_call.args.feed(function.arguments)  # 追加参数
+                        yield ChatContent(ChatContent.Type.TOOL_ARGUMENT, function.arguments)
+                        tool = self.tools.get(tool_call.name)
+                        if tool is not None and tool.stream_field in deltas:
+                            yield ChatContent(ChatContent.Type.TOOL_FIELD, deltas[tool.stream_field])
+
+        if self.cancelled:
+            return
+        self.last_response = "".join(response_chunks)
+        self.last_tool_calls = [
+            ToolCallRequest(tool_call.id or f"call_{index}", tool_call.name, tool_call.args.text())
+            for index, tool_call in sorted(tool_call_buf.items())]
+
+        # 并行执行工具调用，单个调用失败不影响其他调用
+        self.last_tool_results = self.dispatcher.dispatch(self.last_tool_calls)
+
+    def record_usage(self, usage: Any) -> None:
+        """记录服务商返回的 token 用量，包括提示词缓存命中的数量"""
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        # OpenAI 格式在 prompt_tokens_details 中，DeepSeek 格式为 prompt_cache_hit_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+        if cached_tokens is None:
+            cached_tokens = getattr(usage, "prompt_cache_hit_tokens", 0) or 0
+        self.last_usage = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+        }
+        hit_rate = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        log.info(f"模型 {self.model.name} 用量：输入 {prompt_tokens} tokens"
+                 f"（缓存命中 {cached_tokens}，{hit_rate:.0%}），输出 {completion_tokens} tokens")
+
+    def follow_up_messages(self) -> List[ChatCompletionMessageParam]:
+        """
+        最近一次回复对应的消息：包含工具调用的 assistant 消息，以及每个调用的 tool 结果。
+        追加到消息列表后再次调用 chat_stream，即可让模型看到工具结果。
+        """
+        assistant_message: Dict[str, Any] = {"role": "assistant", "content": self.last_response}
+        if self.last_tool_calls:
+            assistant_message["tool_calls"] = [call.to_dict() for call in self.last_tool_calls]
+        messages: List[Any] = [assistant_message]
+        messages.extend(result.to_message() for result in self.last_tool_results)
+        return messages
 
     def close_active(self) -> None:
-        if self.active_stream is not None:
-            self.active_stream.close()
\ No newline at end of file
+        """关闭所有尚未结束的请求，可以在其他线程中调用"""
+        for attempt in list(self.attempts):
+            attempt.close()
\ No newline at end of file
@@ -4,51 +4,466 @@
 import json
 import os
 import re
-from typing import List, Callable
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+from typing import List, Callable, Tuple, Optional, Dict, Set
 from PyQt5.QtCore import QObject, pyqtSignal
 from core.config import Config
+from core.selection import FileSelection
 from core.ai_client import AIClient, AITool, AIModel, ChatContent
 from utils.general import log, Path
 from core.tools_description import EXECUTE_PYTHON_SCRIPT
-from utils.file import is_text
-from core.execute import execute_python_script
+from utils.file import detect_text_encoding
+from core.execute import (
+    execute_python_script, execute_batch_script, ScriptResult, ExecutionMode,
+    PREFLIGHT_FAILED_RETURN_CODE)
+from core.preflight import preflight, PreflightReport
+from core.fork_server import fork_servers
+from core.chunked import execute_chunked_script
+from core.map_reduce import Reducer, reduce_output_base, MAP_ARG
+from core.pipeline import execute_pipeline, split_stages, format_timings
+from core.history import HistoryStore, RunContext, hash_text
+from core.journal import RunJournal, JournalEntry
+from core.job_queue import JobStore
+from core.canary import pick_canary_files, check_canary_results, MAX_CANARY_FILES
+from core.script_index import ScriptIndex, ScriptMatch, MAX_INDEXED_SCRIPTS
+from core.conversation import Conversation
+from core.cancel import CancelToken
 
 PREVIEW_FILE_LIMIT = 1024 * 3  # 预览 3KB 以内的文件
 
+# 系统提示词的各个部分。修改时注意：任何字节的变化都会使服务商的提示词缓存失效
+SYSTEM_PROMPT_INTRO = """接下来将会给你一个用户的需求，你可以选择编写一个 Python 脚本并运行来解决这个任务，或者直接向用户输出文本内容。"""
+
+SYSTEM_PROMPT_FC = """
+如果你选择生成 Python 脚本，请通过指定的 Function Calling 工具来提交。你只能生成一个脚本，并且不能由此获得更多信息。
+你需要在输出的正文中包含代码，然后在函数调用中原封不动地提交它，以确保用户可以及时看到你的工作状态。
+你可以在正文中包含其他的描述性内容以帮助你输出，这些内容仅会展示给用户。"""
+
+SYSTEM_PROMPT_NO_FC = """
+如果你选择生成 Python 脚本，请保证你的输出中仅包含一个 Python 代码块（使用 Markdown 语法 ```python [代码]``` 包裹），接下来用户将会执行这个代码。
+代码块以外可以包括其他描述性的内容以帮助你输出，这些内容仅会展示给用户。"""
+
+SYSTEM_PROMPT_RULES = """
+Python 脚本需要遵循以下规则：
+1. 可以独立地正常运行。
+2. 优先使用标准库和常用依赖库。
+3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
+4. 如果需要输入文件，通过 sys.argv 获取参数，第一个参数为输入文件名。
+5. 如果需要输出文件，请保存为：原文件名_out.扩展名。
+
+如果用户输入包含多个文件，你的程序将会对每个文件运行。
+"""
+
+SYSTEM_PROMPT_BATCH_RULES = """
+Python 脚本需要遵循以下规则：
+1. 可以独立地正常运行。
+2. 优先使用标准库和常用依赖库。
+3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
+4. 脚本只会运行一次，需要处理所有输入文件。输入文件通过 sys.argv[1:] 传入；如果只有一个参数且以 @ 开头，去掉 @ 后是一个清单文件的路径，清单文件中每行一个输入文件（UTF-8 编码）。
+5. 耗时的准备工作（导入大型库、加载模型、编译正则表达式等）只进行一次，然后依次处理每个文件。
+6. 单个文件处理出错时不要中断，继续处理其他文件。
+7. 每处理完一个文件，向环境变量 SMART_ASSISTANT_STATUS 指定的文件追加一行 JSON（UTF-8 编码）：{"file": 输入文件路径, "ok": 是否成功, "message": 简短说明}。
+8. 如果需要输出文件，请保存为：原文件名_out.扩展名。
+"""
+
+SYSTEM_PROMPT_CHUNKED_RULES = """
+Python 脚本需要遵循以下规则：
+1. 可以独立地正常运行。
+2. 优先使用标准库和常用依赖库。
+3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
+4. 输入文件很大，会按行切分为多块，由多个进程同时处理。脚本从 sys.stdin.buffer 按行读取这一块的内容，并使用输入文件的编码解码；不要打开 sys.argv[1] 指定的原始文件，也不要一次性读入全部输入。
+5. 处理结果按输入文件的编码写入 sys.stdout.buffer，各块的输出会按顺序合并为：原文件名_out.扩展名。不要自己创建输出文件。
+6. 每一块的处理必须相互独立，不能依赖其他块的内容。
+7. CSV/TSV 文件的每一块都以表头行开始。如果输出也需要表头，只在环境变量 SMART_ASSISTANT_CHUNK 为 "0" 时输出。
+"""
+
+SYSTEM_PROMPT_MAP_REDUCE_RULES = """
+Python 脚本需要遵循以下规则：
+1. 可以独立地正常运行。
+2. 优先使用标准库和常用依赖库。
+3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
+4. 任务需要汇总所有输入文件。脚本分为 map 和 reduce 两个阶段，通过第一个命令行参数区分。
+5. sys.argv[1] 为 "map" 时，sys.argv[2] 为一个输入文件。只处理这个文件，把它的部分结果（例如计数、小计、筛选出的少量记录）以一行 JSON 输出到 stdout 的最后一行。各个文件的 map 会同时运行。
+6. sys.argv[1] 为 "reduce" 时，从 sys.stdin 逐行读取部分结果，每行一个 JSON：{"file": 输入文件路径, "result": map 输出的 JSON}，顺序不固定。边读取边合并，不要重新读取输入文件。
+7. reduce 读完所有部分结果后，把合并的结果保存为 sys.argv[2] 加上合适的扩展名（例如 sys.argv[2] + ".csv"），并在 stdout 输出文件路径和简短的汇总。
+8. 部分结果应当尽量小。
+"""
+
+SYSTEM_PROMPT_PIPELINE_RULES = """
+Python 脚本需要遵循以下规则：
+1. 可以独立地正常运行。
+2. 优先使用标准库和常用依赖库。
+3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
+4. 脚本是数据处理管道中的一个阶段，可能与其他脚本串联使用：从 sys.stdin.buffer 读取输入，把结果写入 sys.stdout.buffer。第一个阶段的输入是输入文件的内容，最后一个阶段的输出会保存为：原文件名_out.扩展名。
+5. 不要打开输入文件，也不要自己创建输出文件。sys.argv[1] 是原始输入文件的路径，仅供参考（例如判断格式）。
+6. 逐行或分块读取和写入，不要一次性读入全部输入，使各个阶段可以同时运行。
+7. 提示信息输出到 sys.stderr。
+"""
+
+# 每种执行方式对应的脚本规则
+MODE_RULES = {
+    ExecutionMode.PER_FILE: SYSTEM_PROMPT_RULES,
+    ExecutionMode.BATCH: SYSTEM_PROMPT_BATCH_RULES,
+    ExecutionMode.CHUNKED: SYSTEM_PROMPT_CHUNKED_RULES,
+    ExecutionMode.MAP_REDUCE: SYSTEM_PROMPT_MAP_REDUCE_RULES,
+    ExecutionMode.PIPELINE: SYSTEM_PROMPT_PIPELINE_RULES,
+}
+
 
 class Assistant:
     class CommandSignals(QObject):
         """执行用户文字命令的相关信号"""
         receive_content = pyqtSignal(ChatContent)
         confirm_script = pyqtSignal(str)
-        running_lock: bool = False
+        reuse_script = pyqtSignal(ScriptMatch)  # 找到可以直接复用的历史脚本
 
     config: Config  # 配置文件
-    selected_files: List[Path]  # 选中的文件
+    history: HistoryStore  # 执行历史
+    journal: RunJournal  # 每个文件的处理记录，用于跳过没有变化的文件
+    jobs: JobStore  # 已确认、尚未执行完成的脚本，重新启动后继续
+    script_index: Optional[ScriptIndex]  # 已确认脚本的相似度索引，首次查询时建立
+    script_index_lock: threading.Lock
+    selected_files: FileSelection  # 选中的文件，与文件列表控件共享
 
     command_signals: CommandSignals
 
     def __init__(self) -> None:
         self.config = Config()
-        self.selected_files = []
+        self.history = HistoryStore()
+        self.journal = RunJournal()
+        self.jobs = JobStore()
+        self.script_index = None
+        self.script_index_lock = threading.Lock()
+        self.selected_files = FileSelection()
         self.command_signals = Assistant.CommandSignals()
 
-    def process_files(self, script: str, files: List[str],
-                      output: Callable[[str], None]) -> None:
+    def process_files(self, script: str, files: List[str], output: Callable[[str], None],
+                      token: Optional[CancelToken] = None,
+                      mode: ExecutionMode = ExecutionMode.PER_FILE) -> List[Tuple[Path, ScriptResult]]:
         """
         执行 Python 脚本来处理文件。
         每次处理完文件，都会调用 output 函数，来显示提示信息。
+        开启增量运行时，跳过之前已经用同一脚本处理过、且输入和输出都没有变化的文件。
+        返回每个文件的执行结果；取消后不再处理剩余的文件。
         """
+        # 启动任何进程之前，先做静态检查
+        stages = split_stages(script) if mode == ExecutionMode.PIPELINE else [script]
+        if len(stages) == 1:
+            report = preflight(script, files)
+        else:
+            report = PreflightReport()
+            for index, stage in enumerate(stages):
+                report.merge(preflight(stage, files), f"第 {index + 1} 阶段：")
+        if report.errors or report.warnings:
+            output(f"执行前检查：\n{report.text()}\n")
+        if not report.ok:
+            output("脚本没有通过检查，没有执行。\n")
+            return [(file, ScriptResult("", report.text(), PREFLIGHT_FAILED_RETURN_CODE))
+                    for file in files]
+
+        script_hash = hash_text(script)
+        done: Dict[Path, JournalEntry] = {}
+        if self.config.incremental_runs:
+            done = self.journal.lookup(script_hash, files)
+        pending = [file for file in files if file not in done]
+        if done:
+            output(f"跳过 {len(done)} 个已处理且没有变化的文件。\n")
+
+        preload = self.modules_to_preload(report.imports)
+        reducer: Optional[Reducer] = None
+        if mode == ExecutionMode.MAP_REDUCE and files:
+            # reduce 进程先启动，每个 map 完成后立即把部分结果交给它；跳过的文件沿用上次的部分结果
+            reducer = Reducer(script, reduce_output_base(files), token)
+            for file, entry in done.items():
+                reducer.accept(file, ScriptResult(entry.stdout, "", 0))
+
+        def run(batch: List[Path]) -> List[Tuple[Path, ScriptResult]]:
+            if mode == ExecutionMode.BATCH:
+                return self.process_files_batch(script, batch, output, token, script_hash)
+            if mode == ExecutionMode.CHUNKED:
+                return self.process_files_chunked(script, batch, output, token, script_hash)
+            if mode == ExecutionMode.PIPELINE:
+                return self.process_files_pipeline(stages, batch, output, token, script_hash)
+            return self.process_files_each(script, batch, output, token, script_hash, preload,
+                                           reducer)
+
+        executed: List[Tuple[Path, ScriptResult]] = []
+        if self.config.canary_run and len(pending) > MAX_CANARY_FILES:
+            # 先试运行少量样本，脚本有问题时只浪费几次执行，并且能很快得到反馈
+            canaries = pick_canary_files(pending)
+            output(f"先在 {len(canaries)} 个样本文件上试运行...\n")
+            started_at = time()
+            executed = run(canaries)
+            problems = check_canary_results(script, executed, started_at, mode)
+            for file, result in executed:
+                if file in problems and result.return_code == 0:  # 没有得到预期的输出
+                    result.return_code = 1
+                    result.stderr = (result.stderr + "\n" + problems[file]).strip()
+                    self.record_journal(script_hash, file, result, started_at)
+            chosen = set(canaries)
+            pending = [file for file in pending if file not in chosen]
+            if token is not None and token.cancelled:
+                pending = []
+            elif problems:
+                output(f"试运行失败，已停止处理其余 {len(pending)} 个文件：\n"
+                       + "\n".join(f"- {file}：{problem}" for file, problem in problems.items())
+                       + "\n")
+                pending = []
+            elif pending:
+                output(f"试运行成功，开始处理其余 {len(pending)} 个文件。\n")
+        if pending and not (token is not None and token.cancelled):
+            executed += run(pending)
+
+        # 按原来的顺序合并跳过的和执行的文件
+        executed_results = dict(executed)
+        results: List[Tuple[Path, ScriptResult]] = []
         for file in files:
-            output(f"正在处理文件 {file}...\n")
-            result = execute_python_script(script, file)
-            output(f"程序输出：{result.stdout}\n")
+            if (entry := done.get(file)) is not None:
+                results.append((file, ScriptResult(entry.stdout, "", 0, skipped=True)))
+            elif (result := executed_results.get(file)) is not None:
+                results.append((file, result))
+        if done:
+            output(f"共 {len(files)} 个文件：执行 {len(executed)} 个，跳过 {len(done)} 个。\n")
+        if reducer is not None:
+            results += self.finish_reduce(reducer, results, len(files), output, token)
+        return results
+
+    @staticmethod
+    def finish_reduce(reducer: Reducer, results: List[Tuple[Path, ScriptResult]], file_count: int,
+                      output: Callable[[str], None], token: Optional[CancelToken]
+                      ) -> List[Tuple[Path, ScriptResult]]:
+        """
+        等待 reduce 进程写出合并结果，返回以合并结果路径为键的执行结果。
+        有文件没有得到部分结果时合并结果不完整，放弃合并。
+        """
+        succeeded = sum(1 for _, result in results if result.return_code == 0)
+        if (token is not None and token.cancelled) or succeeded < file_count:
+            reducer.abort()
+            if not (token is not None and token.cancelled):
+                output(f"{file_count - succeeded} 个文件没有得到部分结果，没有生成合并结果。\n")
+            return []
+        output(f"正在等待合并 {reducer.fed} 个部分结果...\n")
+        result = reducer.finish()
+        if token is not None and token.cancelled:
+            return []
+        message = f"合并完成（耗时 {result.duration:.2f} 秒）\n程序输出：{result.stdout}\n"
+        if stderr := result.stderr.strip():
+            message += f"程序错误：{stderr}\n"
+        output(message)
+        return [(reducer.output_base, result)]
+
+    def record_journal(self, script_hash: str, file: Path, result: ScriptResult,
+                       started_at: float) -> None:
+        """把文件的处理结果写入执行日志，失败的文件下次需要重新处理"""
+        try:
+            if result.return_code == 0:
+                self.journal.record(script_hash, file, result.stdout, started_at)
+            else:
+                self.journal.forget(script_hash, file)
+        except Exception as e:
+            log.error(f"无法写入执行日志：{e}")
+
+    def modules_to_preload(self, imports: Set[str]) -> List[str]:
+        """脚本导入的模块中，可以由执行服务预加载的部分"""
+        if not self.config.fork_server:
+            return []
+        return [name for name in self.config.preload_modules if name.split(".")[0] in imports]
+
+    def process_files_each(self, script: str, files: List[str], output: Callable[[str], None],
+                           token: Optional[CancelToken], script_hash: str,
+                           preload: Optional[List[str]] = None,
+                           reducer: Optional[Reducer] = None) -> List[Tuple[Path, ScriptResult]]:
+        """
+        每个文件启动一次脚本，最多同时运行 config.max_script_workers 个进程。
+        preload: 脚本导入的大型模块。可用时由预加载了它们的执行服务 fork 子进程执行
+        reducer: map/reduce 模式下，以 map 阶段运行脚本，每个文件完成后把部分结果交给它
+        """
+        server = fork_servers.get(preload) if preload else None
+        execute = server.execute if server is not None else execute_python_script
+
+        def run_one(file: Path) -> Optional[ScriptResult]:
+            if token is not None and token.cancelled:
+                return None
+            started_at = time()
+            result = execute(script, [MAP_ARG, file] if reducer is not None else file, token)
+            if token is not None and token.cancelled:
+                return result
+            if reducer is not None:
+                reducer.accept(file, result)
+            self.record_journal(script_hash, file, result, started_at)
+            # 每个文件的信息一次性输出，避免并行时互相穿插
+            message = f"已处理文件 {file}（耗时 {result.duration:.2f} 秒）\n程序输出：{result.stdout}\n"
             if stderr := result.stderr.strip():  # 如果 stderr 存在信息
-                output(f"程序错误：{stderr}\n")
+                message += f"程序错误：{stderr}\n"
+            output(message)
+            return result
+
+        workers = max(1, min(self.config.max_script_workers, len(files)))
+        if workers == 1:
+            file_results = [run_one(file) for file in files]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="script") as executor:
+                file_results = list(executor.map(run_one, files))
+        return [(file, result) for file, result in zip(files, file_results) if result is not None]
+
+    def process_files_batch(self, script: str, files: List[str], output: Callable[[str], None],
+                            token: Optional[CancelToken], script_hash: str
+                            ) -> List[Tuple[Path, ScriptResult]]:
+        """以批量模式执行脚本：只启动一次进程处理所有文件，再逐个显示每个文件的结果"""
+        output(f"正在批量处理 {len(files)} 个文件...\n")
+        started_at = time()
+        process_result, results = execute_batch_script(script, files, token)
+        # 中断时，已经报告成功的文件同样记录下来，下次从中断的地方继续
+        for file, result in results:
+            if result.return_code == 0:
+                self.record_journal(script_hash, file, result, started_at)
+        if stdout := process_result.stdout.strip():
+            output(f"程序输出：{stdout}\n")
+        if stderr := process_result.stderr.strip():
+            output(f"程序错误：{stderr}\n")
+        for file, result in results:
+            if result.return_code == 0:
+                output(f"[成功] {file}" + (f"：{result.stdout}" if result.stdout else "") + "\n")
+            else:
+                output(f"[失败] {file}：{result.stderr}\n")
+        output(f"批量处理完成，耗时 {process_result.duration:.2f} 秒。\n")
+        return results
+
+    def process_files_chunked(self, script: str, files: List[str], output: Callable[[str], None],
+                              token: Optional[CancelToken], script_hash: str
+                              ) -> List[Tuple[Path, ScriptResult]]:
+        """以分块模式依次处理每个文件，每个文件切分后由 config.max_script_workers 个进程并行处理"""
+        results: List[Tuple[Path, ScriptResult]] = []
+        for file in files:
+            if token is not None and token.cancelled:
+                break
+            started_at = time()
+            try:
+                result, chunk_count = execute_chunked_script(
+                    script, file, self.config.max_script_workers, token)
+            except OSError as e:
+                log.error(f"无法分块处理文件 {file}：{e}")
+                result, chunk_count = ScriptResult("", f"无法读取或写入文件：{e}", 1), 0
+            results.append((file, result))
+            if token is not None and token.cancelled:
+                break
+            self.record_journal(script_hash, file, result, started_at)
+            message = (f"已处理文件 {file}（分为 {chunk_count} 块，耗时 {result.duration:.2f} 秒）\n"
+                       f"{result.stdout}\n")
+            if stderr := result.stderr.strip():
+                message += f"程序错误：{stderr}\n"
+            output(message)
+        return results
+
+    def process_files_pipeline(self, stages: List[str], files: List[str],
+                               output: Callable[[str], None], token: Optional[CancelToken],
+                               script_hash: str) -> List[Tuple[Path, ScriptResult]]:
+        """
+        以管道模式处理每个文件，并显示每个阶段的耗时。
+        每个文件同时占用 len(stages) 个进程，因此并行处理的文件数量相应减少。
+        """
+        totals = [0.0] * len(stages)
+        totals_lock = threading.Lock()
+
+        def run_one(file: Path) -> Optional[ScriptResult]:
+            if token is not None and token.cancelled:
+                return None
+            started_at = time()
+            try:
+                result, stage_results = execute_pipeline(stages, file, token)
+            except OSError as e:
+                log.error(f"无法以管道方式处理文件 {file}：{e}")
+                result, stage_results = ScriptResult("", f"无法读取或写入文件：{e}", 1), []
+            if token is not None and token.cancelled:
+                return result
+            self.record_journal(script_hash, file, result, started_at)
+            with totals_lock:
+                for index, stage in enumerate(stage_results):
+                    totals[index] += stage.duration
+            message = f"已处理文件 {file}（耗时 {result.duration:.2f} 秒）\n{result.stdout}\n"
+            if len(stages) > 1 and stage_results:
+                message += f"各阶段：{format_timings(stage_results)}\n"
+            if stderr := result.stderr.strip():
+                message += f"程序错误：{stderr}\n"
+            output(message)
+            return result
+
+        workers = max(1, min(self.config.max_script_workers // len(stages), len(files)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline") as executor:
+            file_results = list(executor.map(run_one, files))
+        if len(stages) > 1 and len(files) > 1:
+            output("各阶段累计耗时：" + "，".join(
+                f"第 {index + 1} 阶段 {total:.2f} 秒" for index, total in enumerate(totals)) + "\n")
+        return [(file, result) for file, result in zip(files, file_results) if result is not None]
+
+    def run_and_record(self, script: str, files: List[Path], context: RunContext,
+                       output: Callable[[str], None],
+                       token: Optional[CancelToken] = None) -> List[Tuple[Path, ScriptResult]]:
+        """
+        处理文件，并把命令、脚本和每个文件的结果写入历史记录。返回每个文件的执行结果。
+        被取消的执行不完整，不写入历史记录。
+        """
+        start = perf_counter()
+        results = self.process_files(script, files, output, token, context.mode)
+        duration = perf_counter() - start
+        if token is not None and token.cancelled:
+            log.info(f"脚本执行已取消，完成了 {len(results)}/{len(files)} 个文件")
+            return results
+        try:
+            run_id = self.history.record(
+                context.command, files, context.model, context.prompt_hash,
+                script, results, duration, context.mode)
+        except Exception as e:
+            log.error(f"无法写入历史记录：{e}")
+            return results
+
+        if all(result.return_code == 0 for _, result in results):
+            with self.script_index_lock:
+                if self.script_index is not None:
+                    self.script_index.add(run_id, context.command, script, files, context.mode)
+        return results
 
-    def execute_command(self, message: str) -> None:
-        """执行用户的文字命令"""
-        log.debug(f"执行用户命令: {message}")
+    def find_reusable_script(self, command: str, files: List[Path],
+                             mode: ExecutionMode = ExecutionMode.PER_FILE) -> Optional[ScriptMatch]:
+        """在已确认且执行成功、执行方式相同的历史脚本中，查找与当前命令足够相似的脚本"""
+        if self.config.reuse_threshold > 1 or not command.strip():
+            return None
+        with self.script_index_lock:
+            if self.script_index is None:
+                self.script_index = ScriptIndex()
+                for entry in self.history.approved_runs(MAX_INDEXED_SCRIPTS):
+                    self.script_index.add(entry.id, entry.command, entry.script, entry.files,
+                                          entry.mode)
+            match = self.script_index.query(command, files, mode)
+        if match is None or match.score < self.config.reuse_threshold:
+            return None
+        return match
+
+    def execute_command(self, conversation: Conversation, command: str, files: List[Path],
+                        allow_reuse: bool = True, token: Optional[CancelToken] = None,
+                        signals: Optional[CommandSignals] = None,
+                        mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        """
+        执行用户的文字命令，进行一轮对话，模型的回复会追加到 conversation 中。
+        command, files: 用户的原始命令和文件，用于查找可复用的历史脚本
+        allow_reuse: 找到足够相似的历史脚本时，直接使用它而不请求模型
+        token: 取消标记。取消后立即关闭网络连接，不再发出任何信号，也不修改 conversation
+        signals: 接收本次命令事件的信号，默认为 self.command_signals
+        mode: 脚本的执行方式，只复用相同执行方式的历史脚本
+        """
+        log.debug(f"执行用户命令: {command}")
+        token = token or CancelToken()
+        signals = signals or self.command_signals
+
+        if allow_reuse and (match := self.find_reusable_script(command, files, mode)) is not None:
+            if token.cancelled:
+                return
+            log.info(f"复用历史脚本 #{match.run_id}，相似度 {match.score:.2f}")
+            conversation.add_reused_script(match.script)
+            signals.reuse_script.emit(match)
+            return
 
         if 0 <= self.config.current_model_index < len(self.config.models):
             pass
@@ -64,64 +479,63 @@ class Assistant:
         model = self.config.models[self.config.current_model_index]
         tools = list[AITool]()
         if model.supports_functions:  # 允许函数调用
-            def action(param: str) -> None:
+            def action(param: str) -> str:
                 data = json.loads(param)
                 script = data.get("script", "")
                 if not isinstance(script, str):
                     log.error("execute_python_script: 脚本生成异常；script 参数必须是字符串")
-                    return
-                self.command_signals.confirm_script.emit(script)
-            tools.append(AITool("execute_python_script",
-                                EXECUTE_PYTHON_SCRIPT, action,))
+                    raise ValueError("script 参数必须是字符串")
+                token.raise_if_cancelled()
+                signals.confirm_script.emit(script)
+                return "脚本已提交，等待用户确认后执行。"
+            # 同一时间只能有一个脚本等待用户确认
+            tools.append(AITool("execute_python_script", EXECUTE_PYTHON_SCRIPT, action,
+                                stream_field="script", max_concurrency=1))
 
-        client = AIClient(model, tools)
+        client = AIClient(model, tools, self.config.request_policy)
 
         full_content = ""
-        self.command_signals.running_lock = True
-        for response in client.chat_stream([
-            {"role": "user", "content": message},
-        ], temperature=0.2):
-            if not self.command_signals.running_lock:
-                client.close_active()
-                break  # 中断
-            self.command_signals.receive_content.emit(response)  # 在客户端刷新文字
-            if response.type == ChatContent.Type.CONTENT:
-                full_content += response.text
-        
+        # 取消时在调用 cancel 的线程中直接关闭连接，正在阻塞的读取会立即结束
+        unregister = token.on_cancel(client.close_active)
+        try:
+            for response in client.chat_stream(conversation.trimmed(), temperature=0.2,
+                                               should_stop=lambda: token.cancelled):
+                if token.cancelled:
+                    break
+                signals.receive_content.emit(response)  # 在客户端刷新文字
+                if response.type == ChatContent.Type.CONTENT:
+                    full_content += response.text
+        except Exception:
+            if token.cancelled:
+                return  # 关闭连接引起的错误
+            raise
+        finally:
+            unregister()
+
+        if token.cancelled or client.cancelled:
+            return  # 中断
+        conversation.add_reply(client.follow_up_messages())
+
         if not model.supports_functions:
             # 手动解析 Python 脚本
             code_match = re.search(
                 r"```python\n(.*?)\n```", full_content, re.DOTALL)
-            if code_match:  # 检测到 Python 代码块
+            if code_match and not token.cancelled:  # 检测到 Python 代码块
                 script = code_match.group(1)
-                self.command_signals.confirm_script.emit(script)
-
-    def build_prompt(self, command: str, files: List[Path], supports_fc: bool) -> str:
-        """通过给定的命令和文件列表，构建 AI 提示词"""
-
-        prompt = """
-接下来将会给你一个用户的需求，你可以选择编写一个 Python 脚本并运行来解决这个任务，或者直接向用户输出文本内容。"""
-        if supports_fc:
-            prompt += """
-如果你选择生成 Python 脚本，请通过指定的 Function Calling 工具来提交。你只能生成一个脚本，并且不能由此获得更多信息。
-你需要在输出的正文中包含代码，然后在函数调用中原封不动地提交它，以确保用户可以及时看到你的工作状态。
-你可以在正文中包含其他的描述性内容以帮助你输出，这些内容仅会展示给用户。"""
-        else:
-            prompt += """
-如果你选择生成 Python 脚本，请保证你的输出中仅包含一个 Python 代码块（使用 Markdown 语法 ```python [代码]``` 包裹），接下来用户将会执行这个代码。
-代码块以外可以包括其他描述性的内容以帮助你输出，这些内容仅会展示给用户。"""
+                signals.confirm_script.emit(script)
 
-        prompt += """
-Python 脚本需要遵循以下规则：
-1. 可以独立地正常运行。
-2. 优先使用标准库和常用依赖库。
-3. 脚本必须包含 if __name__ == '__main__' 块作为程序入口。
-4. 如果需要输入文件，通过 sys.argv 获取参数，第一个参数为输入文件名。
-5. 如果需要输出文件，请保存为：原文件名_out.扩展名。
+    def build_system_prompt(self, supports_fc: bool,
+                            mode: ExecutionMode = ExecutionMode.PER_FILE) -> str:
+        """
+        构建系统提示词：只包含固定的规则，对同一种模型和执行方式每次都完全相同，
+        使服务商的提示词缓存（前缀缓存）能够命中。
+        """
+        return SYSTEM_PROMPT_INTRO + (SYSTEM_PROMPT_FC if supports_fc else SYSTEM_PROMPT_NO_FC) \
+            + MODE_RULES[mode]
 
-如果用户输入包含多个文件，你的程序将会对每个文件运行。
-"""
-        prompt += f"\n 用户指令：{command}"
+    def build_prompt(self, command: str, files: List[Path]) -> str:
+        """通过给定的命令和文件列表，构建用户提示词（每次请求不同的部分）"""
+        prompt = f"用户指令：{command}"
 
         if files:
             prompt += "\n你需要处理以下文件："
@@ -129,9 +543,10 @@ Python 脚本需要遵循以下规则：
                 prompt += f"\n- {file}"
 
                 # 对于小的文本文件，添加内容预览
-                if os.path.getsize(file) < PREVIEW_FILE_LIMIT and is_text(file):
+                if (os.path.getsize(file) < PREVIEW_FILE_LIMIT
+                        and (encoding := detect_text_encoding(file)) is not None):
                     try:
-                        with open(file, 'r', encoding="utf-8") as f:
+                        with open(file, 'r', encoding=encoding) as f:
                             content = f.read()
                             prompt += f"\n文件内容：\n{content}\n"
                     except Exception as e:
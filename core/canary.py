@@ -0,0 +1,79 @@
+"""
+试运行：先在少量有代表性的文件上运行脚本，确认没有问题后再处理其余文件
+"""
+import ast
+import os
+import re
+from typing import Dict, List, Tuple
+from core.execute import ScriptResult, ExecutionMode
+from core.journal import find_outputs, output_path, OUTPUT_SUFFIX
+from utils.general import Path
+
+MAX_CANARY_FILES = 4  # 最多试运行的文件数量
+# 字符串中的输出文件名约定，例如 "_out.csv"、f"{base}_out{ext}"；不匹配 "_output" 之类的单词
+OUTPUT_NAME_PATTERN = re.compile(re.escape(OUTPUT_SUFFIX) + r"(?![A-Za-z0-9_])")
+# 由脚本自己写出 原文件名_out 输出文件的执行方式；其他方式的输出由程序写出或不按文件命名
+OUTPUT_CHECKED_MODES = {ExecutionMode.PER_FILE, ExecutionMode.BATCH}
+
+
+def file_size(file: Path) -> int:
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return 0
+
+
+def pick_canary_files(files: List[Path], limit: int = MAX_CANARY_FILES) -> List[Path]:
+    """
+    选出试运行的文件：最小的文件，以及每种扩展名中最小的文件（文件多的类型优先），
+    按原来的顺序返回。
+    """
+    groups: Dict[str, List[Path]] = {}
+    for file in files:
+        groups.setdefault(os.path.splitext(file)[1].lower(), []).append(file)
+    sizes = {file: file_size(file) for file in files}
+
+    picked = [min(files, key=lambda file: sizes[file])]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        if len(picked) >= limit:
+            break
+        smallest = min(group, key=lambda file: sizes[file])
+        if smallest not in picked:
+            picked.append(smallest)
+    chosen = set(picked)
+    return [file for file in files if file in chosen]
+
+
+def uses_output_name(script: str) -> bool:
+    """脚本的字符串常量中是否使用了约定的输出文件名（变量名等标识符不算）"""
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        return False
+    return any(isinstance(node, ast.Constant) and isinstance(node.value, str)
+               and OUTPUT_NAME_PATTERN.search(node.value)
+               for node in ast.walk(tree))
+
+
+def check_canary_results(script: str, results: List[Tuple[Path, ScriptResult]],
+                         started_at: float, mode: ExecutionMode = ExecutionMode.PER_FILE
+                         ) -> Dict[Path, str]:
+    """
+    检查试运行的结果，返回有问题的文件及问题说明。
+    返回值必须为 0；逐个文件和批量处理时，如果脚本中使用了约定的输出文件名，
+    还需要生成非空的输出文件（原文件名_out，扩展名不限）。
+    """
+    expects_output = mode in OUTPUT_CHECKED_MODES and uses_output_name(script)
+    problems: Dict[Path, str] = {}
+    for file, result in results:
+        if result.return_code != 0:
+            last_line = (result.stderr.strip().splitlines() or [""])[-1]
+            problems[file] = f"返回值 {result.return_code} {last_line}".strip()
+            continue
+        if expects_output:
+            outputs = find_outputs(file, started_at)
+            if not outputs:
+                problems[file] = f"没有生成或更新输出文件 {output_path(file)}（扩展名不限）"
+            elif not any(file_size(out) for out in outputs):
+                problems[file] = f"输出文件 {outputs[0]} 是空的"
+    return problems
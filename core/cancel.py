@@ -0,0 +1,70 @@
+"""
+请求级别的取消标记
+"""
+import threading
+from typing import Callable, List, Optional
+from utils.general import log
+
+
+class CancelledError(Exception):
+    """请求已被取消"""
+    def __init__(self, message: str = "请求已取消") -> None:
+        super().__init__(message)
+
+
+class CancelToken:
+    """
+    一次请求（一轮对话或一次脚本执行）的取消标记，每个请求使用自己的标记。
+    取消时会在调用 cancel 的线程中立即执行已注册的回调，例如关闭网络连接、结束子进程，
+    而不必等待工作线程自己发现。
+    """
+    _event: threading.Event
+    _callbacks: List[Callable[[], None]]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """取消请求。重复调用不会产生效果"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                log.error(f"CancelToken: 取消回调出错：{e}")
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        注册取消时执行的回调，返回用于撤销注册的函数。
+        如果已经取消，回调会立即执行。
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise CancelledError()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待取消，返回是否已经取消"""
+        return self._event.wait(timeout)
@@ -0,0 +1,196 @@
+"""
+分块模式：把一个很大的按行组织的文本文件按换行切分为多个字节区间，
+在多个进程中并行处理，再按顺序合并输出。
+"""
+import locale
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import unlink
+from time import perf_counter
+from typing import List, Optional, Tuple
+from core.cancel import CancelToken
+from core.execute import ScriptResult, PYTHON_EXECUTABLE, CANCELLED_RETURN_CODE
+from core.journal import output_path
+from utils.file import detect_text_encoding
+from utils.general import log, Path
+
+CHUNK_ENV = "SMART_ASSISTANT_CHUNK"  # 环境变量：分块的序号，从 0 开始
+INPUT_ENV = "SMART_ASSISTANT_INPUT"  # 环境变量：原始输入文件的路径
+MIN_CHUNK_SIZE = 8 * 1024 * 1024  # 每块的最小大小，更小的文件不切分
+CHUNKS_PER_WORKER = 2  # 每个进程平均分到的块数，使各进程的负载更均衡
+WRITE_BLOCK_SIZE = 1024 * 1024  # 每次写入脚本 stdin 的大小
+HEADER_EXTENSIONS = {".csv", ".tsv"}  # 第一行为表头的格式，表头会加到每一块的开头
+# 每个字符不一定以单字节的换行结尾的编码，无法按字节切分
+UNSPLITTABLE_ENCODINGS = {"utf-16", "utf-32"}
+
+
+def split_ranges(data: mmap.mmap, start: int, end: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """把 [start, end) 切分为大约 chunk_size 大小的区间，每个区间都在换行之后结束"""
+    ranges: List[Tuple[int, int]] = []
+    position = start
+    while position < end:
+        boundary = position + chunk_size
+        if boundary >= end:
+            ranges.append((position, end))
+            break
+        newline = data.find(b"\n", boundary, end)
+        if newline < 0:
+            ranges.append((position, end))
+            break
+        ranges.append((position, newline + 1))
+        position = newline + 1
+    return ranges
+
+
+def header_end(data: mmap.mmap, size: int) -> int:
+    """表头行（包括换行）的结束位置"""
+    newline = data.find(b"\n", 0, size)
+    return size if newline < 0 else newline + 1
+
+
+def run_chunk(script_path: Path, file: Path, index: int, data: Optional[mmap.mmap],
+              header: Tuple[int, int], chunk: Tuple[int, int], output: Path,
+              token: Optional[CancelToken]) -> Tuple[int, str]:
+    """
+    在一个进程中处理一块：表头和这一块的内容依次写入 stdin，stdout 写入 output。
+    返回 (返回值, stderr)
+    """
+    env = {**os.environ, CHUNK_ENV: str(index), INPUT_ENV: os.path.abspath(file)}
+    with open(output, "wb") as out:
+        process = subprocess.Popen(
+            [PYTHON_EXECUTABLE, script_path, file], stdin=subprocess.PIPE, stdout=out,
+            stderr=subprocess.PIPE, env=env)
+    unregister = token.on_cancel(process.kill) if token is not None else lambda: None
+
+    def feed() -> None:
+        """直接从内存映射写入，不复制文件内容"""
+        assert process.stdin is not None
+        try:
+            if data is not None:
+                view = memoryview(data)
+                try:
+                    for start, end in (header, chunk):
+                        for position in range(start, end, WRITE_BLOCK_SIZE):
+                            block_end = min(position + WRITE_BLOCK_SIZE, end)
+                            process.stdin.write(view[position:block_end])
+                finally:
+                    view.release()
+        except (BrokenPipeError, OSError):
+            pass  # 脚本提前结束，不再读取输入
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    writer = threading.Thread(target=feed, name=f"chunk-{index}", daemon=True)
+    writer.start()
+    try:
+        assert process.stderr is not None
+        stderr = process.stderr.read().decode(locale.getpreferredencoding(False), errors="replace")
+        process.wait()
+        writer.join()
+    finally:
+        unregister()
+    return process.returncode, stderr
+
+
+def execute_chunked_script(script: str, file: Path, workers: int,
+                           token: Optional[CancelToken] = None) -> Tuple[ScriptResult, int]:
+    """
+    以分块模式处理一个文件：按换行切分为若干块，最多 workers 个进程并行处理，
+    每块从 stdin 读取输入、向 stdout 输出，全部成功后按顺序合并为 原文件名_out.扩展名。
+    CSV/TSV 文件的表头会加到每一块的开头。
+    返回执行结果和分块数量。
+    """
+    size = os.path.getsize(file)
+    encoding = detect_text_encoding(file)
+    splittable = encoding is not None and encoding not in UNSPLITTABLE_ENCODINGS
+
+    temp_files: List[Path] = []
+    start_time = perf_counter()
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w",
+                                         encoding="utf-8") as tmp:
+            tmp.write(script)
+        temp_files.append(tmp.name)
+        script_path = tmp.name
+
+        with open(file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        try:
+            header = (0, 0)
+            if data is None:
+                chunks = [(0, 0)]
+            elif not splittable:
+                chunks = [(0, size)]
+            else:
+                body_start = 0
+                if os.path.splitext(file)[1].lower() in HEADER_EXTENSIONS:
+                    header = (0, header_end(data, size))
+                    body_start = header[1]
+                chunk_size = max(MIN_CHUNK_SIZE,
+                                 -(-(size - body_start) // (workers * CHUNKS_PER_WORKER)))
+                chunks = split_ranges(data, body_start, size, chunk_size) \
+                    or [(body_start, body_start)]
+            log.info(f"分块处理 {file}：{len(chunks)} 块")
+
+            outputs: List[Path] = []
+            for _ in chunks:
+                with tempfile.NamedTemporaryFile(suffix=".part", delete=False) as part:
+                    outputs.append(part.name)
+            temp_files += outputs
+
+            def run(index: int) -> Tuple[int, str]:
+                if token is not None and token.cancelled:
+                    return CANCELLED_RETURN_CODE, ""
+                return run_chunk(script_path, file, index, data, header, chunks[index],
+                                 outputs[index], token)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks))),
+                                    thread_name_prefix="chunk") as executor:
+                chunk_results = list(executor.map(run, range(len(chunks))))
+        finally:
+            if data is not None:
+                data.close()
+
+        duration = perf_counter() - start_time
+        if token is not None and token.cancelled:
+            return ScriptResult("", "脚本已被取消", CANCELLED_RETURN_CODE, duration), len(chunks)
+
+        stderr = "\n".join(f"[第 {index + 1} 块] {text.strip()}"
+                           for index, (_, text) in enumerate(chunk_results) if text.strip())
+        failed = [(index, code) for index, (code, _) in enumerate(chunk_results) if code != 0]
+        if failed:
+            index, code = failed[0]
+            return ScriptResult("", f"{len(failed)} 块处理失败，第 {index + 1} 块返回值 {code}\n"
+                                + stderr, code, duration), len(chunks)
+
+        # 先合并到临时文件，再替换输出文件，失败时不会留下不完整的输出
+        out = output_path(file)
+        fd, merged = tempfile.mkstemp(prefix=f".{os.path.basename(out)}.", suffix=".tmp",
+                                      dir=os.path.dirname(os.path.abspath(out)))
+        try:
+            with os.fdopen(fd, "wb") as merged_file:
+                for part in outputs:
+                    with open(part, "rb") as part_file:
+                        shutil.copyfileobj(part_file, merged_file)
+            os.replace(merged, out)
+        except BaseException:
+            try:
+                unlink(merged)
+            except OSError:
+                pass
+            raise
+        return ScriptResult(f"输出已写入 {out}", stderr, 0, perf_counter() - start_time), len(chunks)
+    finally:
+        for temp_file in temp_files:
+            try:
+                unlink(temp_file)
+            except OSError:
+                pass
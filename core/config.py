@@ -1,9 +1,25 @@
 import json
 import os
-from typing import Dict, Any, List
-from core.ai_client import AIModel
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+from core.ai_client import AIModel, RequestPolicy
+from core.execute import ExecutionMode
+from utils.file import write_atomic
+from utils.general import log
 
 DEFAULT_CONFIG_PATH = os.path.expanduser("~/.smart_assistant/config.json")
+SAVE_DELAY = 0.5  # 保存请求合并的时间窗口（秒）
+
+# 拖入文件夹时的默认扫描设置
+DEFAULT_SCAN_INCLUDE: List[str] = []  # 为空表示包含所有文件
+DEFAULT_SCAN_EXCLUDE = [".git", ".svn", "__pycache__", "node_modules", ".venv", "*.pyc"]
+DEFAULT_SCAN_MAX_DEPTH = 16
+
+DEFAULT_REUSE_THRESHOLD = 0.75  # 复用历史脚本所需的最低相似度，大于 1 表示不复用
+DEFAULT_MAX_PARALLEL_TASKS = 3  # 同时生成或执行脚本的命令数量上限
+DEFAULT_MAX_SCRIPT_WORKERS = os.cpu_count() or 4  # 逐个文件处理时，同时运行的脚本进程数量
+# 脚本导入这些模块时，由预加载了它们的执行服务 fork 子进程执行，省去每次导入的时间
+DEFAULT_PRELOAD_MODULES = ["numpy", "pandas", "PIL.Image", "openpyxl", "lxml.etree"]
 
 class InvalidConfigError(Exception):
     """配置文件格式错误"""
@@ -16,31 +32,198 @@ class Config:
     models: List[AIModel]
     current_model_index: int = 0
 
+    scan_include: List[str]  # 扫描文件夹时包含的文件名模式
+    scan_exclude: List[str]  # 扫描文件夹时排除的文件（夹）名模式
+    scan_max_depth: int  # 扫描文件夹的最大深度
+    reuse_threshold: float  # 复用历史脚本所需的最低相似度
+    request_policy: RequestPolicy  # 请求模型时的超时、重试和对冲设置
+    max_parallel_tasks: int  # 同时生成或执行脚本的命令数量上限
+    execution_mode: ExecutionMode  # 新命令默认的脚本执行方式
+    incremental_runs: bool  # 跳过之前已经用同一脚本处理过且没有变化的文件
+    canary_run: bool  # 文件较多时，先在少量样本文件上试运行
+    max_script_workers: int  # 逐个文件处理时，同时运行的脚本进程数量
+    fork_server: bool  # 逐个文件处理时，使用预加载模块的执行服务（仅支持 fork 的系统）
+    preload_modules: List[str]  # 执行服务可以预加载的模块
+
+    _pending: Optional[Dict[str, Any]]  # 等待写入的数据，不为 None 表示有未保存的修改
+    _save_timer: Optional[threading.Timer]  # 延迟保存的计时器
+    _pending_lock: threading.Lock  # 保护 _pending 和 _save_timer
+    _write_lock: threading.Lock  # 保证同一时间只有一次写入
+    _saved_state: Optional[Dict[str, Any]]  # 最近一次读取或保存的数据，用于撤销修改
+    _file_signature: Optional[Tuple[int, int]]  # 最近一次读写时文件的 (修改时间, 大小)
+
     def __init__(self, config_path: str = DEFAULT_CONFIG_PATH) -> None:
         self.config_path = config_path
         self.models = []
+        self.scan_include = list(DEFAULT_SCAN_INCLUDE)
+        self.scan_exclude = list(DEFAULT_SCAN_EXCLUDE)
+        self.scan_max_depth = DEFAULT_SCAN_MAX_DEPTH
+        self.reuse_threshold = DEFAULT_REUSE_THRESHOLD
+        self.request_policy = RequestPolicy()
+        self.max_parallel_tasks = DEFAULT_MAX_PARALLEL_TASKS
+        self.execution_mode = ExecutionMode.PER_FILE
+        self.incremental_runs = True
+        self.canary_run = True
+        self.max_script_workers = DEFAULT_MAX_SCRIPT_WORKERS
+        self.fork_server = True
+        self.preload_modules = list(DEFAULT_PRELOAD_MODULES)
+        self._pending = None
+        self._save_timer = None
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._saved_state = None
+        self._file_signature = None
         self.load()
-    
-    def __del__(self) -> None:
-        self.save()
+
+    def get_file_signature(self) -> Optional[Tuple[int, int]]:
+        """获取配置文件当前的 (修改时间, 大小)，文件不存在时返回 None"""
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
     def load(self) -> None:
+        self.flush()  # 先写入尚未保存的修改，避免读到旧文件
+        signature = self.get_file_signature()
         try:
             with open(self.config_path, "r", encoding="UTF-8") as f:
                 data = json.load(f)
         except FileNotFoundError:
-            return # 使用默认配置
-        
+            self._saved_state = self.to_dict()  # 使用默认配置，撤销修改时恢复到默认配置
+            return
+        self.apply_dict(data)
+        self._saved_state = data
+        self._file_signature = signature
+
+    def reload_if_changed(self) -> bool:
+        """
+        如果配置文件在外部被修改，重新读取。返回设置是否发生了变化。
+        自身写入的文件不会触发重新读取。
+        """
+        if self.is_dirty():
+            return False  # 有尚未写入的修改，以程序中的设置为准
+        signature = self.get_file_signature()
+        if signature is None or signature == self._file_signature:
+            return False
+        try:
+            with open(self.config_path, "r", encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"无法重新读取配置文件：{e}")  # 可能正在被其他程序写入
+            return False
+        if data == self._saved_state:
+            self._file_signature = signature
+            return False
         try:
-            self.models = [AIModel(**model) for model in data["models"]]
-            self.current_model_index = int(data["current_model_index"])
-        except KeyError as e:
+            self.apply_dict(data)
+        except InvalidConfigError as e:
+            log.warning(f"{e}，保留当前的设置")
+            return False
+        self._saved_state = data
+        self._file_signature = signature
+        log.info("配置文件已在外部修改，已重新读取")
+        return True
+
+    def revert(self) -> None:
+        """撤销尚未保存的修改，恢复到最近一次读取或保存的状态"""
+        if self._saved_state is not None:
+            self.apply_dict(self._saved_state)
+
+    def apply_dict(self, data: Dict[str, Any]) -> None:
+        """
+        从配置文件的数据中读取设置；未改变的模型保留原有对象。
+        先检查全部设置，格式错误时抛出 InvalidConfigError，不修改任何设置。
+        """
+        try:
+            models: List[AIModel] = []
+            for index, model_data in enumerate(data["models"]):
+                if index < len(self.models) and self.models[index].to_dict() == model_data:
+                    models.append(self.models[index])
+                else:
+                    models.append(AIModel(**model_data))
+            current_model_index = int(data["current_model_index"])
+            # 可选项，旧的配置文件中可能不存在
+            scan_include = list(data.get("scan_include", DEFAULT_SCAN_INCLUDE))
+            scan_exclude = list(data.get("scan_exclude", DEFAULT_SCAN_EXCLUDE))
+            scan_max_depth = int(data.get("scan_max_depth", DEFAULT_SCAN_MAX_DEPTH))
+            reuse_threshold = float(data.get("reuse_threshold", DEFAULT_REUSE_THRESHOLD))
+            request_policy = RequestPolicy(**data.get("request_policy", {}))
+            max_parallel_tasks = int(data.get("max_parallel_tasks", DEFAULT_MAX_PARALLEL_TASKS))
+            execution_mode = ExecutionMode(
+                data.get("execution_mode", ExecutionMode.PER_FILE.value))
+            incremental_runs = bool(data.get("incremental_runs", True))
+            canary_run = bool(data.get("canary_run", True))
+            max_script_workers = int(data.get("max_script_workers", DEFAULT_MAX_SCRIPT_WORKERS))
+            fork_server = bool(data.get("fork_server", True))
+            preload_modules = list(data.get("preload_modules", DEFAULT_PRELOAD_MODULES))
+        except (KeyError, TypeError, ValueError) as e:
             raise InvalidConfigError(f"配置文件格式错误: {e}")
 
-    def save(self) -> None:
-        data: Dict[str, Any] = {
-            "models": [model.to_dict() for model in self.models],
-            "current_model_index": self.current_model_index
+        self.models[:] = models  # 原地修改，保持其他地方持有的引用有效
+        self.current_model_index = current_model_index
+        self.scan_include = scan_include
+        self.scan_exclude = scan_exclude
+        self.scan_max_depth = scan_max_depth
+        self.reuse_threshold = reuse_threshold
+        self.request_policy = request_policy
+        self.max_parallel_tasks = max_parallel_tasks
+        self.execution_mode = execution_mode
+        self.incremental_runs = incremental_runs
+        self.canary_run = canary_run
+        self.max_script_workers = max_script_workers
+        self.fork_server = fork_server
+        self.preload_modules = preload_modules
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为配置文件的数据（复制一份，之后的修改不会影响结果）"""
+        return {
+            "models": [dict(model.to_dict()) for model in self.models],
+            "current_model_index": self.current_model_index,
+            "scan_include": list(self.scan_include),
+            "scan_exclude": list(self.scan_exclude),
+            "scan_max_depth": self.scan_max_depth,
+            "reuse_threshold": self.reuse_threshold,
+            "request_policy": dict(self.request_policy.to_dict()),
+            "max_parallel_tasks": self.max_parallel_tasks,
+            "execution_mode": self.execution_mode.value,
+            "incremental_runs": self.incremental_runs,
+            "canary_run": self.canary_run,
+            "max_script_workers": self.max_script_workers,
+            "fork_server": self.fork_server,
+            "preload_modules": list(self.preload_modules),
         }
-        with open(self.config_path, "w", encoding="UTF-8") as f:
-            json.dump(data, f, indent=4)
+
+    def save(self) -> None:
+        """
+        请求保存配置。实际写入在后台线程中延迟进行，
+        短时间内的多次请求只会写入一次最新的数据。
+        """
+        with self._pending_lock:
+            self._pending = self.to_dict()
+            self._saved_state = self._pending
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(SAVE_DELAY, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def is_dirty(self) -> bool:
+        """是否存在尚未写入文件的修改"""
+        return self._pending is not None
+
+    def flush(self) -> None:
+        """立即写入尚未保存的修改。程序退出前需要调用"""
+        with self._write_lock:
+            with self._pending_lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                data, self._pending = self._pending, None
+            if data is None:
+                return
+            try:
+                write_atomic(self.config_path, json.dumps(data, indent=4))
+                self._file_signature = self.get_file_signature()
+            except OSError as e:
+                log.error(f"无法保存配置文件：{e}")
@@ -0,0 +1,51 @@
+"""
+监视配置文件的修改
+"""
+import os
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+from core.config import Config
+
+RELOAD_DELAY_MS = 200  # 文件变化后等待多久再读取，合并编辑器的多次写入
+
+
+class ConfigWatcher(QObject):
+    """
+    通过 QFileSystemWatcher（Linux 上基于 inotify）监视配置文件，
+    文件确实发生变化时重新读取并发出信号。
+    """
+    config_changed = pyqtSignal()  # 设置已被重新读取
+
+    config: Config
+    watcher: QFileSystemWatcher
+    reload_timer: QTimer
+
+    def __init__(self, config: Config) -> None:
+        super().__init__()
+        self.config = config
+        self.watcher = QFileSystemWatcher()
+        self.reload_timer = QTimer()
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(RELOAD_DELAY_MS)
+        self.reload_timer.timeout.connect(self.reload)
+
+        # 同时监视所在目录：原子替换或新建文件时，文件本身的监视会失效
+        directory = os.path.dirname(os.path.abspath(config.config_path))
+        if os.path.isdir(directory):
+            self.watcher.addPath(directory)
+        self.watch_file()
+        self.watcher.fileChanged.connect(self.on_changed)
+        self.watcher.directoryChanged.connect(self.on_changed)
+
+    def watch_file(self) -> None:
+        """确保配置文件处于监视中"""
+        if (os.path.exists(self.config.config_path)
+                and self.config.config_path not in self.watcher.files()):
+            self.watcher.addPath(self.config.config_path)
+
+    def on_changed(self, _path: str) -> None:
+        self.reload_timer.start()  # 重新计时
+
+    def reload(self) -> None:
+        self.watch_file()
+        if self.config.reload_if_changed():
+            self.config_changed.emit()
@@ -0,0 +1,168 @@
+"""
+与模型的多轮对话：保存消息列表，把脚本的执行结果交还给模型
+"""
+from typing import List, Dict, Any, Optional, Tuple
+from core.execute import ScriptResult
+from utils.general import Path
+
+MAX_AUTO_RETRIES = 2  # 脚本执行失败后，自动请求模型修改的最大次数
+CONTEXT_BUDGET_CHARS = 48000  # 每轮发送的消息总长度上限（字符数，粗略代替 token 数）
+MAX_OUTPUT_CHARS = 1500  # 每个文件的输出最多保留的字符数
+MAX_REPORTED_FILES = 10  # 结果中最多详细列出的文件数量
+
+SCRIPT_TOOL_NAME = "execute_python_script"
+RETRY_PROMPT = "脚本执行失败。请根据上面的错误信息修正脚本，并重新提交完整的脚本。"
+
+Message = Dict[str, Any]
+
+
+def truncate(text: str, limit: int = MAX_OUTPUT_CHARS) -> str:
+    """截断过长的输出，保留开头和结尾"""
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    return f"{text[:half]}\n...（省略 {len(text) - limit} 个字符）...\n{text[-half:]}"
+
+
+def format_results(results: List[Tuple[Path, ScriptResult]]) -> str:
+    """把每个文件的执行结果整理为交给模型的文本，失败的文件优先列出"""
+    failed = [(file, result) for file, result in results if result.return_code != 0]
+    lines = [f"脚本已对 {len(results)} 个文件执行，其中 {len(failed)} 个失败。"]
+    if skipped := sum(1 for _, result in results if result.skipped):
+        lines.append(f"（其中 {skipped} 个文件之前已经处理过且没有变化，沿用了上次的结果）")
+    shown = (failed + [item for item in results if item[1].return_code == 0])[:MAX_REPORTED_FILES]
+    for file, result in shown:
+        lines.append(f"\n文件：{file}\n返回值：{result.return_code}")
+        if stdout := truncate(result.stdout):
+            lines.append(f"stdout：\n{stdout}")
+        if stderr := truncate(result.stderr):
+            lines.append(f"stderr：\n{stderr}")
+    if len(results) > len(shown):
+        lines.append(f"\n（其余 {len(results) - len(shown)} 个文件未列出）")
+    return "\n".join(lines)
+
+
+def message_size(message: Message) -> int:
+    """估算消息的长度"""
+    size = len(message.get("content") or "")
+    for call in message.get("tool_calls") or []:
+        size += len(call["function"]["arguments"])
+    return size
+
+
+class Conversation:
+    """
+    一次用户命令对应的对话。
+    模型生成的脚本经用户确认执行后，结果以 tool 消息（或普通消息）追加到对话中，
+    失败时可以在有限次数内自动让模型修改脚本。
+    """
+    messages: List[Message]
+    retries: int  # 已经自动重试的次数
+    max_retries: int
+    budget_chars: int
+    pending_call_id: Optional[str]  # 等待执行结果的脚本工具调用
+
+    def __init__(self, prompt: str, system: Optional[str] = None,
+                 max_retries: int = MAX_AUTO_RETRIES,
+                 budget_chars: int = CONTEXT_BUDGET_CHARS) -> None:
+        self.messages = []
+        if system:
+            self.messages.append({"role": "system", "content": system})
+        self.messages.append({"role": "user", "content": prompt})
+        self.retries = 0
+        self.max_retries = max_retries
+        self.budget_chars = budget_chars
+        self.pending_call_id = None
+
+    def add_reply(self, follow_up: List[Message]) -> None:
+        """
+        追加模型的回复（见 AIClient.follow_up_messages）。
+        脚本工具的结果需要等到用户确认并执行后才能确定，先暂不追加。
+        """
+        assistant_message, *tool_messages = follow_up
+        self.messages.append(assistant_message)
+        script_call_ids = {call["id"] for call in assistant_message.get("tool_calls") or []
+                           if call["function"]["name"] == SCRIPT_TOOL_NAME}
+        for message in tool_messages:
+            if message["tool_call_id"] in script_call_ids and self.pending_call_id is None:
+                self.pending_call_id = message["tool_call_id"]
+            else:
+                self.messages.append(message)
+
+    def add_reused_script(self, script: str) -> None:
+        """记录直接复用的历史脚本，使后续的重试能看到它"""
+        self.messages.append({"role": "assistant", "content": f"```python\n{script}\n```"})
+
+    def add_feedback(self, text: str) -> None:
+        """把脚本相关的反馈交给模型：有等待中的工具调用时作为 tool 结果，否则作为用户消息"""
+        if self.pending_call_id is not None:
+            self.messages.append(
+                {"role": "tool", "tool_call_id": self.pending_call_id, "content": text})
+            self.pending_call_id = None
+        else:
+            self.messages.append({"role": "user", "content": text})
+
+    def add_script_results(self, results: List[Tuple[Path, ScriptResult]]) -> bool:
+        """追加脚本的执行结果，返回是否有文件执行失败"""
+        self.add_feedback(format_results(results))
+        return any(result.return_code != 0 for _, result in results)
+
+    def add_script_denied(self) -> None:
+        """用户拒绝执行脚本"""
+        self.add_feedback("用户拒绝执行这个脚本。")
+
+    def start_retry(self) -> bool:
+        """如果还可以自动重试，记录一次重试并返回 True"""
+        if self.retries >= self.max_retries:
+            return False
+        self.retries += 1
+        self.messages.append({"role": "user", "content": RETRY_PROMPT})
+        return True
+
+    def trimmed(self) -> List[Message]:
+        """
+        获取本轮需要发送的消息。超出长度预算时，省略最早的几轮尝试，
+        只保留系统消息、原始命令、一条摘要和最近的几轮。
+        """
+        total = sum(message_size(message) for message in self.messages)
+        if total <= self.budget_chars:
+            return list(self.messages)
+
+        head_count = 2 if self.messages[0]["role"] == "system" else 1
+        head = self.messages[:head_count]
+        rest = self.messages[head_count:]
+
+        # 按轮次分组：每轮从 assistant 消息开始，tool 消息必须与其 assistant 消息在一起
+        turns: List[List[Message]] = []
+        for message in rest:
+            if message["role"] == "assistant" or not turns:
+                turns.append([message])
+            else:
+                turns[-1].append(message)
+
+        budget = self.budget_chars - sum(message_size(message) for message in head)
+        kept: List[List[Message]] = []
+        for turn in reversed(turns):
+            size = sum(message_size(message) for message in turn)
+            if kept and size > budget:
+                break
+            kept.append(turn)
+            budget -= size
+        kept.reverse()
+
+        dropped = turns[:len(turns) - len(kept)]
+        if not dropped:
+            return head + [message for turn in kept for message in turn]
+        summary_lines = [f"（为节省上下文，省略了较早的 {len(dropped)} 轮尝试。）"]
+        for index, turn in enumerate(dropped, 1):
+            for message in turn:
+                content = (message.get("content") or "").strip()
+                if message["role"] not in ("tool", "user") or not content or content == RETRY_PROMPT:
+                    continue
+                # 保留结果概况和最后一行（通常是异常信息）
+                lines = content.splitlines()
+                brief = lines[0] if len(lines) == 1 else f"{lines[0]} {lines[-1]}"
+                summary_lines.append(f"第 {index} 轮：{brief[:300]}")
+        summary = {"role": "user", "content": "\n".join(summary_lines)}
+        return head + [summary] + [message for turn in kept for message in turn]
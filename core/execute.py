@@ -1,32 +1,175 @@
 """用于执行 Python 脚本"""
 
+import json
+import os
 import tempfile
 import subprocess
+from enum import Enum
 from os import unlink
-from utils.general import log
+from time import perf_counter
+from typing import Optional, List, Dict, Tuple
+from core.cancel import CancelToken
+from utils.general import log, Path
+
+PYTHON_EXECUTABLE = "python"  # 执行脚本的解释器
+CANCELLED_RETURN_CODE = -1  # 脚本因取消而被结束时的返回值
+PREFLIGHT_FAILED_RETURN_CODE = -2  # 脚本没有通过执行前的检查，没有运行
+
+# 批量模式
+STATUS_ENV = "SMART_ASSISTANT_STATUS"  # 环境变量：脚本报告每个文件处理结果的文件
+MANIFEST_PREFIX = "@"  # 以此开头的参数表示清单文件
+MAX_ARGV_CHARS = 8000  # 文件路径总长度超过该值时改用清单文件（Windows 命令行上限为 32767 个字符）
+
+
+class ExecutionMode(Enum):
+    """脚本处理文件的方式"""
+    PER_FILE = "per_file"  # 每个文件启动一次脚本，文件名为 sys.argv[1]
+    BATCH = "batch"  # 只启动一次脚本处理所有文件，并逐个报告结果
+    CHUNKED = "chunked"  # 把每个大文件按行切分为多块并行处理，脚本从 stdin 读取、向 stdout 输出
+    MAP_REDUCE = "map_reduce"  # 每个文件运行 map 得到部分结果，由 reduce 合并为一个输出文件
+    PIPELINE = "pipeline"  # 一个或多个脚本通过管道串联，从 stdin 读取、向 stdout 输出
+
+
+MODE_NAMES = {
+    ExecutionMode.PER_FILE: "逐个文件",
+    ExecutionMode.BATCH: "批量",
+    ExecutionMode.CHUNKED: "大文件分块",
+    ExecutionMode.MAP_REDUCE: "汇总（map/reduce）",
+    ExecutionMode.PIPELINE: "管道",
+}
+
+# 表示代码尚未写完（括号、字符串未闭合等）的语法错误信息
+INCOMPLETE_HINTS = ("EOF", "was never closed", "unterminated", "expected an indented block")
+
 
 class ScriptResult:
     """脚本执行结果"""
-    def __init__(self, stdout: str, stderr: str, return_code: int):
+    def __init__(self, stdout: str, stderr: str, return_code: int, duration: float = 0.0,
+                 skipped: bool = False):
         self.stdout = stdout
         self.stderr = stderr
         self.return_code = return_code
+        self.duration = duration  # 运行耗时（秒）
+        self.skipped = skipped  # 文件在之前已经处理过且没有变化，本次没有执行
 
-def execute_python_script(script: str, args: str) -> ScriptResult:
-    """执行 Python 脚本"""
+def execute_python_script(script: str, args: str | List[str],
+                          token: Optional[CancelToken] = None,
+                          env: Optional[Dict[str, str]] = None) -> ScriptResult:
+    """
+    执行 Python 脚本
+    args: 一个或多个命令行参数
+    token: 取消时立即结束脚本进程
+    env: 额外的环境变量
+    """
     log.debug(f"execute_python_script: {script}")
+    argv = [args] if isinstance(args, str) else list(args)
 
     # 创建临时文件
     with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode='w', encoding="utf-8") as tmp:
         tmp.write(script)
         script_path = tmp.name
 
-    result = subprocess.run(
-        ["python", script_path, args],
-        capture_output=True,
-        text=True
-    )
+    start = perf_counter()
+    try:
+        process = subprocess.Popen(
+            [PYTHON_EXECUTABLE, script_path, *argv],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env={**os.environ, **env} if env else None
+        )
+        unregister = token.on_cancel(process.kill) if token is not None else lambda: None
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            unregister()
+    finally:
+        unlink(script_path) #  删除临时文件
+
+    if token is not None and token.cancelled:
+        return ScriptResult(stdout, stderr + "\n脚本已被取消", CANCELLED_RETURN_CODE,
+                            perf_counter() - start)
+    return ScriptResult(stdout, stderr, process.returncode, perf_counter() - start)
+
+
+def read_status_file(status_path: Path) -> Dict[str, Tuple[bool, str]]:
+    """读取批量模式的状态文件，返回规范化的路径到 (是否成功, 说明) 的映射，忽略格式错误的行"""
+    statuses: Dict[str, Tuple[bool, str]] = {}
+    try:
+        with open(status_path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                    file = os.path.normcase(os.path.abspath(str(data["file"])))
+                    statuses[file] = (bool(data.get("ok", False)), str(data.get("message", "")))
+                except (ValueError, KeyError, TypeError):
+                    log.debug(f"read_status_file: 无法解析状态：{line.strip()}")
+    except OSError as e:
+        log.warning(f"无法读取脚本的状态文件：{e}")
+    return statuses
+
+
+def execute_batch_script(script: str, files: List[Path], token: Optional[CancelToken] = None
+                         ) -> Tuple[ScriptResult, List[Tuple[Path, ScriptResult]]]:
+    """
+    以批量模式执行脚本：只启动一次，处理所有文件。
+    文件路径较少时通过命令行参数传入，否则写入清单文件，以 "@清单文件" 的形式传入。
+    脚本向环境变量 STATUS_ENV 指定的文件逐行写入 JSON：{"file": ..., "ok": ..., "message": ...}。
+    返回整个进程的结果，以及每个文件的结果；没有报告的文件视为失败。
+    """
+    temp_files: List[Path] = []
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as status_file:
+            status_path = status_file.name
+        temp_files.append(status_path)
+
+        if sum(len(file) + 1 for file in files) <= MAX_ARGV_CHARS:
+            args = list(files)
+        else:
+            with tempfile.NamedTemporaryFile(suffix=".txt", delete=False, mode="w",
+                                             encoding="utf-8") as manifest:
+                manifest.write("\n".join(files) + "\n")
+            temp_files.append(manifest.name)
+            args = [MANIFEST_PREFIX + manifest.name]
+
+        process_result = execute_python_script(script, args, token, {STATUS_ENV: status_path})
+        statuses = read_status_file(status_path)
+    finally:
+        for temp_file in temp_files:
+            try:
+                unlink(temp_file)
+            except OSError:
+                pass
+
+    # 进程的总耗时平均分给每个文件
+    duration = process_result.duration / len(files) if files else 0.0
+    results: List[Tuple[Path, ScriptResult]] = []
+    for file in files:
+        status = statuses.get(os.path.normcase(os.path.abspath(file)))
+        if status is None:
+            return_code = process_result.return_code or 1
+            results.append((file, ScriptResult("", "脚本没有报告这个文件的处理结果", return_code,
+                                               duration)))
+        elif status[0]:
+            results.append((file, ScriptResult(status[1], "", 0, duration)))
+        else:
+            results.append((file, ScriptResult("", status[1] or "处理失败", 1, duration)))
+    return process_result, results
 
-    unlink(script_path) #  删除临时文件
 
-    return ScriptResult(result.stdout, result.stderr, result.returncode)
+def find_syntax_error(script: str, partial: bool = False) -> Optional[SyntaxError]:
+    """
+    检查脚本的语法错误。
+    partial 为 True 时，脚本可能尚未生成完毕，忽略出现在最后一行（未完成部分）的错误。
+    """
+    try:
+        compile(script, "<script>", "exec", dont_inherit=True)
+    except SyntaxError as e:
+        if partial:
+            last_line = script.count("\n") + 1
+            message = str(e.msg)
+            if (e.lineno is None or e.lineno >= last_line - 1
+                    or any(hint in message for hint in INCOMPLETE_HINTS)):
+                return None  # 可能只是还没有写完
+        return e
+    return None
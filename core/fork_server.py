@@ -0,0 +1,344 @@
+"""
+预加载执行服务：在一个常驻进程中预先导入常用的大型库，每个文件 fork 一个子进程执行脚本。
+子进程与服务进程以写时复制的方式共享已导入的模块，启动时不必再次导入。
+只在支持 fork 的系统上可用，其他系统直接启动新进程执行。
+"""
+import json
+import locale
+import os
+import subprocess
+import tempfile
+import threading
+from os import unlink
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+from core.cancel import CancelToken
+from core.execute import (execute_python_script, ScriptResult, PYTHON_EXECUTABLE,
+                          CANCELLED_RETURN_CODE)
+from utils.general import log, Path
+
+FORK_AVAILABLE = hasattr(os, "fork")
+PRELOAD_TIMEOUT = 60.0  # 等待服务进程导入预加载模块的最长时间（秒）
+SERVER_DIED_RETURN_CODE = 1  # 服务进程意外退出时，未完成任务的返回值
+
+# 服务进程的程序。从 stdin 逐行读取 JSON 请求，向 stdout 逐行写入 JSON 事件：
+#   {"run": 任务编号, "script": 脚本路径, "args": [...], "env": {...}, "stdout": 路径, "stderr": 路径}
+#   {"kill": 任务编号}
+# 事件：{"ready": [成功导入的模块]}、{"exit": 任务编号, "code": 返回值}
+# stdin 关闭时结束所有子进程并退出
+SERVER_SCRIPT = r"""
+import importlib, json, os, select, signal, sys, traceback
+
+def run_child(request, wakeup_fds):
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for fd in wakeup_fds:
+        os.close(fd)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    for fd, path in ((1, request["stdout"]), (2, request["stderr"])):
+        target = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.dup2(target, fd)
+        os.close(target)
+    os.environ.update(request["env"])
+    script = request["script"]
+    sys.argv = [script] + request["args"]
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    import runpy
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def main():
+    loaded = []
+    for name in json.loads(sys.argv[1]):
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            pass
+
+    def send(message):
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    send({"ready": loaded})
+
+    jobs = {}  # 进程号 -> 任务编号
+    buffer = b""
+    while True:
+        readable, _, _ = select.select([0, wakeup_r], [], [])
+        if wakeup_r in readable:
+            try:
+                os.read(wakeup_r, 4096)
+            except BlockingIOError:
+                pass
+        while jobs:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            send({"exit": jobs.pop(pid), "code": code})
+        if 0 not in readable:
+            continue
+        data = os.read(0, 65536)
+        if not data:
+            for pid in jobs:
+                os.kill(pid, signal.SIGKILL)
+            return 0
+        buffer += data
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            request = json.loads(line)
+            if "kill" in request:
+                for pid, job in jobs.items():
+                    if job == request["kill"]:
+                        os.kill(pid, signal.SIGKILL)
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                return run_child(request, (wakeup_r, wakeup_w))
+            jobs[pid] = request["run"]
+
+sys.exit(main())
+"""
+
+
+class ForkJob:
+    """一个等待完成的任务"""
+    done: threading.Event
+    return_code: Optional[int]
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.return_code = None
+
+
+class ForkServer:
+    """
+    一个预加载了指定模块的服务进程。
+    可以在多个线程中同时调用 execute；服务进程无法使用时退回到直接启动新进程。
+    """
+    preload: Tuple[str, ...]  # 要求预加载的模块
+    loaded: List[str]  # 实际导入成功的模块
+    process: subprocess.Popen
+    jobs: Dict[int, ForkJob]
+    next_id: int
+    lock: threading.Lock  # 保护 jobs、next_id 和对服务进程 stdin 的写入
+    ready: threading.Event  # 预加载已完成，或服务进程已退出
+    alive: bool
+    retiring: bool  # 已被新的服务进程取代，完成现有任务后关闭
+
+    def __init__(self, preload: Sequence[str]) -> None:
+        self.preload = tuple(preload)
+        self.loaded = []
+        self.jobs = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.alive = True
+        self.retiring = False
+        self.process = subprocess.Popen(
+            [PYTHON_EXECUTABLE, "-c", SERVER_SCRIPT, json.dumps(self.preload)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        threading.Thread(target=self.read_events, name="fork-server", daemon=True).start()
+
+    def read_events(self) -> None:
+        """在后台线程中读取服务进程的事件"""
+        assert self.process.stdout is not None
+        start = perf_counter()
+        for line in self.process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                log.warning(f"ForkServer: 无法解析事件：{line!r}")
+                continue
+            if "ready" in event:
+                self.loaded = list(event["ready"])
+                log.info(f"执行服务已启动，预加载 {', '.join(self.loaded) or '无'}，"
+                         f"耗时 {perf_counter() - start:.2f} 秒")
+                self.ready.set()
+            elif "exit" in event:
+                with self.lock:
+                    job = self.jobs.pop(event["exit"], None)
+                    if self.retiring and not self.jobs:
+                        self.close_stdin()
+                if job is not None:
+                    job.return_code = int(event["code"])
+                    job.done.set()
+
+        # 服务进程已退出，未完成的任务都视为失败
+        with self.lock:
+            self.alive = False
+            jobs, self.jobs = self.jobs, {}
+        self.ready.set()
+        for job in jobs.values():
+            job.done.set()
+        self.process.wait()
+        if jobs or not self.retiring:
+            log.warning(f"执行服务已退出，返回值 {self.process.returncode}")
+
+    def send(self, message: Dict) -> None:
+        """向服务进程发送请求，调用时需要持有 self.lock"""
+        assert self.process.stdin is not None
+        self.process.stdin.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+
+    def kill(self, job_id: int) -> None:
+        with self.lock:
+            if self.alive and job_id in self.jobs:
+                try:
+                    self.send({"kill": job_id})
+                except (OSError, ValueError):
+                    pass
+
+    def execute(self, script: str, args: str | List[str], token: Optional[CancelToken] = None,
+                env: Optional[Dict[str, str]] = None) -> ScriptResult:
+        """与 execute_python_script 相同，但在服务进程 fork 出的子进程中执行"""
+        if not self.ready.wait(PRELOAD_TIMEOUT):
+            log.warning("执行服务启动超时，改为直接启动进程")
+            self.alive = False
+            self.close()
+        if not self.alive or self.retiring:
+            return execute_python_script(script, args, token, env)
+        argv = [args] if isinstance(args, str) else list(args)
+
+        temp_files: List[Path] = []
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w",
+                                             encoding="utf-8") as tmp:
+                tmp.write(script)
+            temp_files.append(tmp.name)
+            for _ in range(2):  # stdout 和 stderr
+                with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as tmp_output:
+                    temp_files.append(tmp_output.name)
+            script_path, stdout_path, stderr_path = temp_files
+
+            job = ForkJob()
+            start = perf_counter()
+            submitted = False
+            with self.lock:
+                # 服务进程已退出，或已被替换、即将关闭 stdin，不能再提交任务
+                if self.alive and not self.retiring:
+                    job_id = self.next_id
+                    self.next_id += 1
+                    self.jobs[job_id] = job
+                    try:
+                        self.send({"run": job_id, "script": script_path, "args": argv,
+                                   "env": env or {}, "stdout": stdout_path,
+                                   "stderr": stderr_path})
+                        submitted = True
+                    except (OSError, ValueError) as e:  # stdin 已关闭
+                        del self.jobs[job_id]
+                        log.warning(f"无法向执行服务发送任务：{e}")
+            if not submitted:
+                # 在锁外执行，不阻塞其他任务的提交、结束事件和取消
+                return execute_python_script(script, args, token, env)
+            unregister = token.on_cancel(lambda: self.kill(job_id)) if token is not None \
+                else lambda: None
+            try:
+                job.done.wait()
+            finally:
+                unregister()
+            duration = perf_counter() - start
+
+            encoding = locale.getpreferredencoding(False)  # 与 text=True 的 Popen 相同
+            with open(stdout_path, "r", encoding=encoding, errors="replace") as f:
+                stdout = f.read()
+            with open(stderr_path, "r", encoding=encoding, errors="replace") as f:
+                stderr = f.read()
+        finally:
+            for temp_file in temp_files:
+                try:
+                    unlink(temp_file)
+                except OSError:
+                    pass
+
+        if token is not None and token.cancelled:
+            return ScriptResult(stdout, stderr + "\n脚本已被取消", CANCELLED_RETURN_CODE, duration)
+        if job.return_code is None:
+            return ScriptResult(stdout, stderr + "\n执行服务意外退出", SERVER_DIED_RETURN_CODE,
+                                duration)
+        return ScriptResult(stdout, stderr, job.return_code, duration)
+
+    def retire(self) -> None:
+        """不再接受新任务，现有任务完成后关闭服务进程"""
+        with self.lock:
+            self.retiring = True
+            if not self.jobs:
+                self.close_stdin()
+
+    def close(self) -> None:
+        """关闭 stdin，服务进程会结束所有子进程并退出"""
+        with self.lock:
+            self.retiring = True
+            self.close_stdin()
+
+    def close_stdin(self) -> None:
+        """调用时需要持有 self.lock"""
+        if self.process.stdin is not None and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+
+class ForkServerPool:
+    """
+    管理当前使用的服务进程。需要预加载的模块不在当前服务进程中时，
+    启动一个预加载两者并集的新服务进程，旧的服务进程完成现有任务后关闭。
+    """
+    server: Optional[ForkServer]
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.server = None
+        self.lock = threading.Lock()
+
+    def get(self, preload: Sequence[str]) -> Optional[ForkServer]:
+        """获取预加载了这些模块的服务进程；系统不支持 fork 或无法启动时返回 None"""
+        if not FORK_AVAILABLE or not preload:
+            return None
+        with self.lock:
+            server = self.server
+            if server is not None and server.alive and set(preload) <= set(server.preload):
+                return server
+            modules = set(preload)
+            if server is not None and server.alive:
+                modules |= set(server.preload)
+            try:
+                self.server = new_server = ForkServer(sorted(modules))
+            except OSError as e:
+                log.warning(f"无法启动执行服务：{e}")
+                return None
+        if server is not None:
+            server.retire()
+        return new_server
+
+    def close(self) -> None:
+        with self.lock:
+            server, self.server = self.server, None
+        if server is not None:
+            server.close()
+
+
+fork_servers = ForkServerPool()
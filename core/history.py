@@ -0,0 +1,226 @@
+"""
+命令和脚本的历史记录，保存在 SQLite 数据库中
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from time import time
+from typing import List, Optional, Tuple
+from core.execute import ScriptResult, ExecutionMode
+from utils.general import log, Path
+
+DEFAULT_HISTORY_PATH = os.path.expanduser("~/.smart_assistant/history.db")
+FTS_MIN_QUERY_LENGTH = 3  # trigram 分词要求查询至少 3 个字符
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    command TEXT NOT NULL,
+    files TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    script TEXT NOT NULL,
+    duration REAL NOT NULL,
+    mode TEXT NOT NULL DEFAULT 'per_file'
+);
+CREATE INDEX IF NOT EXISTS runs_prompt_hash ON runs(prompt_hash);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    file TEXT NOT NULL,
+    return_code INTEGER NOT NULL,
+    stdout TEXT NOT NULL,
+    stderr TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_run_id ON results(run_id);
+"""
+
+# 全文索引，通过触发器与 runs 表保持同步
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(
+    command, script, content='runs', content_rowid='id', tokenize='{tokenizer}');
+CREATE TRIGGER IF NOT EXISTS runs_fts_insert AFTER INSERT ON runs BEGIN
+    INSERT INTO runs_fts(rowid, command, script) VALUES (new.id, new.command, new.script);
+END;
+CREATE TRIGGER IF NOT EXISTS runs_fts_delete AFTER DELETE ON runs BEGIN
+    INSERT INTO runs_fts(runs_fts, rowid, command, script)
+    VALUES ('delete', old.id, old.command, old.script);
+END;
+"""
+
+
+def hash_text(text: str) -> str:
+    """计算文本的 SHA-256 摘要"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RunContext:
+    """生成脚本时的上下文，确认执行后与结果一同记录"""
+    command: str
+    model: str
+    prompt_hash: str
+    mode: ExecutionMode  # 脚本遵循的执行方式
+
+    def __init__(self, command: str, model: str, prompt_hash: str,
+                 mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        self.command = command
+        self.model = model
+        self.prompt_hash = prompt_hash
+        self.mode = mode
+
+
+class HistoryEntry:
+    """一次确认执行的记录"""
+    id: int
+    created_at: float
+    command: str
+    files: List[Path]
+    model: str
+    prompt_hash: str
+    script: str
+    duration: float  # 处理所有文件的总耗时（秒）
+    mode: ExecutionMode
+    results: List[Tuple[Path, ScriptResult]]  # 每个文件的执行结果，只在 get 时读取
+
+    def __init__(self, id: int, created_at: float, command: str, files: List[Path],
+                 model: str, prompt_hash: str, script: str, duration: float,
+                 mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        self.id = id
+        self.created_at = created_at
+        self.command = command
+        self.files = files
+        self.model = model
+        self.prompt_hash = prompt_hash
+        self.script = script
+        self.duration = duration
+        self.mode = mode
+        self.results = []
+
+
+class HistoryStore:
+    """
+    历史记录数据库。
+    命令和脚本建立了全文索引（FTS5），在十万条记录下查询依然很快。
+    """
+    db_path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock  # 连接会在多个线程中使用
+    has_fts: bool  # 当前 SQLite 是否支持 FTS5
+
+    def __init__(self, db_path: Path = DEFAULT_HISTORY_PATH) -> None:
+        self.db_path = db_path
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            self.migrate()
+            self.has_fts = self.create_fts()
+
+    def migrate(self) -> None:
+        """为旧版本的数据库补充新增的列"""
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(runs)")}
+        if "mode" not in columns:
+            self.connection.execute(
+                "ALTER TABLE runs ADD COLUMN mode TEXT NOT NULL DEFAULT 'per_file'")
+
+    def create_fts(self) -> bool:
+        """创建全文索引，优先使用支持中文的 trigram 分词"""
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                self.connection.executescript(FTS_SCHEMA.format(tokenizer=tokenizer))
+                return True
+            except sqlite3.OperationalError as e:
+                log.debug(f"HistoryStore: 无法使用 {tokenizer} 分词：{e}")
+        log.warning("当前 SQLite 不支持 FTS5，历史记录将使用普通查询")
+        return False
+
+    def record(self, command: str, files: List[Path], model: str, prompt_hash: str,
+               script: str, results: List[Tuple[Path, ScriptResult]], duration: float,
+               mode: ExecutionMode = ExecutionMode.PER_FILE) -> int:
+        """记录一次执行，返回记录编号"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (created_at, command, files, model, prompt_hash, script,"
+                " duration, mode) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time(), command, json.dumps(files, ensure_ascii=False), model,
+                 prompt_hash, script, duration, mode.value))
+            run_id = cursor.lastrowid
+            assert run_id is not None
+            self.connection.executemany(
+                "INSERT INTO results (run_id, file, return_code, stdout, stderr, duration)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, file, result.return_code, result.stdout, result.stderr, result.duration)
+                 for file, result in results])
+        return run_id
+
+    @staticmethod
+    def row_to_entry(row: tuple) -> HistoryEntry:
+        id, created_at, command, files, model, prompt_hash, script, duration, mode = row
+        try:
+            execution_mode = ExecutionMode(mode)
+        except ValueError:
+            execution_mode = ExecutionMode.PER_FILE
+        return HistoryEntry(id, created_at, command, json.loads(files),
+                            model, prompt_hash, script, duration, execution_mode)
+
+    def recent(self, limit: int = 50) -> List[HistoryEntry]:
+        """获取最近的记录（不包含每个文件的结果）"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self.row_to_entry(row) for row in rows]
+
+    def search(self, query: str, limit: int = 50) -> List[HistoryEntry]:
+        """在命令和脚本中搜索（不包含每个文件的结果）"""
+        query = query.strip()
+        if not query:
+            return self.recent(limit)
+        with self.lock:
+            if self.has_fts and len(query) >= FTS_MIN_QUERY_LENGTH:
+                phrase = '"' + query.replace('"', '""') + '"'  # 作为短语匹配，避免语法错误
+                rows = self.connection.execute(
+                    "SELECT runs.* FROM runs_fts JOIN runs ON runs.id = runs_fts.rowid"
+                    " WHERE runs_fts MATCH ? ORDER BY runs.id DESC LIMIT ?",
+                    (phrase, limit)).fetchall()
+            else:
+                pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                rows = self.connection.execute(
+                    "SELECT * FROM runs WHERE command LIKE ? ESCAPE '\\' OR script LIKE ? ESCAPE '\\'"
+                    " ORDER BY id DESC LIMIT ?",
+                    (pattern, pattern, limit)).fetchall()
+        return [self.row_to_entry(row) for row in rows]
+
+    def approved_runs(self, limit: int) -> List[HistoryEntry]:
+        """获取最近的、所有文件都执行成功的记录，按时间从旧到新排列"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM runs WHERE NOT EXISTS ("
+                "SELECT 1 FROM results WHERE results.run_id = runs.id AND return_code != 0)"
+                " ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self.row_to_entry(row) for row in reversed(rows)]
+
+    def get(self, run_id: int) -> Optional[HistoryEntry]:
+        """获取一条完整的记录"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+            if row is None:
+                return None
+            result_rows = self.connection.execute(
+                "SELECT file, return_code, stdout, stderr, duration FROM results"
+                " WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+        entry = self.row_to_entry(row)
+        entry.results = [(file, ScriptResult(stdout, stderr, return_code, duration))
+                         for file, return_code, stdout, stderr, duration in result_rows]
+        return entry
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
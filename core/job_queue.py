@@ -0,0 +1,140 @@
+"""
+持久化的任务队列：已确认的脚本在执行完成之前保存在数据库中，程序重新启动后可以继续
+"""
+import json
+import os
+import sqlite3
+import threading
+from enum import Enum
+from time import time
+from typing import List, Optional
+from core.execute import ExecutionMode
+from core.history import DEFAULT_HISTORY_PATH, RunContext
+from utils.general import log, Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    command TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    script TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+
+class JobStatus(Enum):
+    """任务在队列中的状态。执行结束（成功、失败或停止）的任务会从队列中删除"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    PAUSED = "paused"
+
+
+class Job:
+    """一个已确认、尚未执行完成的脚本"""
+    id: int
+    created_at: float
+    priority: int  # 越大越先执行
+    status: JobStatus
+    context: RunContext  # 命令、模型和执行方式
+    script: str
+    files: List[Path]
+
+    def __init__(self, id: int, created_at: float, priority: int, status: JobStatus,
+                 context: RunContext, script: str, files: List[Path]) -> None:
+        self.id = id
+        self.created_at = created_at
+        self.priority = priority
+        self.status = status
+        self.context = context
+        self.script = script
+        self.files = files
+
+
+class JobStore:
+    """
+    任务队列数据库，保存在历史记录数据库中。
+    只是尽力保存：数据库出错时记录日志，不影响任务本身的执行。
+    """
+    db_path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock
+
+    def __init__(self, db_path: Path = DEFAULT_HISTORY_PATH) -> None:
+        self.db_path = db_path
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def add(self, context: RunContext, script: str, files: List[Path],
+            priority: int = 0) -> Optional[int]:
+        """加入队列，返回任务编号；无法保存时返回 None"""
+        try:
+            with self.lock, self.connection:
+                cursor = self.connection.execute(
+                    "INSERT INTO jobs (created_at, priority, status, command, model, prompt_hash,"
+                    " mode, script, files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time(), priority, JobStatus.QUEUED.value, context.command, context.model,
+                     context.prompt_hash, context.mode.value, script,
+                     json.dumps(files, ensure_ascii=False)))
+                return cursor.lastrowid
+        except sqlite3.Error as e:
+            log.error(f"无法保存任务：{e}")
+            return None
+
+    def update(self, sql: str, parameters: tuple) -> None:
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(sql, parameters)
+        except sqlite3.Error as e:
+            log.error(f"无法更新任务队列：{e}")
+
+    def set_status(self, job_id: int, status: JobStatus) -> None:
+        self.update("UPDATE jobs SET status = ? WHERE id = ?", (status.value, job_id))
+
+    def set_priority(self, job_id: int, priority: int) -> None:
+        self.update("UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id))
+
+    def remove(self, job_id: int) -> None:
+        """任务已结束，从队列中删除（结果保存在历史记录中）"""
+        self.update("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def restore(self) -> List[Job]:
+        """
+        读取上次没有完成的任务，按优先级和加入顺序排列。
+        上次运行中的任务（程序退出或崩溃时被中断）重新排队；
+        配合执行日志，已经处理完的文件不会再次处理。
+        """
+        self.update("UPDATE jobs SET status = ? WHERE status = ?",
+                    (JobStatus.QUEUED.value, JobStatus.RUNNING.value))
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, created_at, priority, status, command, model, prompt_hash, mode,"
+                    " script, files FROM jobs ORDER BY priority DESC, id").fetchall()
+        except sqlite3.Error as e:
+            log.error(f"无法读取任务队列：{e}")
+            return []
+        jobs: List[Job] = []
+        for id, created_at, priority, status, command, model, prompt_hash, mode, script, files \
+                in rows:
+            try:
+                context = RunContext(command, model, prompt_hash, ExecutionMode(mode))
+                jobs.append(Job(id, created_at, priority, JobStatus(status), context, script,
+                                json.loads(files)))
+            except ValueError as e:
+                log.warning(f"忽略无法读取的任务 #{id}：{e}")
+        return jobs
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,229 @@
+"""
+执行日志：记录每个文件被某个脚本成功处理后的状态，重新运行时跳过没有变化的文件
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Dict, List, Optional, Tuple
+from core.history import DEFAULT_HISTORY_PATH
+from utils.general import log, Path
+
+HASH_BLOCK_SIZE = 1024 * 1024  # 计算文件摘要时每次读取的大小
+# 超过这个大小的文件不计算内容摘要（读取整个文件的时间会抵消跳过它节省的时间），
+# 只按大小和修改时间判断是否变化
+HASH_SIZE_LIMIT = 64 * 1024 * 1024
+OUTPUT_SUFFIX = "_out"  # 脚本输出文件的命名约定：原文件名_out.扩展名
+MTIME_TOLERANCE = 2.0  # 判断输出文件是否为本次生成时，允许的修改时间误差（秒，FAT 文件系统的精度为 2 秒）
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    script_hash TEXT NOT NULL,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    stdout TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (script_hash, file)
+);
+"""
+
+
+def hash_file(path: Path) -> str:
+    """计算文件内容的 SHA-256 摘要"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def output_path(file: Path) -> Path:
+    """按约定，脚本为输入文件生成的输出文件路径"""
+    base, ext = os.path.splitext(file)
+    return base + OUTPUT_SUFFIX + ext
+
+
+def find_outputs(file: Path, started_at: float) -> List[Path]:
+    """
+    started_at 之后生成或修改的、符合命名约定的输出文件：原文件名_out 加任意扩展名
+    （格式转换的脚本输出的扩展名可能与输入文件不同）
+    """
+    directory = os.path.dirname(os.path.abspath(file))
+    prefix = os.path.splitext(os.path.basename(file))[0] + OUTPUT_SUFFIX
+    since = int((started_at - MTIME_TOLERANCE) * 1e9)
+    outputs: List[Path] = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.name.startswith(prefix):
+                    continue
+                rest = entry.name[len(prefix):]
+                if rest and not rest.startswith("."):
+                    continue
+                try:
+                    if entry.is_file() and entry.stat().st_mtime_ns >= since:
+                        outputs.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        return []
+    return sorted(outputs)
+
+
+class FileState:
+    """文件的大小、修改时间和（按需计算的）内容摘要"""
+    path: Path
+    size: int
+    mtime_ns: int
+    _content_hash: Optional[str]
+
+    def __init__(self, path: Path, size: int, mtime_ns: int,
+                 content_hash: Optional[str] = None) -> None:
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self._content_hash = content_hash
+
+    @staticmethod
+    def of(path: Path) -> Optional["FileState"]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return FileState(path, stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            self._content_hash = hash_file(self.path)
+        return self._content_hash
+
+    def recorded_hash(self) -> str:
+        """记录到日志中的内容摘要；大文件不计算，记录为空字符串"""
+        return self.content_hash if self.size <= HASH_SIZE_LIMIT else ""
+
+    def matches(self, size: int, mtime_ns: int, content_hash: str) -> bool:
+        """
+        与记录的状态是否相同。大小和修改时间都相同时直接认为相同；
+        只有修改时间变化时（例如复制、解压），再比较内容摘要（没有记录摘要时认为已变化）。
+        """
+        if self.size != size:
+            return False
+        if self.mtime_ns == mtime_ns:
+            return True
+        if not content_hash:
+            return False
+        try:
+            return self.content_hash == content_hash
+        except OSError:
+            return False
+
+
+class JournalEntry:
+    """一个文件被成功处理的记录"""
+    file: Path
+    stdout: str  # 当时的程序输出，跳过时展示
+    outputs: List[Tuple[Path, int, int, str]]  # 输出文件的 (路径, 大小, 修改时间, 摘要或空字符串)
+
+    def __init__(self, file: Path, stdout: str,
+                 outputs: List[Tuple[Path, int, int, str]]) -> None:
+        self.file = file
+        self.stdout = stdout
+        self.outputs = outputs
+
+
+class RunJournal:
+    """
+    执行日志，保存在历史记录数据库中。
+    以 (脚本摘要, 输入文件) 为键，记录输入文件的大小、修改时间、内容摘要（仅限较小的文件）
+    和生成的输出文件。
+    每个文件处理成功后立即写入，因此中断的批量处理可以从中断的地方继续。
+    """
+    db_path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock
+
+    def __init__(self, db_path: Path = DEFAULT_HISTORY_PATH) -> None:
+        self.db_path = db_path
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    @staticmethod
+    def normalize(file: Path) -> Path:
+        return os.path.normcase(os.path.abspath(file))
+
+    def lookup(self, script_hash: str, files: List[Path]) -> Dict[Path, JournalEntry]:
+        """查找输入文件和输出文件都没有变化的记录，返回文件到记录的映射"""
+        keys = {self.normalize(file): file for file in files}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT file, size, mtime_ns, content_hash, outputs, stdout FROM journal"
+                " WHERE script_hash = ?", (script_hash,)).fetchall()
+        entries: Dict[Path, JournalEntry] = {}
+        for key, size, mtime_ns, content_hash, outputs_json, stdout in rows:
+            file = keys.get(key)
+            if file is None:
+                continue
+            state = FileState.of(file)
+            if state is None or not state.matches(size, mtime_ns, content_hash):
+                continue
+            outputs = [tuple(output) for output in json.loads(outputs_json)]
+            if all(self.output_intact(*output) for output in outputs):
+                entries[file] = JournalEntry(file, stdout, outputs)  # type: ignore
+        return entries
+
+    @staticmethod
+    def output_intact(path: Path, size: int, mtime_ns: int, content_hash: str) -> bool:
+        """输出文件是否仍然存在且没有被修改"""
+        state = FileState.of(path)
+        return state is not None and state.matches(size, mtime_ns, content_hash)
+
+    def record(self, script_hash: str, file: Path, stdout: str, started_at: float) -> None:
+        """
+        记录一个处理成功的文件。
+        started_at: 开始处理的时间，之后生成或修改的约定输出文件（扩展名不限）会一并记录
+        """
+        state = FileState.of(file)
+        if state is None:
+            return
+        outputs: List[Tuple[Path, int, int, str]] = []
+        for path in find_outputs(file, started_at):
+            out = FileState.of(path)
+            if out is None:
+                continue
+            try:
+                outputs.append((out.path, out.size, out.mtime_ns, out.recorded_hash()))
+            except OSError as e:
+                log.warning(f"无法读取输出文件 {out.path}：{e}")
+        try:
+            content_hash = state.recorded_hash()
+        except OSError as e:
+            log.warning(f"无法读取文件 {file}：{e}")
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO journal (script_hash, file, size, mtime_ns, content_hash,"
+                " outputs, stdout, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (script_hash, self.normalize(file), state.size, state.mtime_ns, content_hash,
+                 json.dumps(outputs, ensure_ascii=False), stdout, time()))
+
+    def forget(self, script_hash: str, file: Path) -> None:
+        """删除一个文件的记录（例如处理失败时）"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM journal WHERE script_hash = ? AND file = ?",
+                (script_hash, self.normalize(file)))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,137 @@
+"""
+map/reduce 模式：每个文件单独运行 map 得到部分结果，
+部分结果在 map 完成时立即交给一直运行的 reduce 进程，最后合并为一个输出文件。
+"""
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from os import unlink
+from time import perf_counter
+from typing import Callable, List, Optional
+from core.cancel import CancelToken
+from core.execute import ScriptResult, PYTHON_EXECUTABLE, CANCELLED_RETURN_CODE
+from utils.general import log, Path
+
+MAP_ARG = "map"  # 第一个命令行参数，表示 map 阶段
+REDUCE_ARG = "reduce"  # 第一个命令行参数，表示 reduce 阶段
+REDUCE_OUTPUT_NAME = "combined_out"  # 合并结果的文件名（不含扩展名，由脚本决定）
+
+
+def reduce_output_base(files: List[Path]) -> Path:
+    """合并结果的路径（不含扩展名），位于所有输入文件共同的上级文件夹"""
+    directories = [os.path.dirname(os.path.abspath(file)) for file in files]
+    try:
+        directory = os.path.commonpath(directories)
+    except ValueError:  # 不在同一个驱动器上
+        directory = directories[0]
+    return os.path.join(directory, REDUCE_OUTPUT_NAME)
+
+
+class Reducer:
+    """
+    运行中的 reduce 进程。
+    每个 map 完成后调用 accept，部分结果以 JSON 行的形式立即写入 reduce 进程的 stdin；
+    reduce 进程读取较慢时写入会阻塞，使 map 的速度不会超过合并的速度。
+    """
+    output_base: Path
+    process: subprocess.Popen
+    token: Optional[CancelToken]
+    script_path: Path
+    stdout: List[str]
+    stderr: List[str]
+    readers: List[threading.Thread]
+    lock: threading.Lock  # 保证每行完整地写入
+    fed: int  # 已经交给 reduce 的部分结果数量
+    broken: bool  # reduce 进程已经不再读取输入
+    start: float
+    unregister: Callable[[], None]
+
+    def __init__(self, script: str, output_base: Path, token: Optional[CancelToken] = None) -> None:
+        self.output_base = output_base
+        self.token = token
+        self.stdout = []
+        self.stderr = []
+        self.lock = threading.Lock()
+        self.fed = 0
+        self.broken = False
+        with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w",
+                                         encoding="utf-8") as tmp:
+            tmp.write(script)
+        self.script_path = tmp.name
+        self.start = perf_counter()
+        self.process = subprocess.Popen(
+            [PYTHON_EXECUTABLE, self.script_path, REDUCE_ARG, output_base],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, encoding="utf-8", errors="replace",
+            env={**os.environ, "PYTHONIOENCODING": "utf-8"})
+        self.unregister = token.on_cancel(self.process.kill) if token is not None else lambda: None
+        # 持续读取输出，避免 reduce 进程因为输出管道写满而停止读取输入
+        self.readers = [
+            threading.Thread(target=self.read, args=(self.process.stdout, self.stdout),
+                             name="reduce-stdout", daemon=True),
+            threading.Thread(target=self.read, args=(self.process.stderr, self.stderr),
+                             name="reduce-stderr", daemon=True),
+        ]
+        for reader in self.readers:
+            reader.start()
+
+    @staticmethod
+    def read(stream, chunks: List[str]) -> None:
+        for line in stream:
+            chunks.append(line)
+
+    def accept(self, file: Path, result: ScriptResult) -> None:
+        """
+        交给 reduce 一个文件的 map 结果。部分结果为 stdout 的最后一行 JSON；
+        格式不正确时把这个文件的结果改为失败。
+        """
+        if result.return_code != 0:
+            return
+        lines = result.stdout.strip().splitlines()
+        try:
+            partial = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            result.return_code = 1
+            result.stderr = (result.stderr + "\n没有在 stdout 的最后一行输出 JSON 格式的部分结果").strip()
+            return
+        line = json.dumps({"file": file, "result": partial}, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.broken:
+                return
+            assert self.process.stdin is not None
+            try:
+                self.process.stdin.write(line)
+                self.process.stdin.flush()
+                self.fed += 1
+            except (BrokenPipeError, OSError, ValueError):
+                self.broken = True
+                log.warning("reduce 进程已不再读取部分结果")
+
+    def finish(self) -> ScriptResult:
+        """所有部分结果都已交给 reduce，等待它写出合并结果"""
+        with self.lock:
+            try:
+                assert self.process.stdin is not None
+                self.process.stdin.close()
+            except OSError:
+                pass
+        self.process.wait()
+        for reader in self.readers:
+            reader.join()
+        self.unregister()
+        try:
+            unlink(self.script_path)
+        except OSError:
+            pass
+        stdout, stderr = "".join(self.stdout), "".join(self.stderr)
+        duration = perf_counter() - self.start
+        if self.token is not None and self.token.cancelled:
+            return ScriptResult(stdout, stderr + "\n脚本已被取消", CANCELLED_RETURN_CODE, duration)
+        return ScriptResult(stdout, stderr, self.process.returncode, duration)
+
+    def abort(self) -> None:
+        """放弃合并（例如 map 失败或被取消），结束 reduce 进程"""
+        self.process.kill()
+        self.finish()
@@ -0,0 +1,137 @@
+"""
+管道模式：多个脚本依次连接，前一个阶段的 stdout 通过操作系统管道直接作为下一个阶段的 stdin，
+各阶段同时运行，不产生中间文件。
+"""
+import locale
+import os
+import subprocess
+import tempfile
+import threading
+from os import unlink
+from time import perf_counter
+from typing import List, Optional, Tuple
+from core.cancel import CancelToken
+from core.execute import ScriptResult, PYTHON_EXECUTABLE, CANCELLED_RETURN_CODE
+from core.journal import output_path
+from utils.general import Path
+
+# 多个阶段的脚本保存为一段文本时，各阶段之间的分隔行（Python 注释，不影响每个阶段的脚本）
+STAGE_SEPARATOR = "# ==== smart-assistant pipeline stage ===="
+
+
+def split_stages(script: str) -> List[str]:
+    """把保存的管道脚本拆分为各个阶段"""
+    stages: List[List[str]] = [[]]
+    for line in script.splitlines(keepends=True):
+        if line.rstrip("\r\n") == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(line)
+    return ["".join(stage) for stage in stages]
+
+
+def join_stages(scripts: List[str]) -> str:
+    """把各阶段的脚本合并为一段文本，可以用 split_stages 还原"""
+    return f"\n{STAGE_SEPARATOR}\n".join(script.rstrip("\n") for script in scripts) + "\n"
+
+
+class StageResult:
+    """一个阶段的执行结果"""
+    return_code: int
+    stderr: str
+    duration: float  # 从启动到结束的时间（秒）
+
+    def __init__(self, return_code: int, stderr: str, duration: float) -> None:
+        self.return_code = return_code
+        self.stderr = stderr
+        self.duration = duration
+
+
+def execute_pipeline(scripts: List[str], file: Path, token: Optional[CancelToken] = None
+                     ) -> Tuple[ScriptResult, List[StageResult]]:
+    """
+    以管道方式处理一个文件：输入文件作为第一个阶段的 stdin，最后一个阶段的 stdout
+    在全部阶段成功后保存为 原文件名_out.扩展名。每个阶段的参数 sys.argv[1] 为输入文件路径。
+    管道缓冲区写满时上游阶段会阻塞，因此内存占用不随文件大小增长。
+    返回整体结果和每个阶段的结果。
+    """
+    out = output_path(file)
+    temp_files: List[Path] = []
+    processes: List[subprocess.Popen] = []
+    start = perf_counter()
+    try:
+        for script in scripts:
+            with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w",
+                                             encoding="utf-8") as tmp:
+                tmp.write(script)
+            temp_files.append(tmp.name)
+        fd, merged = tempfile.mkstemp(prefix=f".{os.path.basename(out)}.", suffix=".tmp",
+                                      dir=os.path.dirname(os.path.abspath(out)))
+        temp_files.append(merged)
+
+        with open(file, "rb") as source, os.fdopen(fd, "wb") as sink:
+            stdin = source
+            for index, script_path in enumerate(temp_files[:len(scripts)]):
+                last = index == len(scripts) - 1
+                process = subprocess.Popen(
+                    [PYTHON_EXECUTABLE, script_path, file], stdin=stdin,
+                    stdout=sink if last else subprocess.PIPE, stderr=subprocess.PIPE)
+                if stdin is not source:
+                    stdin.close()  # 只由下一个阶段持有管道的读取端，上游才能在下游退出时得到 EPIPE
+                stdin = process.stdout
+                processes.append(process)
+        unregister = token.on_cancel(lambda: [process.kill() for process in processes]) \
+            if token is not None else lambda: None
+
+        # 每个阶段单独等待，记录各自的结束时间
+        stage_results: List[Optional[StageResult]] = [None] * len(processes)
+        encoding = locale.getpreferredencoding(False)
+
+        def wait(index: int) -> None:
+            process = processes[index]
+            assert process.stderr is not None
+            stderr = process.stderr.read().decode(encoding, errors="replace")
+            process.wait()
+            stage_results[index] = StageResult(process.returncode, stderr, perf_counter() - start)
+
+        waiters = [threading.Thread(target=wait, args=(index,), name=f"stage-{index}", daemon=True)
+                   for index in range(len(processes))]
+        try:
+            for waiter in waiters:
+                waiter.start()
+            for waiter in waiters:
+                waiter.join()
+        finally:
+            unregister()
+        stages = [result for result in stage_results if result is not None]
+        duration = perf_counter() - start
+
+        stderr = "\n".join(f"[第 {index + 1} 阶段] {stage.stderr.strip()}"
+                           for index, stage in enumerate(stages) if stage.stderr.strip())
+        if token is not None and token.cancelled:
+            return ScriptResult("", stderr + "\n脚本已被取消", CANCELLED_RETURN_CODE, duration), stages
+        # 下游失败时上游通常因为管道关闭而失败，下游则会读到提前结束的输入；
+        # 因此最后一个失败的阶段通常是出错的原因
+        failed = [index for index, stage in enumerate(stages) if stage.return_code != 0]
+        if failed:
+            index = failed[-1]
+            return ScriptResult("", f"第 {index + 1} 阶段失败，返回值 {stages[index].return_code}\n"
+                                + stderr, stages[index].return_code, duration), stages
+        os.replace(merged, out)
+        return ScriptResult(f"输出已写入 {out}", stderr, 0, duration), stages
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        for temp_file in temp_files:
+            try:
+                unlink(temp_file)
+            except OSError:
+                pass
+
+
+def format_timings(stages: List[StageResult]) -> str:
+    """各阶段的耗时，例如：第 1 阶段 0.52 秒，第 2 阶段 0.60 秒"""
+    return "，".join(f"第 {index + 1} 阶段 {stage.duration:.2f} 秒"
+                    for index, stage in enumerate(stages))
@@ -0,0 +1,228 @@
+"""
+执行前的静态检查：在启动任何进程之前发现脚本中明显的问题
+"""
+import ast
+import json
+import os
+import subprocess
+import threading
+from time import monotonic
+from typing import Dict, List, Optional, Set, Tuple
+from core.execute import PYTHON_EXECUTABLE
+from utils.general import log, Path
+
+LARGE_INPUT_SIZE = 256 * 1024 * 1024  # 超过这个大小的输入文件，一次性读入整个文件可能耗尽内存
+MISSING_CACHE_SECONDS = 60.0  # 不可用的模块缓存多久，期间用户可能安装了它
+IMPORT_CHECK_TIMEOUT = 10.0
+
+# 这些调用会把整个文件读入内存
+WHOLE_FILE_READS = {"read", "readlines", "read_text", "read_bytes", "read_csv", "read_excel", "load"}
+STREAMING_KEYWORDS = {"chunksize", "iterator", "nrows"}  # 带有这些参数时只读取一部分
+
+# 在执行环境中检查模块是否可以导入（只查找，不真正导入）
+FIND_SPEC_SCRIPT = """
+import importlib.util, json, sys
+result = {}
+for name in json.loads(sys.stdin.read()):
+    try:
+        result[name] = importlib.util.find_spec(name) is not None
+    except Exception:
+        result[name] = False
+print(json.dumps(result))
+"""
+
+
+class PreflightReport:
+    """检查结果。errors 中的问题会使脚本无法运行，warnings 只是提示"""
+    errors: List[str]
+    warnings: List[str]
+    imports: Set[str]  # 脚本导入的顶层模块
+
+    def __init__(self) -> None:
+        self.errors = []
+        self.warnings = []
+        self.imports = set()
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def merge(self, other: "PreflightReport", prefix: str = "") -> None:
+        """合并另一个脚本（例如管道的另一个阶段）的检查结果"""
+        self.errors += [prefix + error for error in other.errors]
+        self.warnings += [prefix + warning for warning in other.warnings]
+        self.imports |= other.imports
+
+    def text(self) -> str:
+        lines = [f"[错误] {error}" for error in self.errors]
+        lines += [f"[警告] {warning}" for warning in self.warnings]
+        return "\n".join(lines)
+
+
+class ModuleAvailability:
+    """
+    执行脚本的解释器中各个模块是否可用，带缓存。
+    可用的模块一直缓存；不可用的模块只缓存一段时间，以便用户安装后能够发现。
+    """
+    interpreter: str
+    available: Dict[str, bool]
+    checked_at: Dict[str, float]
+    lock: threading.Lock
+
+    def __init__(self, interpreter: str = PYTHON_EXECUTABLE) -> None:
+        self.interpreter = interpreter
+        self.available = {}
+        self.checked_at = {}
+        self.lock = threading.Lock()
+
+    def check(self, names: Set[str]) -> Dict[str, bool]:
+        """检查一组模块是否可用，未缓存的模块在一个子进程中一起检查"""
+        now = monotonic()
+        with self.lock:
+            unknown = [name for name in names
+                       if name not in self.available
+                       or (not self.available[name]
+                           and now - self.checked_at[name] > MISSING_CACHE_SECONDS)]
+        if unknown:
+            found = self.query(unknown)
+            with self.lock:
+                for name in unknown:
+                    if name in found:
+                        self.available[name] = found[name]
+                        self.checked_at[name] = now
+        with self.lock:
+            return {name: self.available.get(name, True) for name in names}
+
+    def query(self, names: List[str]) -> Dict[str, bool]:
+        """在执行环境中查找模块；无法检查时返回空字典（视为可用）"""
+        try:
+            process = subprocess.run(
+                [self.interpreter, "-c", FIND_SPEC_SCRIPT], input=json.dumps(names),
+                capture_output=True, text=True, timeout=IMPORT_CHECK_TIMEOUT)
+            return {str(name): bool(found) for name, found in json.loads(process.stdout).items()}
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            log.warning(f"无法检查脚本依赖的模块：{e}")
+            return {}
+
+
+module_availability = ModuleAvailability()
+
+
+def catches_import_error(node: ast.Try) -> bool:
+    """try 语句是否会捕获导入失败"""
+    for handler in node.handlers:
+        if handler.type is None:
+            return True
+        types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+        if any(isinstance(t, ast.Name) and t.id in ("ImportError", "ModuleNotFoundError", "Exception",
+                                                     "BaseException") for t in types):
+            return True
+    return False
+
+
+def collect_imports(tree: ast.Module) -> Dict[str, Tuple[int, bool]]:
+    """收集导入的顶层模块：模块名到 (首次出现的行号, 是否有导入失败的处理)"""
+    imports: Dict[str, Tuple[int, bool]] = {}
+
+    def add(name: str, lineno: int, guarded: bool) -> None:
+        top = name.split(".")[0]
+        if top not in imports or (imports[top][1] and not guarded):
+            imports[top] = (lineno, guarded)
+
+    def visit(node: ast.AST, guarded: bool) -> None:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                add(alias.name, node.lineno, guarded)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 0 and node.module:  # 忽略相对导入
+                add(node.module, node.lineno, guarded)
+        elif isinstance(node, ast.Try) and catches_import_error(node):
+            for child in node.body:
+                visit(child, True)
+            for child in node.handlers + node.orelse + node.finalbody:
+                visit(child, guarded)
+            return
+        for child in ast.iter_child_nodes(node):
+            visit(child, guarded)
+
+    visit(tree, False)
+    return imports
+
+
+def has_main_guard(tree: ast.Module) -> bool:
+    """是否存在顶层的 if __name__ == '__main__' 块"""
+    for node in tree.body:
+        if not isinstance(node, ast.If) or not isinstance(node.test, ast.Compare):
+            continue
+        test = node.test
+        if len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+            continue
+        sides = [test.left, test.comparators[0]]
+        if (any(isinstance(side, ast.Name) and side.id == "__name__" for side in sides)
+                and any(isinstance(side, ast.Constant) and side.value == "__main__"
+                        for side in sides)):
+            return True
+    return False
+
+
+def find_whole_file_reads(tree: ast.Module) -> List[int]:
+    """查找一次性读取整个文件的调用，返回行号"""
+    lines: List[int] = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in WHOLE_FILE_READS):
+            # read(n)、read_csv(chunksize=...) 只读取一部分，不算
+            if node.func.attr == "read" and (node.args or node.keywords):
+                continue
+            if any(keyword.arg in STREAMING_KEYWORDS for keyword in node.keywords):
+                continue
+            lines.append(node.lineno)
+    return sorted(set(lines))
+
+
+def largest_file(files: List[Path]) -> Tuple[Optional[Path], int]:
+    largest: Optional[Path] = None
+    largest_size = -1
+    for file in files:
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            continue
+        if size > largest_size:
+            largest, largest_size = file, size
+    return largest, largest_size
+
+
+def preflight(script: str, files: List[Path],
+              availability: Optional[ModuleAvailability] = None) -> PreflightReport:
+    """在执行前检查脚本：语法、依赖的模块、程序入口，以及对大文件的整体读取"""
+    report = PreflightReport()
+    try:
+        tree = ast.parse(script)
+    except SyntaxError as e:
+        report.errors.append(f"第 {e.lineno} 行存在语法错误：{e.msg}")
+        return report
+
+    imports = collect_imports(tree)
+    report.imports = set(imports)
+    available = (availability or module_availability).check(set(imports))
+    for name, (lineno, guarded) in sorted(imports.items(), key=lambda item: item[1][0]):
+        if available.get(name, True):
+            continue
+        if guarded:
+            report.warnings.append(f"第 {lineno} 行导入的模块 {name} 在执行环境中不存在（已处理导入失败）")
+        else:
+            report.errors.append(f"第 {lineno} 行导入的模块 {name} 在执行环境中不存在，"
+                                 "请改用标准库或其他已安装的库")
+
+    if not has_main_guard(tree):
+        report.warnings.append("脚本缺少 if __name__ == '__main__' 程序入口")
+
+    if files and (reads := find_whole_file_reads(tree)):
+        file, size = largest_file(files)
+        if file is not None and size >= LARGE_INPUT_SIZE:
+            line_text = "、".join(str(line) for line in reads[:5])
+            report.warnings.append(
+                f"第 {line_text} 行一次性读取整个文件，而输入文件 {file} 有 "
+                f"{size / 1024 / 1024:.0f} MB，可能耗尽内存，建议逐行或分块读取")
+    return report
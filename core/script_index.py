@@ -0,0 +1,150 @@
+"""
+根据命令和文件的相似度，查找可以直接复用的已确认脚本
+"""
+import math
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Set, Iterable
+from core.execute import ExecutionMode
+from utils.general import Path
+
+NGRAM_SIZES = (2, 3)  # 使用的字符 n-gram 长度
+COMMAND_WEIGHT = 0.8  # 命令相似度所占的权重，其余为文件特征
+MAX_INDEXED_SCRIPTS = 5000  # 最多索引的脚本数量
+
+
+def char_ngrams(text: str) -> Counter:
+    """提取文本的字符 n-gram 计数（忽略大小写和多余空白）"""
+    text = " ".join(text.lower().split())
+    grams: Counter = Counter()
+    for size in NGRAM_SIZES:
+        for i in range(len(text) - size + 1):
+            grams[text[i:i + size]] += 1
+    return grams
+
+
+def file_fingerprint(files: Iterable[Path]) -> Set[str]:
+    """文件特征：出现过的扩展名"""
+    return {os.path.splitext(file)[1].lower() or "<none>" for file in files}
+
+
+class ScriptMatch:
+    """查询到的可复用脚本"""
+    run_id: int
+    command: str
+    script: str
+    score: float  # 0~1 之间的相似度
+    mode: ExecutionMode
+
+    def __init__(self, run_id: int, command: str, script: str, score: float,
+                 mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        self.run_id = run_id
+        self.command = command
+        self.script = script
+        self.score = score
+        self.mode = mode
+
+
+class IndexedScript:
+    run_id: int
+    command: str
+    script: str
+    grams: Counter  # 命令的 n-gram 计数
+    fingerprint: Set[str]
+    mode: ExecutionMode  # 脚本遵循的执行方式，只能在相同的方式下复用
+    norm: float  # 按当前 IDF 计算的向量长度，文档集合变化后需要重新计算
+
+    def __init__(self, run_id: int, command: str, script: str, files: List[Path],
+                 mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        self.run_id = run_id
+        self.command = command
+        self.script = script
+        self.mode = mode
+        self.grams = char_ngrams(command)
+        self.fingerprint = file_fingerprint(files)
+        self.norm = 0.0
+
+
+class ScriptIndex:
+    """
+    命令的字符 n-gram TF-IDF 索引。
+    通过倒排表只比较有共同 n-gram 的脚本，相同的脚本只保留最新的一条。
+    """
+    scripts: Dict[int, IndexedScript]  # 记录编号到脚本
+    by_script: Dict[str, int]  # 脚本内容到记录编号，用于去重
+    postings: Dict[str, Set[int]]  # n-gram 到包含它的记录编号
+    norms_dirty: bool
+
+    def __init__(self) -> None:
+        self.scripts = {}
+        self.by_script = {}
+        self.postings = {}
+        self.norms_dirty = False
+
+    def __len__(self) -> int:
+        return len(self.scripts)
+
+    def idf(self, gram: str) -> float:
+        return math.log((1 + len(self.scripts)) / (1 + len(self.postings.get(gram, ())))) + 1
+
+    def add(self, run_id: int, command: str, script: str, files: List[Path],
+            mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        """加入一个已确认的脚本；相同脚本的旧记录会被替换"""
+        if (old_id := self.by_script.get(script)) is not None:
+            self.remove(old_id)
+        entry = IndexedScript(run_id, command, script, files, mode)
+        self.scripts[run_id] = entry
+        self.by_script[script] = run_id
+        for gram in entry.grams:
+            self.postings.setdefault(gram, set()).add(run_id)
+        self.norms_dirty = True
+
+    def remove(self, run_id: int) -> None:
+        entry = self.scripts.pop(run_id, None)
+        if entry is None:
+            return
+        self.by_script.pop(entry.script, None)
+        for gram in entry.grams:
+            if (ids := self.postings.get(gram)) is not None:
+                ids.discard(run_id)
+                if not ids:
+                    del self.postings[gram]
+        self.norms_dirty = True
+
+    def update_norms(self) -> None:
+        for entry in self.scripts.values():
+            entry.norm = math.sqrt(sum(
+                (count * self.idf(gram)) ** 2 for gram, count in entry.grams.items()))
+        self.norms_dirty = False
+
+    def query(self, command: str, files: List[Path],
+              mode: ExecutionMode = ExecutionMode.PER_FILE) -> Optional[ScriptMatch]:
+        """查找与命令和文件最相似、且执行方式相同的脚本"""
+        grams = char_ngrams(command)
+        if not grams or not self.scripts:
+            return None
+        if self.norms_dirty:
+            self.update_norms()
+
+        query_weights = {gram: count * self.idf(gram) for gram, count in grams.items()}
+        query_norm = math.sqrt(sum(weight ** 2 for weight in query_weights.values()))
+        dots: Dict[int, float] = {}
+        for gram, weight in query_weights.items():
+            for run_id in self.postings.get(gram, ()):
+                entry = self.scripts[run_id]
+                dots[run_id] = dots.get(run_id, 0.0) + \
+                    weight * entry.grams[gram] * self.idf(gram)
+
+        fingerprint = file_fingerprint(files)
+        best: Optional[ScriptMatch] = None
+        for run_id, dot in dots.items():
+            entry = self.scripts[run_id]
+            if entry.mode != mode:
+                continue
+            text_score = dot / (query_norm * entry.norm) if entry.norm else 0.0
+            union = fingerprint | entry.fingerprint
+            file_score = len(fingerprint & entry.fingerprint) / len(union) if union else 1.0
+            score = COMMAND_WEIGHT * text_score + (1 - COMMAND_WEIGHT) * file_score
+            if best is None or score > best.score:
+                best = ScriptMatch(run_id, entry.command, entry.script, score, entry.mode)
+        return best
@@ -0,0 +1,76 @@
+"""
+选中文件的集合
+"""
+from typing import Dict, List, Optional, Iterable, Iterator
+from utils.general import Path
+
+
+class FileSelection:
+    """
+    按加入顺序保存选中的文件，查找、添加和删除均为 O(1)。
+    需要按下标访问时，会在修改后第一次访问时重建一次列表快照。
+    """
+    _files: Dict[Path, None]  # dict 保持插入顺序，作为有序集合使用
+    _snapshot: Optional[List[Path]]  # 按下标访问时使用的列表，修改后失效
+
+    def __init__(self, files: Iterable[Path] = ()) -> None:
+        self._files = dict.fromkeys(files)
+        self._snapshot = None
+
+    def __contains__(self, file_path: object) -> bool:
+        return file_path in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __bool__(self) -> bool:
+        return bool(self._files)
+
+    def __iter__(self) -> Iterator[Path]:
+        return iter(self.to_list())
+
+    def __getitem__(self, index: int) -> Path:
+        return self.to_list()[index]
+
+    def to_list(self) -> List[Path]:
+        """获取当前所有文件的列表（不应修改返回值）"""
+        if self._snapshot is None:
+            self._snapshot = list(self._files)
+        return self._snapshot
+
+    def add(self, file_path: Path) -> bool:
+        """添加文件，返回是否为新文件"""
+        return bool(self.add_many([file_path]))
+
+    def add_many(self, file_paths: Iterable[Path]) -> List[Path]:
+        """批量添加文件，返回实际新增的文件"""
+        added: List[Path] = []
+        for file_path in file_paths:
+            if file_path not in self._files:
+                self._files[file_path] = None
+                added.append(file_path)
+        if added:
+            self._snapshot = None
+        return added
+
+    def remove(self, file_path: Path) -> bool:
+        """删除文件，返回文件是否存在"""
+        return bool(self.remove_many([file_path]))
+
+    def remove_many(self, file_paths: Iterable[Path]) -> List[Path]:
+        """批量删除文件，返回实际删除的文件"""
+        removed: List[Path] = []
+        for file_path in file_paths:
+            if file_path in self._files:
+                del self._files[file_path]
+                removed.append(file_path)
+        if removed:
+            self._snapshot = None
+        return removed
+
+    def clear(self) -> List[Path]:
+        """清空所有文件，返回被删除的文件"""
+        removed = self.to_list()
+        self._files = {}
+        self._snapshot = None
+        return removed
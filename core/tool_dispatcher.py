@@ -0,0 +1,93 @@
+"""
+并行执行模型在一次回复中返回的多个工具调用
+"""
+from __future__ import annotations
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, TYPE_CHECKING
+from utils.general import log
+
+if TYPE_CHECKING:
+    from core.ai_client import AITool
+
+MAX_PARALLEL_TOOL_CALLS = 8  # 同时执行的工具调用数量上限
+
+
+class ToolCallRequest:
+    """模型请求的一次工具调用"""
+    id: str
+    name: str
+    arguments: str  # JSON 形式的参数
+
+    def __init__(self, id: str, name: str, arguments: str) -> None:
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为 assistant 消息中的 tool_calls 项"""
+        return {
+            "id": self.id,
+            "type": "function",
+            "function": {"name": self.name, "arguments": self.arguments},
+        }
+
+
+class ToolResult:
+    """一次工具调用的结果"""
+    call_id: str
+    name: str
+    content: str  # 返回给模型的内容
+    error: Optional[str]  # 调用失败时的错误信息
+
+    def __init__(self, call_id: str, name: str, content: str = "",
+                 error: Optional[str] = None) -> None:
+        self.call_id = call_id
+        self.name = name
+        self.content = content
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_message(self) -> Dict[str, Any]:
+        """转换为返回给模型的 tool 消息"""
+        content = self.content if self.ok else f"Error: {self.error}"
+        return {"role": "tool", "tool_call_id": self.call_id, "content": content}
+
+
+class ToolDispatcher:
+    """
+    在线程池中并行执行互不依赖的工具调用。
+    每个工具可以通过 AITool.max_concurrency 限制自身的并发数量。
+    """
+    tools: Dict[str, AITool]
+    limits: Dict[str, threading.Semaphore]  # 每个工具的并发限制
+
+    def __init__(self, tools: Dict[str, AITool]) -> None:
+        self.tools = tools
+        self.limits = {name: threading.BoundedSemaphore(max(1, tool.max_concurrency))
+                       for name, tool in tools.items()}
+
+    def run_one(self, request: ToolCallRequest) -> ToolResult:
+        """执行单个工具调用，错误会记录在结果中而不是抛出"""
+        tool = self.tools.get(request.name)
+        if tool is None:
+            log.error(f"ToolDispatcher: 未知的工具 {request.name}")
+            return ToolResult(request.id, request.name, error=f"Unknown tool: {request.name}")
+        with self.limits[request.name]:
+            try:
+                content = tool.call(request.arguments)
+            except Exception as e:
+                log.error(f"ToolDispatcher: 工具 {request.name} 调用失败：{e}")
+                return ToolResult(request.id, request.name, error=f"{type(e).__name__}: {e}")
+        return ToolResult(request.id, request.name, content or "")
+
+    def dispatch(self, requests: List[ToolCallRequest]) -> List[ToolResult]:
+        """执行所有工具调用，按请求的顺序返回结果"""
+        if len(requests) <= 1:
+            return [self.run_one(request) for request in requests]
+        workers = min(len(requests), MAX_PARALLEL_TOOL_CALLS)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tool") as executor:
+            return list(executor.map(self.run_one, requests))
@@ -9,6 +9,7 @@ from ui.tray import TrayIcon
 from utils.windows import set_app_id
 from utils.general import log
 from ui.font import DefaultFont
+from core.fork_server import fork_servers
 
 APP_NAME = "智能助手"
 APP_TITLE = "智能助手"
@@ -32,7 +33,8 @@ def main():
     app.setFont(DefaultFont())
 
     # 创建主窗口
-    window = MainWindow(Assistant())
+    assistant = Assistant()
+    window = MainWindow(assistant)
     window.show()
 
     # 创建托盘图标
@@ -41,6 +43,9 @@ def main():
 
     # 接管退出事件
     tray.quit_signal.connect(app.quit)
+    app.aboutToQuit.connect(assistant.config.flush)  # 退出前写入未保存的配置
+    app.aboutToQuit.connect(window.task_manager.shutdown)  # 结束运行中的脚本，任务留在队列中
+    app.aboutToQuit.connect(fork_servers.close)  # 结束预加载模块的执行服务
 
     # 开始运行
     exit(app.exec_())
@@ -0,0 +1,202 @@
+"""
+监视文件夹：新文件写入完成后，自动使用已确认的脚本处理
+"""
+import os
+from collections import deque
+from time import time
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+from core.history import RunContext
+from core.journal import OUTPUT_SUFFIX
+from core.map_reduce import REDUCE_OUTPUT_NAME
+from ui.task_manager import TaskManager, CommandTask, TaskStatus
+from utils.general import log, Path
+
+DEBOUNCE_MS = 1000  # 文件夹发生变化后，等待多久没有新的变化再扫描
+STABLE_CHECK_MS = 1000  # 检查新文件是否已写入完成的间隔
+STABLE_CHECKS = 2  # 连续多少次检查大小和修改时间都没有变化，认为文件已写入完成
+MAX_BATCH_FILES = 50  # 每个批次最多包含的文件数量
+MAX_FAILED_BATCHES_KEPT = 5  # 保留最近几个失败批次的命令和标签页，供查看错误
+THROUGHPUT_WINDOW = 600.0  # 计算处理速度的时间窗口（秒）
+MIN_THROUGHPUT_WINDOW = 60.0  # 刚开始监视时，至少按这么长的时间计算，避免速度虚高
+# 下载或复制过程中的临时文件
+TEMPORARY_SUFFIXES = (".tmp", ".part", ".crdownload", ".download", ".partial")
+
+
+def is_ignored(name: str) -> bool:
+    """不需要处理的文件：隐藏文件、临时文件，以及脚本自己生成的输出文件"""
+    if name.startswith((".", "~$")) or name.lower().endswith(TEMPORARY_SUFFIXES):
+        return True
+    stem = os.path.splitext(name)[0]
+    return stem.endswith(OUTPUT_SUFFIX) or stem == REDUCE_OUTPUT_NAME
+
+
+class FolderWatcher(QObject):
+    """
+    监视一个文件夹（不包括子文件夹）。开始监视之后新出现的文件，
+    在大小和修改时间稳定后分批交给 TaskManager，以已确认的脚本并行处理。
+    """
+    stats_changed = pyqtSignal()
+
+    directory: Path
+    script: str
+    run_context: RunContext
+    task_manager: TaskManager
+    watcher: QFileSystemWatcher
+    debounce_timer: QTimer
+    stability_timer: QTimer
+    seen: Set[Path]  # 已经存在或已经分派的文件
+    candidates: Dict[Path, Tuple[int, int, int]]  # 等待写入完成的文件：(大小, 修改时间, 稳定次数)
+    running: Dict[int, int]  # 正在处理的批次：命令编号 -> 文件数量
+    processed: int  # 已处理的文件数量
+    failed_batches: int
+    completions: Deque[Tuple[float, int]]  # 最近完成的批次：(完成时间, 文件数量)
+    failed_tasks: Deque[CommandTask]  # 保留的失败批次
+    started_at: float
+    active: bool
+
+    def __init__(self, directory: Path, script: str, run_context: RunContext,
+                 task_manager: TaskManager) -> None:
+        super().__init__()
+        self.directory = os.path.abspath(directory)
+        self.script = script
+        self.run_context = run_context
+        self.task_manager = task_manager
+        self.seen = set(self.list_files() or [])
+        self.candidates = {}
+        self.running = {}
+        self.processed = 0
+        self.failed_batches = 0
+        self.completions = deque()
+        self.failed_tasks = deque()
+        self.started_at = time()
+        self.active = True
+
+        self.debounce_timer = QTimer()
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(DEBOUNCE_MS)
+        self.debounce_timer.timeout.connect(self.scan)
+        self.stability_timer = QTimer()
+        self.stability_timer.setInterval(STABLE_CHECK_MS)
+        self.stability_timer.timeout.connect(self.check_stability)
+
+        self.watcher = QFileSystemWatcher([self.directory])
+        self.watcher.directoryChanged.connect(lambda _: self.debounce_timer.start())
+        log.info(f"开始监视文件夹 {self.directory}，忽略已有的 {len(self.seen)} 个文件")
+
+    def list_files(self) -> Optional[List[Path]]:
+        """文件夹中需要处理的文件，无法读取时返回 None"""
+        try:
+            with os.scandir(self.directory) as it:
+                return [entry.path for entry in it
+                        if not is_ignored(entry.name) and entry.is_file()]
+        except OSError as e:
+            log.warning(f"无法读取监视的文件夹 {self.directory}：{e}")
+            return None
+
+    def scan(self) -> None:
+        """查找新出现的文件，开始检查它们是否已写入完成"""
+        if not self.active:
+            return
+        if not os.path.isdir(self.directory):
+            log.warning(f"监视的文件夹 {self.directory} 已不存在，停止监视")
+            self.stop()
+            return
+        files = self.list_files()
+        if files is None:
+            return
+        # 已经移走的文件不再记录，之后以同样的名字再次出现时作为新文件处理
+        self.seen &= set(files)
+        for file in files:
+            if file not in self.seen and file not in self.candidates:
+                self.candidates[file] = (-1, -1, 0)
+        if self.candidates and not self.stability_timer.isActive():
+            self.stability_timer.start()
+        self.stats_changed.emit()
+
+    def check_stability(self) -> None:
+        """大小和修改时间连续几次没有变化的文件视为已写入完成，分批处理"""
+        ready: List[Path] = []
+        for file, (size, mtime_ns, count) in list(self.candidates.items()):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                del self.candidates[file]  # 已被删除或重命名，重命名后的文件会被重新发现
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                count += 1
+            else:
+                count = 0
+            if count >= STABLE_CHECKS:
+                del self.candidates[file]
+                ready.append(file)
+            else:
+                self.candidates[file] = (stat.st_size, stat.st_mtime_ns, count)
+        if not self.candidates:
+            self.stability_timer.stop()
+        ready.sort()
+        for start in range(0, len(ready), MAX_BATCH_FILES):
+            self.dispatch(ready[start:start + MAX_BATCH_FILES])
+        self.stats_changed.emit()
+
+    def dispatch(self, files: List[Path]) -> None:
+        """把一批文件交给 TaskManager，排队等待并行名额"""
+        self.seen.update(files)
+        task = self.task_manager.create_task(
+            f"[监视] {self.run_context.command}", files, None, self.run_context, background=True)
+        self.running[task.id] = len(files)
+        task.status_changed.connect(lambda: self.on_task_status_changed(task))
+        task.output(f"监视文件夹 {self.directory} 中出现了 {len(files)} 个新文件，使用已确认的脚本处理：\n")
+        task.set_pending_script(self.script)
+        task.confirm()
+
+    def on_task_status_changed(self, task: CommandTask) -> None:
+        """
+        批次结束后移除它的命令和标签页，长时间监视时不会越积越多；
+        失败的批次只保留最近几个。
+        """
+        if not task.finished or task.id not in self.running:
+            return
+        count = self.running.pop(task.id)
+        if task.status == TaskStatus.DONE:
+            self.processed += count
+            self.completions.append((time(), count))
+            self.task_manager.remove_task(task)
+        else:
+            self.failed_batches += 1
+            self.failed_tasks.append(task)
+            while len(self.failed_tasks) > MAX_FAILED_BATCHES_KEPT:
+                self.task_manager.remove_task(self.failed_tasks.popleft())
+        self.stats_changed.emit()
+
+    @property
+    def queue_depth(self) -> int:
+        """等待写入完成和正在处理的文件数量"""
+        return len(self.candidates) + sum(self.running.values())
+
+    def throughput(self) -> float:
+        """最近一段时间内每分钟处理的文件数量"""
+        now = time()
+        while self.completions and now - self.completions[0][0] > THROUGHPUT_WINDOW:
+            self.completions.popleft()
+        window = min(THROUGHPUT_WINDOW, max(now - self.started_at, MIN_THROUGHPUT_WINDOW))
+        return sum(count for _, count in self.completions) * 60 / window
+
+    def summary(self) -> str:
+        text = (f"{os.path.basename(self.directory) or self.directory}：队列 {self.queue_depth} 个，"
+                f"已处理 {self.processed} 个，{self.throughput():.1f} 个/分钟")
+        if self.failed_batches:
+            text += f"，{self.failed_batches} 批失败"
+        return text
+
+    def stop(self) -> None:
+        """停止监视；已经分派的批次继续执行"""
+        if not self.active:
+            return
+        self.active = False
+        self.debounce_timer.stop()
+        self.stability_timer.stop()
+        self.watcher.removePaths(self.watcher.directories())
+        self.candidates.clear()
+        log.info(f"停止监视文件夹 {self.directory}")
+        self.stats_changed.emit()
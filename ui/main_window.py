@@ -1,75 +1,38 @@
 """
 UI 主窗口
 """
+import os
 import threading
-from typing import Optional
-from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QTextEdit, QLabel, QPushButton
+from typing import Optional, List, Dict
+from PyQt5.QtWidgets import (
+    QMainWindow, QWidget, QVBoxLayout, QTextEdit, QLabel, QPushButton, QLineEdit, QTabWidget,
+    QFileDialog)
 from PyQt5.QtGui import QIcon, QCloseEvent
-from PyQt5.QtCore import QThread, pyqtSignal, Qt, QObject
-from core.ai_client import ChatContent
+from PyQt5.QtCore import pyqtSignal, Qt, QObject, QTimer
 from core.assistant import Assistant
+from core.config_watcher import ConfigWatcher
+from core.history import RunContext, hash_text
+from core.conversation import Conversation
+from core.execute import ExecutionMode
+from core.pipeline import join_stages
 from utils.general import set_default, Path, log
 from utils.icon import get_icon
 from ui.widgets.file_drop_area import FileDropArea
 from ui.widgets.output_area import OutputArea
 from ui.widgets.model_selector import ModelSelector
+from ui.widgets.mode_selector import ModeSelector
 from ui.widgets.control_buttons import ControlButtons
+from ui.widgets.job_buttons import JobButtons
+from ui.widgets.history_dialog import HistoryDialog
+from ui.task_manager import TaskManager, CommandTask, TaskStatus
+from ui.folder_watcher import FolderWatcher
 from ui.stylesheet import STYLESHEET
 from utils.keyboard import Hotkey
 
 WINDOW_TITLE = "智能助手"
 MIN_WINDOW_SIZE = (600, 500)
 ICON_NAME = "assistant_icon"
-
-
-class AITaskThread(QThread):
-    """在另外的线程等待 AI 回应"""
-
-    finished_signal = pyqtSignal()
-    receive_text_signal = pyqtSignal(str)
-    confirm_script_signal = pyqtSignal(str)
-
-    is_thinking: bool
-
-    assistant: Assistant
-    prompt: str
-
-    def __init__(self, assistant: Assistant, prompt: str) -> None:
-        super().__init__()
-        self.assistant = assistant
-        self.prompt = prompt
-        self.is_thinking = False
-
-    def add_content(self, content: ChatContent) -> None:
-        log.debug(f"on_run_clicked::Context::add_content: {content.text}")
-        if content.type == ChatContent.Type.REASONING:
-            if not self.is_thinking:
-                self.receive_text_signal.emit("<think>")
-                self.is_thinking = True
-            self.receive_text_signal.emit(content.text)
-        elif content.type == ChatContent.Type.CONTENT:
-            if self.is_thinking:
-                self.receive_text_signal.emit("</think>")
-                self.is_thinking = False
-            self.receive_text_signal.emit(content.text)
-        else:
-            self.receive_text_signal.emit(content.text)
-
-    def confirm_script(self, script: str) -> None:
-        log.info(f"正在执行脚本: {script}")
-        self.confirm_script_signal.emit(script)
-
-    def run(self) -> None:
-        self.assistant.command_signals.confirm_script.connect(
-            self.confirm_script)
-        self.assistant.command_signals.receive_content.connect(
-            self.add_content)
-        self.assistant.execute_command(self.prompt)
-        self.receive_text_signal.emit("\n命令执行完毕。\n")
-        self.finished.emit()
-
-    def cancel(self) -> None:
-        self.assistant.command_signals.running_lock = False
+WATCH_STATS_INTERVAL_MS = 5000  # 刷新监视文件夹统计信息的间隔
 
 
 class MainWindow(QMainWindow):
@@ -83,16 +46,25 @@ class MainWindow(QMainWindow):
     main_widget: QWidget
 
     pin_button: QPushButton
+    history_button: QPushButton
+    file_filter_input: QLineEdit
     file_drop_area: FileDropArea
     model_selector: ModelSelector
+    mode_selector: ModeSelector
     control_buttons: ControlButtons
-    output_area: OutputArea
-
-    ai_task_thread: Optional[AITaskThread] = None  # 等待 AI 回应的线程
+    job_buttons: JobButtons  # 暂停、继续已确认的脚本，调整优先级
+    task_tabs: QTabWidget  # 每条命令一个输出区
+    config_watcher: ConfigWatcher
+
+    task_manager: TaskManager  # 同时进行的多条命令
+    task_outputs: Dict[int, OutputArea]  # 命令编号到输出区
+    folder_watchers: List[FolderWatcher]  # 正在监视的文件夹
+    watch_timer: QTimer  # 定时刷新监视文件夹的统计信息（处理速度随时间变化）
     hotkey: Hotkey
 
     class Signals(QObject):
         toggle_pin_signal = pyqtSignal()
+        watch_stats_signal = pyqtSignal(str)  # 监视文件夹的统计信息，没有监视时为空字符串
     signals: Signals
 
     def __init__(self, assis: Optional[Assistant] = None) -> None:
@@ -102,6 +74,9 @@ class MainWindow(QMainWindow):
         assis = set_default(assis, Assistant())
         self.assistant = assis
         self.signals = MainWindow.Signals()
+        self.task_manager = TaskManager(self.assistant, self.assistant.config.max_parallel_tasks)
+        self.task_outputs = {}
+        self.folder_watchers = []
 
         # 初始化窗体
         super().__init__()
@@ -132,18 +107,28 @@ class MainWindow(QMainWindow):
         self.tool_bar.addWidget(self.pin_button)
         self.after_pin()
 
+        # 历史记录按钮
+        self.history_button = QPushButton("历史")
+        self.history_button.clicked.connect(self.open_history_dialog)
+        self.tool_bar.addWidget(self.history_button)
+
         # 文件拖放区
-        self.file_drop_area = FileDropArea()
+        self.file_filter_input = QLineEdit()
+        self.file_filter_input.setPlaceholderText("按文件名筛选")
+        self.main_layout.addWidget(self.file_filter_input)
+        config = self.assistant.config
+        self.file_drop_area = FileDropArea(
+            self.assistant.selected_files,  # 与逻辑处理器共享同一个文件集合
+            config.scan_include, config.scan_exclude, config.scan_max_depth)
         self.main_layout.addWidget(self.file_drop_area)
         self.setAcceptDrops(True )
-        def on_add_file(file_path: Path):  # 添加文件时进行相关处理
-            log.debug(f"on_add_file: {file_path}")
-            self.assistant.selected_files.append(file_path)
-        def on_remove_file(file_path: Path):  # 删除文件
-            log.debug(f"on_remove_file: {file_path}")
-            self.assistant.selected_files.remove(file_path)
-        self.file_drop_area.add_file_signal.connect(on_add_file)
-        self.file_drop_area.remove_file_signal.connect(on_remove_file)
+        def on_add_files(file_paths: List[Path]):  # 添加文件时进行相关处理
+            log.debug(f"on_add_files: 添加了 {len(file_paths)} 个文件")
+        def on_remove_files(file_paths: List[Path]):  # 删除文件
+            log.debug(f"on_remove_files: 删除了 {len(file_paths)} 个文件")
+        self.file_drop_area.add_files_signal.connect(on_add_files)
+        self.file_drop_area.remove_files_signal.connect(on_remove_files)
+        self.file_filter_input.textChanged.connect(self.file_drop_area.set_filter)
 
         # 命令输入区
         self.main_layout.addWidget(QLabel("指令："))
@@ -154,8 +139,18 @@ class MainWindow(QMainWindow):
         # 模型选择区
         self.model_selector = ModelSelector(self, self.assistant)
         self.main_layout.addLayout(self.model_selector)
-        self.model_selector.update_model_list(
-            [x.name for x in self.assistant.get_models()])
+        self.model_selector.refresh_model_list()
+
+        # 执行方式选择区
+        self.mode_selector = ModeSelector(self.assistant.config)
+        self.main_layout.addLayout(self.mode_selector)
+
+        # 配置文件在外部修改时，自动重新读取
+        self.config_watcher = ConfigWatcher(self.assistant.config)
+        self.config_watcher.config_changed.connect(self.model_selector.refresh_model_list)
+        self.config_watcher.config_changed.connect(self.mode_selector.refresh)
+        self.config_watcher.config_changed.connect(
+            lambda: self.task_manager.set_max_parallel(self.assistant.config.max_parallel_tasks))
 
         # 控制按钮
         self.control_buttons = ControlButtons()
@@ -165,11 +160,28 @@ class MainWindow(QMainWindow):
         self.control_buttons.confirm_script_signal.connect(self.confirm_script)
         self.control_buttons.deny_script_signal.connect(self.deny_script)
         self.main_layout.addLayout(self.control_buttons)
-
-        # 输出区
+        self.job_buttons = JobButtons()
+        self.job_buttons.pause_signal.connect(self.pause_job)
+        self.job_buttons.resume_signal.connect(self.resume_job)
+        self.job_buttons.raise_signal.connect(lambda: self.change_job_priority(1))
+        self.job_buttons.lower_signal.connect(lambda: self.change_job_priority(-1))
+        self.main_layout.addLayout(self.job_buttons)
+
+        # 输出区，每条命令一个标签页
         self.main_layout.addWidget(QLabel("输出："))
-        self.output_area = OutputArea()
-        self.main_layout.addWidget(self.output_area)
+        self.task_tabs = QTabWidget()
+        self.task_tabs.setTabsClosable(True)
+        self.task_tabs.tabCloseRequested.connect(self.close_task_tab)
+        self.task_tabs.currentChanged.connect(lambda _: self.update_control_buttons())
+        self.main_layout.addWidget(self.task_tabs)
+        self.task_manager.task_added.connect(self.add_task_tab)
+        self.task_manager.task_removed.connect(self.remove_task_tab)
+        self.task_manager.counts_changed.connect(self.show_task_counts)
+        self.restore_jobs()
+
+        self.watch_timer = QTimer()
+        self.watch_timer.setInterval(WATCH_STATS_INTERVAL_MS)
+        self.watch_timer.timeout.connect(self.emit_watch_stats)
 
         # 设置快捷键
         self.hotkey = Hotkey("<ctrl>+<alt>+<space>")
@@ -184,51 +196,205 @@ class MainWindow(QMainWindow):
             self.show()
 
     def execute_command(self) -> None:
-        """开始执行用户命令"""
+        """开始执行用户命令。已有命令在运行时，新命令会并行执行或排队"""
         log.debug(f"execute_command")
-        self.output_area.append_text("开始执行用户命令。\n")
         command = self.command_input.toPlainText()
+        files = self.assistant.selected_files.to_list()
         models = self.assistant.get_models()
         current_model = models[self.model_selector.get_selected_index()]
-        prompt = self.assistant.build_prompt(
-            command, self.assistant.selected_files, current_model.supports_functions)
-
-        # 创建新的进程
-        self.ai_task_thread = AITaskThread(self.assistant, prompt)
-
-        def on_finished() -> None:
-            self.ai_task_thread = None
+        mode = self.mode_selector.get_selected_mode()
+        system = self.assistant.build_system_prompt(current_model.supports_functions, mode)
+        prompt = self.assistant.build_prompt(command, files)
+        context = RunContext(command, current_model.name, hash_text(system + prompt), mode)
+        task = self.task_manager.create_task(
+            command, files, Conversation(prompt, system), context)
+        task.output("开始执行用户命令。\n")
+        task.generate()
+
+    def add_task_tab(self, task: CommandTask) -> None:
+        """为新的命令创建输出区"""
+        output_area = OutputArea()
+        self.task_outputs[task.id] = output_area
+        task.output_signal.connect(output_area.append_text)
+        task.status_changed.connect(lambda: self.on_task_status_changed(task))
+        index = self.task_tabs.addTab(output_area, self.task_title(task))
+        self.task_tabs.setTabToolTip(index, task.command)
+        if not task.background:
+            self.task_tabs.setCurrentIndex(index)
+
+    def task_title(self, task: CommandTask) -> str:
+        command = task.command.strip().replace("\n", " ")
+        if len(command) > 12:
+            command = command[:12] + "…"
+        if task.priority:
+            return f"#{task.id} {command}（{task.status.value}，优先级 {task.priority:+d}）"
+        return f"#{task.id} {command}（{task.status.value}）"
+
+    def task_at(self, index: int) -> Optional[CommandTask]:
+        """标签页对应的命令"""
+        widget = self.task_tabs.widget(index)
+        for task_id, output_area in self.task_outputs.items():
+            if output_area is widget:
+                return self.task_manager.tasks.get(task_id)
+        return None
+
+    def current_task(self) -> Optional[CommandTask]:
+        return self.task_at(self.task_tabs.currentIndex())
+
+    def on_task_status_changed(self, task: CommandTask) -> None:
+        output_area = self.task_outputs.get(task.id)
+        if output_area is None:
+            return
+        index = self.task_tabs.indexOf(output_area)
+        if index >= 0:
+            self.task_tabs.setTabText(index, self.task_title(task))
+        if task.status == TaskStatus.CONFIRMING and task is not self.current_task():
+            self.statusBar().showMessage(f"命令 #{task.id} 的脚本等待确认", 3000)
+        self.update_control_buttons()
+
+    def show_task_counts(self, running: int, queued: int) -> None:
+        self.statusBar().showMessage(
+            f"正在运行 {running} 条命令（最多 {self.task_manager.max_parallel} 条），"
+            f"排队 {queued} 个")
+
+    def update_control_buttons(self) -> None:
+        """按当前标签页的命令切换控制按钮的模式"""
+        task = self.current_task()
+        if task is not None and task.status == TaskStatus.CONFIRMING and task.pending_script:
+            self.control_buttons.to_confirm_script_mode(task.pending_script)
+        else:
+            self.control_buttons.to_normal_mode()
+        has_job = task is not None and task.job_script is not None
+        self.job_buttons.set_state(
+            task is not None and task.can_pause,
+            has_job and task.status == TaskStatus.PAUSED,
+            has_job and task.status in (TaskStatus.QUEUED, TaskStatus.PAUSED))
+
+    def close_task_tab(self, index: int) -> None:
+        """关闭标签页，命令尚未结束时先停止"""
+        task = self.task_at(index)
+        if task is not None:
+            self.task_manager.remove_task(task)  # 通过 task_removed 关闭标签页
+            return
+        widget = self.task_tabs.widget(index)
+        self.task_tabs.removeTab(index)
+        if widget is not None:
+            widget.deleteLater()
+
+    def remove_task_tab(self, task: CommandTask) -> None:
+        """命令被移除（手动关闭或自动清理）后，关闭它的标签页"""
+        output_area = self.task_outputs.pop(task.id, None)
+        if output_area is None:
+            return
+        index = self.task_tabs.indexOf(output_area)
+        if index >= 0:
+            self.task_tabs.removeTab(index)
+        output_area.deleteLater()  # removeTab 不会删除页面，输出区的全部文本会一直占用内存
 
-        def on_receive_text(text: str) -> None:
-            self.output_area.append_text(text)
+    def stop_command(self) -> None:
+        """中断当前标签页的命令：立即停止等待模型和正在运行的脚本"""
+        if (task := self.current_task()) is not None:
+            task.cancel()
 
-        def on_confirm(script: str) -> None:
-            self.output_area.append_text("\n检测到 Python 脚本：\n")
-            self.output_area.append_text(script)
-            self.control_buttons.to_confirm_script_mode(script)
+    def pause_job(self) -> None:
+        """暂停当前标签页已确认的脚本"""
+        if (task := self.current_task()) is not None:
+            task.pause()
 
-        self.ai_task_thread.finished.connect(on_finished)
-        self.ai_task_thread.receive_text_signal.connect(on_receive_text)
-        self.ai_task_thread.confirm_script_signal.connect(
-            on_confirm)  # 切换到确认脚本模式
+    def resume_job(self) -> None:
+        if (task := self.current_task()) is not None:
+            task.resume()
 
-        self.ai_task_thread.start()
+    def change_job_priority(self, delta: int) -> None:
+        if (task := self.current_task()) is not None:
+            task.change_priority(delta)
 
-    def stop_command(self) -> None:
-        """中断用户命令"""
-        if self.ai_task_thread is not None:
-            self.ai_task_thread.cancel()
+    def restore_jobs(self) -> None:
+        """继续上次退出时没有完成的任务"""
+        tasks = self.task_manager.restore_jobs()
+        if tasks:
+            self.statusBar().showMessage(f"已恢复 {len(tasks)} 个上次没有完成的任务", 5000)
 
     def confirm_script(self, script: str) -> None:
-        """确认脚本"""
-        self.assistant.process_files(
-            script, self.assistant.selected_files, self.output_area.append_text)
-        self.control_buttons.to_normal_mode()
+        """确认当前标签页的脚本，在后台线程中执行"""
+        if (task := self.current_task()) is not None:
+            task.confirm()
+
+    def open_history_dialog(self) -> None:
+        """打开历史记录对话框"""
+        dialog = HistoryDialog(self, self.assistant.history)
+        dialog.rerun_signal.connect(self.rerun_history)
+        dialog.pipeline_signal.connect(self.run_pipeline)
+        dialog.watch_signal.connect(self.start_watch)
+        dialog.exec_()
+
+    def rerun_history(self, run_id: int) -> None:
+        """直接使用过去的脚本，跳过模型生成"""
+        entry = self.assistant.history.get(run_id)
+        if entry is None:
+            return
+        if not self.assistant.selected_files:  # 没有选中文件时，使用当时的文件
+            self.file_drop_area.add_files(
+                [file for file in entry.files if os.path.isfile(file)])
+        self.command_input.setPlainText(entry.command)
+        # 没有经过模型，无法自动重试
+        task = self.task_manager.create_task(
+            entry.command, self.assistant.selected_files.to_list(), None,
+            RunContext(entry.command, entry.model, entry.prompt_hash, entry.mode))
+        task.output(f"使用历史记录中的脚本（{entry.command}）：\n")
+        task.set_pending_script(entry.script)
+
+    def run_pipeline(self, run_ids: List[int]) -> None:
+        """把多个历史中的管道脚本按顺序串联，作为一个脚本等待确认"""
+        entries = [entry for run_id in run_ids
+                   if (entry := self.assistant.history.get(run_id)) is not None]
+        if len(entries) < 2:
+            return
+        if not self.assistant.selected_files:
+            self.file_drop_area.add_files(
+                [file for file in entries[0].files if os.path.isfile(file)])
+        command = " → ".join(entry.command.strip() for entry in entries)
+        task = self.task_manager.create_task(
+            command, self.assistant.selected_files.to_list(), None,
+            RunContext(command, entries[-1].model, hash_text(command), ExecutionMode.PIPELINE))
+        task.output(f"串联 {len(entries)} 个历史脚本：\n" + "\n".join(
+            f"{index}. {entry.command.strip()}" for index, entry in enumerate(entries, 1)) + "\n")
+        task.set_pending_script(join_stages([entry.script for entry in entries]))
+
+    def start_watch(self, run_id: int) -> None:
+        """选择一个文件夹，用历史记录中的脚本自动处理其中的新文件"""
+        entry = self.assistant.history.get(run_id)
+        if entry is None:
+            return
+        directory = QFileDialog.getExistingDirectory(self, "选择要监视的文件夹")
+        if not directory:
+            return
+        watcher = FolderWatcher(
+            directory, entry.script,
+            RunContext(entry.command, entry.model, entry.prompt_hash, entry.mode),
+            self.task_manager)
+        watcher.stats_changed.connect(self.emit_watch_stats)
+        self.folder_watchers.append(watcher)
+        self.watch_timer.start()
+        self.statusBar().showMessage(f"开始监视文件夹 {watcher.directory}", 3000)
+        self.emit_watch_stats()
+
+    def stop_watches(self) -> None:
+        """停止监视所有文件夹，已经开始的批次继续执行"""
+        for watcher in self.folder_watchers:
+            watcher.stop()
+        self.folder_watchers.clear()
+        self.watch_timer.stop()
+        self.emit_watch_stats()
+
+    def emit_watch_stats(self) -> None:
+        self.signals.watch_stats_signal.emit(
+            "\n".join(watcher.summary() for watcher in self.folder_watchers if watcher.active))
 
     def deny_script(self) -> None:
-        """拒绝脚本"""
-        self.output_area.append_text("未运行脚本")
-        self.control_buttons.to_normal_mode()
+        """拒绝当前标签页的脚本"""
+        if (task := self.current_task()) is not None:
+            task.deny()
 
     def toggle_pin(self) -> None:
         """切换置顶状态"""
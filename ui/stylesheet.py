@@ -11,7 +11,7 @@ STYLESHEET = """
     }
     
     /* 输入框样式 */
-    QTextEdit, QListWidget, QComboBox, QLineEdit {
+    QTextEdit, QListWidget, QListView, QComboBox, QLineEdit {
         background-color: white;
         border: 1px solid #ddd;
         border-radius: 4px;
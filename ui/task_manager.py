@@ -0,0 +1,555 @@
+"""
+管理多个同时进行的用户命令
+"""
+from enum import Enum
+from typing import Optional, List, Tuple, Callable, Dict
+from PyQt5.QtCore import QThread, QObject, pyqtSignal
+from core.ai_client import ChatContent
+from core.script_index import ScriptMatch
+from core.execute import find_syntax_error, ScriptResult, ExecutionMode
+from core.assistant import Assistant
+from core.history import RunContext
+from core.conversation import Conversation
+from core.cancel import CancelToken
+from core.job_queue import Job, JobStatus
+from utils.general import Path, log
+
+SHUTDOWN_WAIT_MS = 5000  # 程序退出时，等待每个线程结束的最长时间
+
+
+class AITaskThread(QThread):
+    """在另外的线程等待 AI 回应"""
+
+    receive_text_signal = pyqtSignal(str)
+    confirm_script_signal = pyqtSignal(str)
+    reuse_script_signal = pyqtSignal(ScriptMatch)
+
+    is_thinking: bool
+    script_chunks: List[str]  # 正在生成的脚本
+    reported_error_line: Optional[int]  # 已经提示过的语法错误所在行
+
+    assistant: Assistant
+    conversation: Conversation
+    command: str
+    files: List[Path]
+    allow_reuse: bool
+    mode: ExecutionMode
+    error: Optional[str]  # 请求失败时的错误信息
+    token: CancelToken  # 本次任务的取消标记
+    command_signals: Assistant.CommandSignals  # 本次任务专用的信号，避免与其他任务混在一起
+
+    def __init__(self, assistant: Assistant, conversation: Conversation, command: str,
+                 files: List[Path], allow_reuse: bool = True,
+                 mode: ExecutionMode = ExecutionMode.PER_FILE) -> None:
+        super().__init__()
+        self.assistant = assistant
+        self.conversation = conversation
+        self.command = command
+        self.files = files
+        self.allow_reuse = allow_reuse
+        self.mode = mode
+        self.error = None
+        self.token = CancelToken()
+        self.is_thinking = False
+        self.script_chunks = []
+        self.reported_error_line = None
+
+        # 接收信号的槽在 GUI 线程中执行，取消也发生在 GUI 线程，
+        # 因此取消之后到达的事件都会在这里被丢弃
+        self.command_signals = Assistant.CommandSignals()
+        self.command_signals.confirm_script.connect(self.confirm_script)
+        self.command_signals.receive_content.connect(self.add_content)
+        self.command_signals.reuse_script.connect(self.reuse_script)
+
+    def add_content(self, content: ChatContent) -> None:
+        if self.token.cancelled:
+            return
+        log.debug(f"on_run_clicked::Context::add_content: {content.text}")
+        if content.type == ChatContent.Type.REASONING:
+            if not self.is_thinking:
+                self.receive_text_signal.emit("<think>")
+                self.is_thinking = True
+            self.receive_text_signal.emit(content.text)
+        elif content.type == ChatContent.Type.CONTENT:
+            if self.is_thinking:
+                self.receive_text_signal.emit("</think>")
+                self.is_thinking = False
+            self.receive_text_signal.emit(content.text)
+        elif content.type == ChatContent.Type.TOOL_FIELD:
+            if not self.script_chunks:
+                self.receive_text_signal.emit("\n正在生成脚本：\n")
+            self.script_chunks.append(content.text)
+            self.receive_text_signal.emit(content.text)
+            if "\n" in content.text:  # 每生成完一行，检查一次语法
+                self.check_partial_script()
+        elif content.type == ChatContent.Type.TOOL_ARGUMENT:
+            pass  # 原始 JSON 参数不展示，脚本内容通过 TOOL_FIELD 展示
+        else:
+            self.receive_text_signal.emit(content.text)
+
+    def check_partial_script(self) -> None:
+        """检查正在生成的脚本中是否已经出现语法错误"""
+        self.script_chunks = ["".join(self.script_chunks)]
+        error = find_syntax_error(self.script_chunks[0], partial=True)
+        if error is not None and error.lineno != self.reported_error_line:
+            self.reported_error_line = error.lineno
+            self.receive_text_signal.emit(
+                f"\n[提示] 脚本第 {error.lineno} 行可能存在语法错误：{error.msg}\n")
+
+    def confirm_script(self, script: str) -> None:
+        if self.token.cancelled:
+            return
+        log.info(f"正在执行脚本: {script}")
+        self.confirm_script_signal.emit(script)
+
+    def reuse_script(self, match: ScriptMatch) -> None:
+        if not self.token.cancelled:
+            self.reuse_script_signal.emit(match)
+
+    def run(self) -> None:
+        try:
+            self.assistant.execute_command(
+                self.conversation, self.command, self.files, self.allow_reuse,
+                self.token, self.command_signals, self.mode)
+        except Exception as e:
+            log.error(f"AITaskThread: 命令执行失败：{e}")
+            self.error = str(e)
+            if not self.token.cancelled:
+                self.receive_text_signal.emit(f"\n请求失败：{e}\n")
+            return
+        if not self.token.cancelled:
+            self.receive_text_signal.emit("\n命令执行完毕。\n")
+
+    def cancel(self) -> None:
+        """立即取消：关闭网络连接，之后不会再发出任何信号"""
+        self.token.cancel()
+
+
+class ScriptTaskThread(QThread):
+    """在另外的线程执行已确认的脚本，避免阻塞界面"""
+
+    output_signal = pyqtSignal(str)
+    results_signal = pyqtSignal(list)  # 每个文件的执行结果，取消时不会发出
+
+    assistant: Assistant
+    script: str
+    files: List[Path]
+    context: RunContext
+    token: CancelToken
+
+    def __init__(self, assistant: Assistant, script: str, files: List[Path],
+                 context: RunContext) -> None:
+        super().__init__()
+        self.assistant = assistant
+        self.script = script
+        self.files = files
+        self.context = context
+        self.token = CancelToken()
+
+    def output(self, text: str) -> None:
+        if not self.token.cancelled:
+            self.output_signal.emit(text)
+
+    def run(self) -> None:
+        try:
+            results: List[Tuple[Path, ScriptResult]] = self.assistant.run_and_record(
+                self.script, self.files, self.context, self.output, self.token)
+        except Exception as e:
+            log.error(f"ScriptTaskThread: 脚本执行失败：{e}")
+            self.output(f"\n脚本执行失败：{e}\n")
+            return
+        if not self.token.cancelled:
+            self.results_signal.emit(results)
+
+    def cancel(self) -> None:
+        """立即取消：结束正在运行的脚本进程，不再处理剩余的文件"""
+        self.token.cancel()
+
+
+class TaskStatus(Enum):
+    """命令的状态"""
+    QUEUED = "排队中"
+    GENERATING = "生成中"
+    CONFIRMING = "待确认"
+    EXECUTING = "执行中"
+    PAUSED = "已暂停"
+    DONE = "已完成"
+    FAILED = "失败"
+    CANCELLED = "已停止"
+
+
+class CommandTask(QObject):
+    """
+    一条用户命令：与模型的对话、待确认的脚本和执行结果。
+    生成和执行脚本时占用 TaskManager 的一个并行名额，等待用户确认时不占用。
+    确认的脚本在执行完成之前保存在任务队列数据库中，可以暂停、继续和调整优先级。
+    """
+    output_signal = pyqtSignal(str)  # 输出到该命令的输出区
+    status_changed = pyqtSignal()
+
+    id: int
+    manager: "TaskManager"
+    command: str
+    files: List[Path]
+    conversation: Optional[Conversation]  # 直接使用历史脚本时为 None，无法自动重试
+    run_context: RunContext
+    status: TaskStatus
+    pending_script: Optional[str]  # 等待用户确认的脚本
+    reusing_script: bool  # 待确认的脚本是否为自动复用的历史脚本
+    ai_thread: Optional[AITaskThread]
+    script_thread: Optional[ScriptTaskThread]
+    background: bool  # 自动创建的命令（例如监视文件夹），不切换到它的标签页
+    priority: int  # 等待名额时，优先级高的先开始
+    job_id: Optional[int]  # 任务队列中的编号，脚本执行结束后删除
+    job_script: Optional[str]  # 已确认、尚未执行完成的脚本，暂停后继续时使用
+
+    def __init__(self, id: int, manager: "TaskManager", command: str, files: List[Path],
+                 conversation: Optional[Conversation], run_context: RunContext,
+                 background: bool = False) -> None:
+        super().__init__()
+        self.id = id
+        self.manager = manager
+        self.command = command
+        self.files = files
+        self.conversation = conversation
+        self.run_context = run_context
+        self.status = TaskStatus.QUEUED
+        self.pending_script = None
+        self.reusing_script = False
+        self.ai_thread = None
+        self.script_thread = None
+        self.background = background
+        self.priority = 0
+        self.job_id = None
+        self.job_script = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (TaskStatus.DONE, TaskStatus.FAILED, TaskStatus.CANCELLED)
+
+    def set_status(self, status: TaskStatus) -> None:
+        if status != self.status:
+            self.status = status
+            self.status_changed.emit()
+
+    def output(self, text: str) -> None:
+        self.output_signal.emit(text)
+
+    def generate(self, allow_reuse: bool = True) -> None:
+        """排队进行一轮对话"""
+        self.set_status(TaskStatus.QUEUED)
+        self.manager.request_slot(self, lambda: self.start_generation(allow_reuse))
+
+    def start_generation(self, allow_reuse: bool) -> None:
+        assert self.conversation is not None
+        self.set_status(TaskStatus.GENERATING)
+        thread = AITaskThread(self.manager.assistant, self.conversation,
+                              self.command, self.files, allow_reuse, self.run_context.mode)
+        self.ai_thread = thread
+
+        def on_confirm(script: str) -> None:
+            self.output("\n检测到 Python 脚本：\n")
+            self.output(script)
+            self.pending_script = script
+
+        def on_reuse(match: ScriptMatch) -> None:
+            self.output(
+                f"找到相似的已确认脚本（相似度 {match.score:.0%}，"
+                f"原命令：{match.command}），无需等待模型。\n"
+                "如需让模型重新生成，请点击「取消」。\n")
+            self.output(match.script)
+            self.pending_script = match.script
+            self.reusing_script = True
+
+        def on_finished() -> None:
+            self.manager.thread_finished(thread)
+            if thread.token.cancelled:
+                return
+            self.ai_thread = None
+            self.manager.release_slot(self)
+            if thread.error is not None:
+                self.set_status(TaskStatus.FAILED)
+            elif self.pending_script is not None:
+                self.set_status(TaskStatus.CONFIRMING)
+            else:
+                self.set_status(TaskStatus.DONE)
+
+        thread.receive_text_signal.connect(
+            lambda text: None if thread.token.cancelled else self.output(text))
+        thread.confirm_script_signal.connect(on_confirm)
+        thread.reuse_script_signal.connect(on_reuse)
+        thread.finished.connect(on_finished)
+        self.manager.thread_started(thread)
+        thread.start()
+
+    def set_pending_script(self, script: str) -> None:
+        """直接提交一个待确认的脚本（例如历史记录中的脚本）"""
+        self.output(script)
+        self.pending_script = script
+        self.set_status(TaskStatus.CONFIRMING)
+
+    def confirm(self) -> None:
+        """确认执行待确认的脚本，保存到任务队列后排队等待名额"""
+        script = self.pending_script
+        if script is None or self.status != TaskStatus.CONFIRMING:
+            return
+        self.pending_script = None
+        self.reusing_script = False
+        self.job_script = script
+        self.job_id = self.manager.assistant.jobs.add(
+            self.run_context, script, self.files, self.priority)
+        self.queue_script()
+
+    def restore_job(self, job: Job) -> None:
+        """恢复上次没有执行完成的任务"""
+        self.job_id = job.id
+        self.job_script = job.script
+        self.priority = job.priority
+        self.output(f"恢复上次没有完成的任务（{len(job.files)} 个文件），已处理且没有变化的文件会被跳过：\n")
+        self.output(job.script)
+        if job.status == JobStatus.PAUSED:
+            self.output("\n任务已暂停，点击「继续」开始执行。\n")
+            self.set_status(TaskStatus.PAUSED)
+        else:
+            self.queue_script()
+
+    def queue_script(self) -> None:
+        script = self.job_script
+        assert script is not None
+        self.set_status(TaskStatus.QUEUED)
+        self.manager.request_slot(self, lambda: self.start_script(script))
+
+    def finish_job(self) -> None:
+        """脚本执行结束（或被停止），从任务队列中删除"""
+        if self.job_id is not None:
+            self.manager.assistant.jobs.remove(self.job_id)
+        self.job_id = None
+        self.job_script = None
+
+    @property
+    def can_pause(self) -> bool:
+        return self.job_script is not None and self.status in (TaskStatus.QUEUED,
+                                                               TaskStatus.EXECUTING)
+
+    def pause(self) -> None:
+        """
+        暂停排队或执行中的脚本。正在运行的进程会被结束，
+        继续时已经处理完的文件通过执行日志跳过。
+        """
+        if not self.can_pause:
+            return
+        if self.script_thread is not None:
+            self.script_thread.cancel()
+            self.script_thread = None
+            self.output("\n已暂停，正在运行的文件会在继续后重新处理。\n")
+        self.manager.release_slot(self)
+        if self.job_id is not None:
+            self.manager.assistant.jobs.set_status(self.job_id, JobStatus.PAUSED)
+        self.set_status(TaskStatus.PAUSED)
+
+    def resume(self) -> None:
+        """继续暂停的任务"""
+        if self.status != TaskStatus.PAUSED or self.job_script is None:
+            return
+        if self.job_id is not None:
+            self.manager.assistant.jobs.set_status(self.job_id, JobStatus.QUEUED)
+        self.queue_script()
+
+    def change_priority(self, delta: int) -> None:
+        """调整优先级，影响在队列中等待名额的顺序"""
+        self.priority += delta
+        if self.job_id is not None:
+            self.manager.assistant.jobs.set_priority(self.job_id, self.priority)
+        self.manager.reorder_queue()
+        self.status_changed.emit()
+
+    def start_script(self, script: str) -> None:
+        self.set_status(TaskStatus.EXECUTING)
+        if self.job_id is not None:
+            self.manager.assistant.jobs.set_status(self.job_id, JobStatus.RUNNING)
+        thread = ScriptTaskThread(self.manager.assistant, script, self.files, self.run_context)
+        self.script_thread = thread
+
+        # 以下槽在 GUI 线程中执行，取消后到达的事件会被丢弃
+        def on_output(text: str) -> None:
+            if not thread.token.cancelled:
+                self.output(text)
+
+        def on_results(results: List[Tuple[Path, ScriptResult]]) -> None:
+            if not thread.token.cancelled:
+                self.on_script_finished(results)
+
+        def on_finished() -> None:
+            self.manager.thread_finished(thread)
+            if self.script_thread is not thread:
+                return  # 已经取消
+            self.script_thread = None
+            if self.status == TaskStatus.EXECUTING:  # 没有得到结果，脚本执行过程出错
+                self.finish_job()
+                self.manager.release_slot(self)
+                self.set_status(TaskStatus.FAILED)
+
+        thread.output_signal.connect(on_output)
+        thread.results_signal.connect(on_results)
+        thread.finished.connect(on_finished)
+        self.manager.thread_started(thread)
+        thread.start()
+
+    def on_script_finished(self, results: List[Tuple[Path, ScriptResult]]) -> None:
+        """脚本执行完毕。把执行结果交给模型；失败时在限定次数内自动让模型修正"""
+        self.finish_job()
+        self.manager.release_slot(self)
+        failed = any(result.return_code != 0 for _, result in results)
+        conversation = self.conversation
+        if conversation is not None:
+            failed = conversation.add_script_results(results)
+            if failed and conversation.start_retry():
+                self.output(
+                    f"\n脚本执行失败，正在请求模型修正（第 {conversation.retries}/"
+                    f"{conversation.max_retries} 次自动重试）。\n")
+                self.generate(allow_reuse=False)
+                return
+        self.set_status(TaskStatus.FAILED if failed else TaskStatus.DONE)
+
+    def deny(self) -> None:
+        """拒绝待确认的脚本"""
+        if self.pending_script is None or self.status != TaskStatus.CONFIRMING:
+            return
+        self.pending_script = None
+        self.output("未运行脚本\n")
+        if self.reusing_script:  # 拒绝了复用的脚本，改为请求模型生成
+            self.reusing_script = False
+            self.output("正在请求模型重新生成脚本。\n")
+            self.generate(allow_reuse=False)
+            return
+        if self.conversation is not None:
+            self.conversation.add_script_denied()
+        self.set_status(TaskStatus.DONE)
+
+    def cancel(self) -> None:
+        """立即停止：取消正在进行的请求或脚本，并移出等待队列"""
+        if self.finished:
+            return
+        for thread in (self.ai_thread, self.script_thread):
+            if thread is not None:
+                thread.cancel()
+        self.ai_thread = None
+        self.script_thread = None
+        self.pending_script = None
+        self.finish_job()
+        self.manager.release_slot(self)
+        self.output("\n已停止。\n")
+        self.set_status(TaskStatus.CANCELLED)
+
+
+class TaskManager(QObject):
+    """
+    同时运行多条命令，限制同时生成或执行脚本的命令数量。
+    名额已满时，新的请求进入队列，在名额空出后按优先级和请求的顺序开始。
+    """
+    task_added = pyqtSignal(CommandTask)
+    task_removed = pyqtSignal(CommandTask)
+    counts_changed = pyqtSignal(int, int)  # (占用名额的命令数, 排队的请求数)
+
+    assistant: Assistant
+    max_parallel: int
+    tasks: Dict[int, CommandTask]
+    active: List[CommandTask]  # 占用名额的命令
+    queue: List[Tuple[CommandTask, Callable[[], None]]]  # 等待名额的请求
+    threads: List[QThread]  # 正在运行的线程，退出前需要保留引用
+    next_id: int
+
+    def __init__(self, assistant: Assistant, max_parallel: int) -> None:
+        super().__init__()
+        self.assistant = assistant
+        self.max_parallel = max(1, max_parallel)
+        self.tasks = {}
+        self.active = []
+        self.queue = []
+        self.threads = []
+        self.next_id = 1
+
+    def create_task(self, command: str, files: List[Path], conversation: Optional[Conversation],
+                    run_context: RunContext, background: bool = False) -> CommandTask:
+        task = CommandTask(self.next_id, self, command, files, conversation, run_context,
+                           background)
+        self.next_id += 1
+        self.tasks[task.id] = task
+        self.task_added.emit(task)
+        return task
+
+    def remove_task(self, task: CommandTask) -> None:
+        """移除命令，尚未结束时先停止"""
+        task.cancel()
+        if self.tasks.pop(task.id, None) is not None:
+            self.task_removed.emit(task)
+
+    def request_slot(self, task: CommandTask, start: Callable[[], None]) -> None:
+        """名额未满时立即开始，否则进入队列"""
+        if len(self.active) < self.max_parallel:
+            self.active.append(task)
+            start()
+        else:
+            self.queue.append((task, start))
+            self.reorder_queue()
+        self.counts_changed.emit(len(self.active), len(self.queue))
+
+    def reorder_queue(self) -> None:
+        """按优先级排列等待的请求，相同优先级保持请求的顺序"""
+        self.queue.sort(key=lambda item: -item[0].priority)
+
+    def release_slot(self, task: CommandTask) -> None:
+        """命令不再占用名额（或不再排队），开始队列中的下一个请求"""
+        if task in self.active:
+            self.active.remove(task)
+        self.queue = [(queued, start) for queued, start in self.queue if queued is not task]
+        self.drain()
+
+    def set_max_parallel(self, max_parallel: int) -> None:
+        self.max_parallel = max(1, max_parallel)
+        self.drain()
+
+    def drain(self) -> None:
+        """在名额允许的范围内，开始队列中的请求"""
+        while self.queue and len(self.active) < self.max_parallel:
+            queued, start = self.queue.pop(0)
+            self.active.append(queued)
+            start()
+        self.counts_changed.emit(len(self.active), len(self.queue))
+
+    def thread_started(self, thread: QThread) -> None:
+        self.threads.append(thread)
+
+    def thread_finished(self, thread: QThread) -> None:
+        if thread in self.threads:
+            self.threads.remove(thread)
+
+    def cancel_all(self) -> None:
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+    def restore_jobs(self) -> List[CommandTask]:
+        """恢复任务队列中上次没有完成的任务，按优先级排队"""
+        tasks: List[CommandTask] = []
+        for job in self.assistant.jobs.restore():
+            task = self.create_task(job.context.command, job.files, None, job.context,
+                                    background=True)
+            task.restore_job(job)
+            tasks.append(task)
+        return tasks
+
+    def shutdown(self) -> None:
+        """
+        程序退出：结束正在运行的进程，但保留任务队列中的任务，下次启动时恢复。
+        """
+        for task in self.tasks.values():
+            for thread in (task.ai_thread, task.script_thread):
+                if thread is not None:
+                    thread.cancel()
+            # 之后到达的 finished 信号会被当作已取消忽略，不会从队列中删除任务
+            task.ai_thread = None
+            task.script_thread = None
+        # 线程仍在运行时销毁 QThread 会使程序异常退出
+        for thread in list(self.threads):
+            if not thread.wait(SHUTDOWN_WAIT_MS):
+                log.warning(f"程序退出时线程 {thread} 没有在 {SHUTDOWN_WAIT_MS} 毫秒内结束")
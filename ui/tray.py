@@ -5,13 +5,15 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import pyqtSignal
 from utils.icon import get_icon
 from utils.general import log, Path, set_default
-from ui.main_window import MainWindow, ICON_NAME
+from ui.main_window import MainWindow, ICON_NAME, WINDOW_TITLE
 
 
 class TrayIcon(QSystemTrayIcon):
     icon_path: Path
     main_window: MainWindow
     pin_action: Optional[QAction] = None
+    watch_stats_action: Optional[QAction] = None  # 显示监视文件夹的统计信息
+    stop_watch_action: Optional[QAction] = None
 
     quit_signal = pyqtSignal()  # 用户要求退出程序
 
@@ -39,6 +41,18 @@ class TrayIcon(QSystemTrayIcon):
             self.main_window.signals.toggle_pin_signal.connect(
                 self.on_toggle_pin)
 
+            # 监视文件夹的统计信息，只在监视时显示
+            tray_menu.addSeparator()
+            watch_stats_action = tray_menu.addAction("")
+            watch_stats_action.setEnabled(False)
+            watch_stats_action.setVisible(False)
+            self.watch_stats_action = watch_stats_action
+            stop_watch_action = tray_menu.addAction("停止监视文件夹")
+            stop_watch_action.setVisible(False)
+            stop_watch_action.triggered.connect(self.main_window.stop_watches)
+            self.stop_watch_action = stop_watch_action
+            self.main_window.signals.watch_stats_signal.connect(self.on_watch_stats)
+
             tray_menu.addSeparator()
 
             # 退出
@@ -67,3 +81,12 @@ class TrayIcon(QSystemTrayIcon):
             log.warning("pin_action 未初始化")
             return
         self.pin_action.setChecked(self.main_window.pin_flag)
+
+    def on_watch_stats(self, text: str) -> None:
+        """更新监视文件夹的统计信息"""
+        if self.watch_stats_action is None or self.stop_watch_action is None:
+            return
+        self.watch_stats_action.setText(text.replace("\n", "；"))
+        self.watch_stats_action.setVisible(bool(text))
+        self.stop_watch_action.setVisible(bool(text))
+        self.setToolTip(f"{WINDOW_TITLE}\n{text}" if text else WINDOW_TITLE)
@@ -1,27 +1,188 @@
 import os
-from typing import List, Optional
-from PyQt5.QtCore import pyqtSignal, Qt
-from PyQt5.QtWidgets import QListWidget, QMenu, QAbstractItemView
-from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QDragMoveEvent, QKeyEvent, QContextMenuEvent
-from utils.general import Path
+from time import monotonic, localtime, strftime
+from typing import List, Optional, Dict, Any
+from PyQt5.QtCore import pyqtSignal, Qt, QThread, QAbstractListModel, QModelIndex
+from PyQt5.QtWidgets import QListView, QMenu, QAbstractItemView
+from PyQt5.QtGui import (
+    QDragEnterEvent, QDropEvent, QDragMoveEvent, QKeyEvent, QContextMenuEvent, QPaintEvent, QPainter)
+from core.config import DEFAULT_SCAN_INCLUDE, DEFAULT_SCAN_EXCLUDE, DEFAULT_SCAN_MAX_DEPTH
+from core.selection import FileSelection
+from utils.general import Path, log
+from utils.file import scan_directory, detect_text_encoding
 
+SCAN_BATCH_SIZE = 1000  # 每批最多发送的文件数量
+SCAN_BATCH_INTERVAL = 0.1  # 每批最长的等待时间（秒）
 
-class FileDropArea(QListWidget):
-    """支持文件拖放和删除、展示文件列表"""
-    add_file_signal = pyqtSignal(Path)    # 添加文件信号（参数：文件路径）
-    remove_file_signal = pyqtSignal(Path) # 删除文件信号（参数：文件路径）
-    file_list: List[Path]
 
-    def __init__(self) -> None:
+class DirectoryScanThread(QThread):
+    """在后台线程中遍历文件夹，分批发送找到的文件"""
+    batch_found_signal = pyqtSignal(list)  # 找到一批文件（参数：文件路径列表）
+
+    roots: List[Path]
+    include: List[str]
+    exclude: List[str]
+    max_depth: int
+    stopped: bool
+
+    def __init__(self, roots: List[Path], include: List[str],
+                 exclude: List[str], max_depth: int) -> None:
+        super().__init__()
+        self.roots = roots
+        self.include = include
+        self.exclude = exclude
+        self.max_depth = max_depth
+        self.stopped = False
+
+    def run(self) -> None:
+        batch: List[Path] = []
+        last_emit = monotonic()
+        for root in self.roots:
+            for file_path in scan_directory(root, self.include, self.exclude, self.max_depth):
+                if self.stopped:
+                    return
+                batch.append(file_path)
+                if (len(batch) >= SCAN_BATCH_SIZE
+                        or monotonic() - last_emit >= SCAN_BATCH_INTERVAL):
+                    self.batch_found_signal.emit(batch)
+                    batch = []
+                    last_emit = monotonic()
+        if batch:
+            self.batch_found_signal.emit(batch)
+
+    def stop(self) -> None:
+        """停止扫描，已经发送的文件不受影响"""
+        self.stopped = True
+
+
+class FileListModel(QAbstractListModel):
+    """
+    文件列表的数据模型，只保存路径，文件信息在需要显示时才读取。
+    支持按文件名筛选：在上一次的结果上继续缩小范围。
+    """
+    selection: FileSelection
+    rows: List[Path]  # 当前显示的文件（已筛选）
+    filter_text: str  # 当前的筛选文本（小写）
+    info_cache: Dict[Path, str]  # 文件信息的缓存
+
+    def __init__(self, selection: FileSelection) -> None:
+        super().__init__()
+        self.selection = selection
+        self.rows = list(selection)
+        self.filter_text = ""
+        self.info_cache = {}
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole) -> Any:
+        if not index.isValid() or not 0 <= index.row() < len(self.rows):
+            return None
+        file_path = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return os.path.basename(file_path)
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return self.get_file_info(file_path)
+        if role == Qt.ItemDataRole.UserRole:
+            return file_path
+        return None
+
+    def path_at(self, row: int) -> Path:
+        """获取指定行的文件路径"""
+        return self.rows[row]
+
+    def get_file_info(self, file_path: Path) -> str:
+        """获取文件的大小、类型和修改时间，首次访问时才读取"""
+        if (info := self.info_cache.get(file_path)) is not None:
+            return info
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            return f"{file_path}\n无法读取文件信息：{e}"
+        encoding = detect_text_encoding(file_path)
+        file_type = f"文本（{encoding}）" if encoding is not None else "二进制"
+        mtime = strftime("%Y-%m-%d %H:%M:%S", localtime(stat.st_mtime))
+        info = f"{file_path}\n大小：{stat.st_size} 字节\n类型：{file_type}\n修改时间：{mtime}"
+        self.info_cache[file_path] = info
+        return info
+
+    def matches(self, file_path: Path) -> bool:
+        """判断文件是否符合当前的筛选条件"""
+        return self.filter_text in os.path.basename(file_path).lower()
+
+    def append_files(self, file_paths: List[Path]) -> None:
+        """在末尾追加文件（只显示符合筛选条件的）"""
+        if self.filter_text:
+            file_paths = [file_path for file_path in file_paths if self.matches(file_path)]
+        if not file_paths:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(file_paths) - 1)
+        self.rows.extend(file_paths)
+        self.endInsertRows()
+
+    def remove_files(self, file_paths: List[Path]) -> None:
+        """删除若干文件"""
+        removed = set(file_paths)
+        for file_path in removed:
+            self.info_cache.pop(file_path, None)
+        self.beginResetModel()
+        self.rows = [file_path for file_path in self.rows if file_path not in removed]
+        self.endResetModel()
+
+    def reset_files(self) -> None:
+        """按共享的文件集合重新生成列表"""
+        self.beginResetModel()
+        self.rows = [file_path for file_path in self.selection if self.matches(file_path)]
+        self.info_cache.clear()
+        self.endResetModel()
+
+    def set_filter(self, text: str) -> None:
+        """设置筛选文本；如果新文本包含旧文本，只在当前结果中继续筛选"""
+        text = text.strip().lower()
+        if text == self.filter_text:
+            return
+        if self.filter_text and text.startswith(self.filter_text):
+            candidates = self.rows
+        else:
+            candidates = self.selection.to_list()
+        self.filter_text = text
+        self.beginResetModel()
+        self.rows = [file_path for file_path in candidates if self.matches(file_path)]
+        self.endResetModel()
+
+
+class FileDropArea(QListView):
+    """支持文件（夹）拖放和删除、展示文件列表"""
+    add_files_signal = pyqtSignal(list)     # 添加文件信号（参数：新增的文件路径列表）
+    remove_files_signal = pyqtSignal(list)  # 删除文件信号（参数：删除的文件路径列表）
+    selection: FileSelection  # 与 Assistant 共享的文件集合
+    file_model: FileListModel
+
+    scan_include: List[str]  # 扫描文件夹时包含的文件名模式
+    scan_exclude: List[str]  # 扫描文件夹时排除的文件（夹）名模式
+    scan_max_depth: int  # 扫描文件夹的最大深度
+    scan_threads: List[DirectoryScanThread]  # 正在进行的扫描
+
+    def __init__(self, selection: Optional[FileSelection] = None,
+                 scan_include: Optional[List[str]] = None,
+                 scan_exclude: Optional[List[str]] = None,
+                 scan_max_depth: int = DEFAULT_SCAN_MAX_DEPTH) -> None:
         super().__init__()
         self.setAcceptDrops(True)
         self.setMinimumHeight(100)
         self.setMaximumHeight(150)
-        self.file_list = []
+        self.selection = selection if selection is not None else FileSelection()
+        self.scan_include = scan_include if scan_include is not None else list(DEFAULT_SCAN_INCLUDE)
+        self.scan_exclude = scan_exclude if scan_exclude is not None else list(DEFAULT_SCAN_EXCLUDE)
+        self.scan_max_depth = scan_max_depth
+        self.scan_threads = []
+
+        self.file_model = FileListModel(self.selection)
+        self.setModel(self.file_model)
+        self.setUniformItemSizes(True)  # 所有行等高，无需逐行计算尺寸
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)  # 支持多选
-        
-        # 初始提示文本
-        self.show_tip()
 
     def dragEnterEvent(self, e: Optional[QDragEnterEvent]) -> None:
         """处理拖拽进入事件"""
@@ -37,37 +198,69 @@ class FileDropArea(QListWidget):
         e.acceptProposedAction()
 
     def dropEvent(self, event: Optional[QDropEvent]) -> None:
-        """释放鼠标，添加文件"""
+        """释放鼠标，添加文件；文件夹在后台扫描"""
         if event is None:
             return
 
+        files: List[Path] = []
+        directories: List[Path] = []
         for url in event.mimeData().urls():
             file_path = url.toLocalFile()
             if os.path.isfile(file_path):
-                self.add_file(file_path)
+                files.append(file_path)
+            elif os.path.isdir(file_path):
+                directories.append(file_path)
+        self.add_files(files)
+        if directories:
+            self.scan_directories(directories)
         event.acceptProposedAction()
 
+    def scan_directories(self, directories: List[Path]) -> None:
+        """在后台扫描文件夹，找到的文件会分批加入列表"""
+        log.debug(f"FileDropArea::scan_directories: {directories}")
+        thread = DirectoryScanThread(
+            directories, self.scan_include, self.scan_exclude, self.scan_max_depth)
+        thread.batch_found_signal.connect(self.add_files)
+
+        def on_finished() -> None:
+            if thread in self.scan_threads:
+                self.scan_threads.remove(thread)
+        thread.finished.connect(on_finished)
+
+        self.scan_threads.append(thread)
+        thread.start()
+
+    def stop_scanning(self) -> None:
+        """停止所有正在进行的文件夹扫描"""
+        for thread in self.scan_threads:
+            thread.stop()
+
     def add_file(self, file_path: Path) -> None:
         """添加文件到列表"""
-        if file_path in self.file_list:
-            return
-        
-        # 如果是首次添加，清除提示项
-        if not self.file_list:
-            self.clear()
-            self.file_list = []
+        self.add_files([file_path])
 
-        self.file_list.append(file_path)
-        self.addItem(os.path.basename(file_path))
+    def add_files(self, file_paths: List[Path]) -> None:
+        """批量添加文件到列表，只发出一次信号"""
+        added = self.selection.add_many(file_paths)
+        if not added:
+            return
+        self.file_model.append_files(added)
 
         # 发出添加信号
-        self.add_file_signal.emit(file_path)
+        self.add_files_signal.emit(added)
 
-    def remove_file(self, file_path: Path) -> None:
-        """从列表中删除文件"""
-        if file_path in self.file_list:
-            self.file_list.remove(file_path)
-            self.remove_file_signal.emit(file_path)
+    def remove_files(self, file_paths: List[Path]) -> None:
+        """从列表中批量删除文件，只发出一次信号"""
+        removed = self.selection.remove_many(file_paths)
+        if not removed:
+            return
+        self.file_model.remove_files(removed)
+        self.remove_files_signal.emit(removed)
+
+    def set_filter(self, text: str) -> None:
+        """按文件名筛选显示的文件"""
+        self.file_model.set_filter(text)
+        self.viewport().update()
 
     def keyPressEvent(self, e: Optional[QKeyEvent]) -> None:
         """键盘事件处理 - 支持 Delete 键删除"""
@@ -81,7 +274,7 @@ class FileDropArea(QListWidget):
 
     def contextMenuEvent(self, a0: Optional[QContextMenuEvent]) -> None:
         """右键菜单事件 - 创建删除菜单"""
-        if a0 is None or not self.selectedItems():
+        if a0 is None or not self.selectionModel().hasSelection():
             return
             
         event = a0
@@ -102,35 +295,30 @@ class FileDropArea(QListWidget):
 
     def delete_selected_files(self) -> None:
         """删除选中的文件项"""
-        if not self.selectedItems():
+        indexes = self.selectionModel().selectedIndexes()
+        if not indexes:
             return
-            
-        # 倒序删除避免索引变动
-        for item in reversed(self.selectedItems()):
-            row = self.row(item)
-            file_path = self.file_list[row]
-            
-            # 从列表中移除
-            self.remove_file(file_path)
-            self.takeItem(row)
-        
-        self.show_tip()
+
+        self.remove_files([self.file_model.path_at(index.row()) for index in indexes])
 
     def clear_all_files(self) -> None:
         """清空所有文件"""
-        # 发出删除信号
-        for file_path in self.file_list:
-            self.remove_file_signal.emit(file_path)
+        self.stop_scanning()
 
         # 清空文件
-        self.clear()
-        self.file_list = []
-    
-    def show_tip(self) -> None:
-        """如果文件列表为空，显示提示"""
-        if self.file_list:
+        removed = self.selection.clear()
+        self.file_model.reset_files()
+
+        # 发出删除信号
+        if removed:
+            self.remove_files_signal.emit(removed)
+
+    def paintEvent(self, e: Optional[QPaintEvent]) -> None:
+        """如果列表为空，显示提示"""
+        super().paintEvent(e)
+        if self.file_model.rowCount() > 0:
             return  # 存在文件
-        self.addItem("拖拽文件到此处")
-        if item := self.item(0):
-            item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
-            item.setFlags(Qt.ItemFlag.NoItemFlags)
+        tip = "没有匹配的文件" if self.selection else "拖拽文件或文件夹到此处"
+        painter = QPainter(self.viewport())
+        painter.drawText(self.viewport().rect(), Qt.AlignmentFlag.AlignCenter, tip)
+        painter.end()
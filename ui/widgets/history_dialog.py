@@ -0,0 +1,147 @@
+from time import localtime, strftime
+from typing import List
+from PyQt5.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QLineEdit, QListWidget, QListWidgetItem,
+    QTextEdit, QPushButton, QWidget, QSplitter, QAbstractItemView)
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from core.history import HistoryStore, HistoryEntry
+from core.execute import MODE_NAMES, ExecutionMode
+
+SEARCH_DELAY_MS = 200  # 停止输入多久后开始搜索
+SEARCH_LIMIT = 200  # 最多显示的记录数量
+
+
+class HistoryDialog(QDialog):
+    """查看、搜索历史记录，并重新运行过去的脚本"""
+    rerun_signal = pyqtSignal(int)  # 重新运行（参数：记录编号）
+    watch_signal = pyqtSignal(int)  # 用这个脚本监视文件夹（参数：记录编号）
+    pipeline_signal = pyqtSignal(list)  # 把多个管道脚本串联运行（参数：按执行顺序排列的记录编号）
+
+    history: HistoryStore
+    search_input: QLineEdit
+    entry_list: QListWidget
+    detail_area: QTextEdit
+    rerun_button: QPushButton
+    pipeline_button: QPushButton
+    watch_button: QPushButton
+    search_timer: QTimer
+
+    def __init__(self, parent: QWidget, history: HistoryStore) -> None:
+        super().__init__(parent)
+        self.history = history
+        self.setWindowTitle("历史记录")
+        self.setMinimumSize(700, 500)
+
+        layout = QVBoxLayout()
+
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("搜索命令或脚本")
+        layout.addWidget(self.search_input)
+
+        splitter = QSplitter(Qt.Orientation.Vertical)
+        self.entry_list = QListWidget()
+        self.entry_list.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        splitter.addWidget(self.entry_list)
+        self.detail_area = QTextEdit()
+        self.detail_area.setReadOnly(True)
+        splitter.addWidget(self.detail_area)
+        layout.addWidget(splitter)
+
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        self.pipeline_button = QPushButton("串联运行")
+        self.pipeline_button.setToolTip("把选中的多个管道脚本按创建顺序串联：前一个脚本的输出直接作为后一个脚本的输入")
+        self.pipeline_button.setEnabled(False)
+        self.pipeline_button.clicked.connect(self.on_pipeline)
+        button_layout.addWidget(self.pipeline_button)
+        self.watch_button = QPushButton("监视文件夹...")
+        self.watch_button.setToolTip("选择一个文件夹，之后放入其中的新文件会自动用这个脚本处理")
+        self.watch_button.setEnabled(False)
+        self.watch_button.clicked.connect(self.on_watch)
+        button_layout.addWidget(self.watch_button)
+        self.rerun_button = QPushButton("重新运行")
+        self.rerun_button.setEnabled(False)
+        self.rerun_button.clicked.connect(self.on_rerun)
+        button_layout.addWidget(self.rerun_button)
+        close_button = QPushButton("关闭")
+        close_button.clicked.connect(self.reject)
+        button_layout.addWidget(close_button)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+        # 输入停止一段时间后再搜索
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.refresh)
+        self.search_input.textChanged.connect(lambda _: self.search_timer.start())
+        self.entry_list.currentItemChanged.connect(lambda item, _: self.show_entry(item))
+        self.entry_list.itemDoubleClicked.connect(lambda _: self.on_rerun())
+        self.entry_list.itemSelectionChanged.connect(self.update_pipeline_button)
+
+        self.refresh()
+
+    def refresh(self) -> None:
+        """按搜索框的内容刷新列表"""
+        entries: List[HistoryEntry] = self.history.search(self.search_input.text(), SEARCH_LIMIT)
+        self.entry_list.clear()
+        for entry in entries:
+            time_str = strftime("%Y-%m-%d %H:%M", localtime(entry.created_at))
+            command = entry.command.strip().replace("\n", " ")
+            item = QListWidgetItem(f"[{time_str}] {command}（{len(entry.files)} 个文件）")
+            item.setData(Qt.ItemDataRole.UserRole, entry.id)
+            item.setData(Qt.ItemDataRole.UserRole + 1, entry.mode == ExecutionMode.PIPELINE)
+            self.entry_list.addItem(item)
+        self.detail_area.clear()
+        self.rerun_button.setEnabled(False)
+        self.watch_button.setEnabled(False)
+        self.pipeline_button.setEnabled(False)
+
+    def show_entry(self, item: QListWidgetItem) -> None:
+        """显示一条记录的详细信息"""
+        if item is None:
+            return
+        entry = self.history.get(item.data(Qt.ItemDataRole.UserRole))
+        if entry is None:
+            return
+        lines = [f"命令：{entry.command}", f"模型：{entry.model}",
+                 f"执行方式：{MODE_NAMES[entry.mode]}", f"总耗时：{entry.duration:.2f} 秒", "", "脚本：", entry.script, "", "结果："]
+        for file, result in entry.results:
+            lines.append(f"- {file}：返回值 {result.return_code}，耗时 {result.duration:.2f} 秒")
+            if stderr := result.stderr.strip():
+                lines.append(f"  错误：{stderr}")
+        self.detail_area.setPlainText("\n".join(lines))
+        self.rerun_button.setEnabled(True)
+        self.watch_button.setEnabled(True)
+
+    def on_rerun(self) -> None:
+        item = self.entry_list.currentItem()
+        if item is None:
+            return
+        self.rerun_signal.emit(item.data(Qt.ItemDataRole.UserRole))
+        self.accept()
+
+    def on_watch(self) -> None:
+        item = self.entry_list.currentItem()
+        if item is None:
+            return
+        self.watch_signal.emit(item.data(Qt.ItemDataRole.UserRole))
+        self.accept()
+
+    def selected_pipeline_ids(self) -> List[int]:
+        """选中的记录编号（按创建顺序）；包含非管道模式的记录时返回空列表"""
+        items = self.entry_list.selectedItems()
+        if not all(item.data(Qt.ItemDataRole.UserRole + 1) for item in items):
+            return []
+        return sorted(item.data(Qt.ItemDataRole.UserRole) for item in items)
+
+    def update_pipeline_button(self) -> None:
+        """选中两个以上的管道脚本时可以串联运行"""
+        self.pipeline_button.setEnabled(len(self.selected_pipeline_ids()) >= 2)
+
+    def on_pipeline(self) -> None:
+        run_ids = self.selected_pipeline_ids()
+        if len(run_ids) < 2:
+            return
+        self.pipeline_signal.emit(run_ids)
+        self.accept()
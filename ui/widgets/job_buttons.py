@@ -0,0 +1,38 @@
+from PyQt5.QtWidgets import QHBoxLayout, QPushButton
+from PyQt5.QtCore import pyqtSignal
+
+
+class JobButtons(QHBoxLayout):
+    """已确认脚本的「暂停」「继续」和调整优先级按钮"""
+    pause_button: QPushButton
+    resume_button: QPushButton
+    raise_button: QPushButton
+    lower_button: QPushButton
+
+    pause_signal = pyqtSignal()  # 暂停
+    resume_signal = pyqtSignal()  # 继续
+    raise_signal = pyqtSignal()  # 提高优先级
+    lower_signal = pyqtSignal()  # 降低优先级
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.pause_button = QPushButton("暂停")
+        self.resume_button = QPushButton("继续")
+        self.raise_button = QPushButton("优先级↑")
+        self.lower_button = QPushButton("优先级↓")
+        for button in (self.pause_button, self.resume_button,
+                       self.raise_button, self.lower_button):
+            self.addWidget(button)
+
+        self.pause_button.clicked.connect(self.pause_signal.emit)
+        self.resume_button.clicked.connect(self.resume_signal.emit)
+        self.raise_button.clicked.connect(self.raise_signal.emit)
+        self.lower_button.clicked.connect(self.lower_signal.emit)
+        self.set_state(False, False, False)
+
+    def set_state(self, can_pause: bool, can_resume: bool, can_prioritize: bool) -> None:
+        """按当前命令的状态启用按钮"""
+        self.pause_button.setEnabled(can_pause)
+        self.resume_button.setEnabled(can_resume)
+        self.raise_button.setEnabled(can_prioritize)
+        self.lower_button.setEnabled(can_prioritize)
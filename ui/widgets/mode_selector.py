@@ -0,0 +1,59 @@
+from PyQt5.QtWidgets import QHBoxLayout, QLabel, QComboBox, QCheckBox
+from core.config import Config
+from core.execute import ExecutionMode, MODE_NAMES
+
+
+class ModeSelector(QHBoxLayout):
+    """脚本执行方式选择框和相关选项，选择的结果保存到配置中"""
+    config: Config
+
+    label: QLabel
+    combo_box: QComboBox
+    incremental_box: QCheckBox  # 是否跳过没有变化的文件
+
+    def __init__(self, config: Config) -> None:
+        super().__init__()
+        self.setContentsMargins(0, 0, 0, 0)
+        self.config = config
+
+        self.label = QLabel("执行方式：")
+        self.addWidget(self.label)
+        self.combo_box = QComboBox()
+        self.combo_box.setMinimumWidth(200)
+        for mode, name in MODE_NAMES.items():
+            self.combo_box.addItem(name, mode.value)
+        self.addWidget(self.combo_box)
+        self.addStretch()
+        self.incremental_box = QCheckBox("跳过未变化的文件")
+        self.incremental_box.setToolTip("之前已经用同一个脚本处理过、且输入和输出文件都没有变化的文件不再处理")
+        self.addWidget(self.incremental_box)
+
+        self.refresh()
+        self.combo_box.currentIndexChanged.connect(self.on_changed)
+        self.incremental_box.toggled.connect(self.on_incremental_toggled)
+
+    def refresh(self) -> None:
+        """按当前配置显示选中的执行方式"""
+        index = self.combo_box.findData(self.config.execution_mode.value)
+        if index >= 0 and index != self.combo_box.currentIndex():
+            self.combo_box.blockSignals(True)
+            self.combo_box.setCurrentIndex(index)
+            self.combo_box.blockSignals(False)
+        if self.incremental_box.isChecked() != self.config.incremental_runs:
+            self.incremental_box.blockSignals(True)
+            self.incremental_box.setChecked(self.config.incremental_runs)
+            self.incremental_box.blockSignals(False)
+
+    def get_selected_mode(self) -> ExecutionMode:
+        return ExecutionMode(self.combo_box.currentData())
+
+    def on_changed(self, _: int) -> None:
+        mode = self.get_selected_mode()
+        if mode != self.config.execution_mode:
+            self.config.execution_mode = mode
+            self.config.save()
+
+    def on_incremental_toggled(self, checked: bool) -> None:
+        if checked != self.config.incremental_runs:
+            self.config.incremental_runs = checked
+            self.config.save()
@@ -39,9 +39,18 @@ class ModelSelector(QHBoxLayout):
         self.parent_widget = parent
 
     def update_model_list(self, model_list: List[str]) -> None:
-        """更新模型列表"""
-        self.combo_box.clear()
-        self.combo_box.addItems(model_list)
+        """更新模型列表，只修改发生变化的项"""
+        for index, name in enumerate(model_list):
+            if index >= self.combo_box.count():
+                self.combo_box.addItem(name)
+            elif self.combo_box.itemText(index) != name:
+                self.combo_box.setItemText(index, name)
+        while self.combo_box.count() > len(model_list):
+            self.combo_box.removeItem(self.combo_box.count() - 1)
+
+    def refresh_model_list(self) -> None:
+        """按当前配置更新模型列表"""
+        self.update_model_list([model.name for model in self.assistant.get_models()])
 
     def get_selected_index(self) -> int:
         """获取当前选中的模型索引"""
@@ -137,7 +146,7 @@ class ModelSelector(QHBoxLayout):
 
     def recall_modification(self, table: QTableWidget) -> None:
         """撤销现有的修改"""
-        self.assistant.config.load()
+        self.assistant.config.revert()
         self.load_model_info_to_table(table)
 
     def clear_table(self, table: QTableWidget) -> None:
@@ -185,3 +194,4 @@ class ModelSelector(QHBoxLayout):
             config.models.append(model)
 
         config.save()
+        self.refresh_model_list()
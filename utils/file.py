@@ -1,10 +1,195 @@
 """文件相关实用工具"""
 
-import mimetypes
+import codecs
+import os
+import tempfile
+from fnmatch import fnmatch
+from functools import lru_cache
+from typing import Optional, List, Tuple, Iterator
 from utils.general import Path
 
+SNIFF_BLOCK_SIZE = 8192  # 每个文件最多读取的字节数
+SNIFF_CACHE_SIZE = 4096  # 缓存的检测结果数量
+CONTROL_RATIO_LIMIT = 0.05  # 允许的控制字符比例，超过则视为二进制
+
+# 尝试的编码，按优先级排列
+FALLBACK_ENCODINGS = ["utf-8", "gb18030"]
+
+# 带 BOM 的编码，可以直接确定（UTF-16/32 的内容中会出现 NUL 字节，需要先于 NUL 检测）
+BOMS: List[Tuple[bytes, str]] = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# 文本中常见的字节：\t \n \v \f \r ESC 和所有非控制字符
+TEXT_BYTES = bytes({7, 8, 9, 10, 11, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+
+
+def sniff_encoding(block: bytes) -> Optional[str]:
+    """
+    根据文件开头的一段内容推测编码。
+    如果内容看起来是二进制数据，返回 None。
+    """
+    if not block:
+        return "utf-8"  # 空文件视为文本
+
+    for bom, encoding in BOMS:
+        if block.startswith(bom):
+            return encoding
+
+    if b"\x00" in block:
+        return None
+
+    for encoding in FALLBACK_ENCODINGS:
+        # 增量解码：块末尾被截断的多字节字符不视为错误
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            decoder.decode(block, final=False)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+
+    # 无法严格解码，按控制字符比例判断（例如 Latin-1 文本）
+    control_count = len(block.translate(None, TEXT_BYTES))
+    if control_count / len(block) <= CONTROL_RATIO_LIMIT:
+        return "latin-1"
+    return None
+
+
+@lru_cache(maxsize=SNIFF_CACHE_SIZE)
+def _detect_cached(file_path: Path, mtime_ns: int, size: int) -> Optional[str]:
+    """以 (路径, 修改时间, 大小) 为键缓存检测结果"""
+    with open(file_path, "rb") as f:
+        block = f.read(SNIFF_BLOCK_SIZE)
+    return sniff_encoding(block)
+
+
+def detect_text_encoding(file_path: Path) -> Optional[str]:
+    """检测文本文件的编码。如果不是文本文件或无法读取，返回 None"""
+    try:
+        stat = os.stat(file_path)
+        return _detect_cached(file_path, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+
 def is_text(file_path: Path) -> bool:
-    mime = mimetypes.guess_type(file_path)[0]
-    if mime is None:
-        return False
-    return "text" in mime
+    """通过读取文件开头的一小块内容，判断是否为文本文件"""
+    return detect_text_encoding(file_path) is not None
+
+
+def write_atomic(file_path: Path, text: str, encoding: str = "utf-8") -> None:
+    """
+    先写入同一目录下的临时文件，再重命名覆盖目标文件。
+    写入中途崩溃时，原文件保持完整。
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(file_path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding=encoding) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def match_any(name: str, patterns: List[str]) -> bool:
+    """判断文件名是否匹配任意一个通配符模式"""
+    return any(fnmatch(name, pattern) for pattern in patterns)
+
+
+def scan_directory(root: Path, include: List[str], exclude: List[str],
+                   max_depth: int) -> Iterator[Path]:
+    """
+    使用 os.scandir 遍历文件夹，逐个产出其中的文件路径。
+    include: 文件名需要匹配的模式（为空则全部包含）
+    exclude: 需要排除的文件或文件夹名模式
+    max_depth: 最大递归深度，0 表示只列出 root 下的文件
+    """
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue  # 无权限或已被删除
+
+        sub_directories: List[Path] = []
+        for entry in entries:
+            if match_any(entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < max_depth:
+                        sub_directories.append(entry.path)
+                elif entry.is_file():
+                    if not include or match_any(entry.name, include):
+                        yield entry.path
+            except OSError:
+                continue
+        # 倒序入栈，使遍历顺序与文件管理器一致
+        stack.extend((path, depth + 1) for path in reversed(sub_directories))
+
+
+def benchmark(count: int = 2000) -> None:
+    """在一组混合文件上测试检测速度和准确率"""
+    import mimetypes
+    import random
+    import tempfile
+    from time import perf_counter
+
+    samples: List[Tuple[str, bytes, bool]] = [
+        ("note.txt", "普通文本\n".encode("utf-8") * 200, True),
+        ("server.log", b"2024-01-01 INFO started\n" * 500, True),
+        ("data.jsonl", b'{"a": 1, "b": "x"}\n' * 500, True),
+        ("Makefile", b"all:\n\tgcc main.c -o main\n" * 50, True),
+        ("main.rs", b"fn main() { println!(\"hi\"); }\n" * 100, True),
+        ("gbk.txt", "中文内容，使用 GBK 编码。\n".encode("gbk") * 200, True),
+        ("utf16.txt", "UTF-16 文本\n".encode("utf-16") * 100, True),
+        ("latin1.txt", "caf\xe9 cr\xe8me br\xfbl\xe9e\n".encode("latin-1") * 100, True),
+        ("image.png", b"\x89PNG\r\n\x1a\n" + random.randbytes(20000), False),
+        ("archive", b"PK\x03\x04" + random.randbytes(20000), False),
+        ("program.exe", b"MZ\x90\x00" + random.randbytes(20000), False),
+        ("random.bin", random.randbytes(20000), False),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths: List[Tuple[Path, bool]] = []
+        for i in range(count):
+            name, content, expected = samples[i % len(samples)]
+            path = os.path.join(tmp_dir, f"{i}_{name}")
+            with open(path, "wb") as f:
+                f.write(content)
+            paths.append((path, expected))
+
+        def run(label: str, detect) -> None:
+            start = perf_counter()
+            correct = sum(detect(path) == expected for path, expected in paths)
+            elapsed = perf_counter() - start
+            print(f"{label:<12} {elapsed * 1e6 / len(paths):8.1f} us/file  "
+                  f"准确率 {correct}/{len(paths)}")
+
+        def guess_by_mime(path: Path) -> bool:
+            mime = mimetypes.guess_type(path)[0]
+            return mime is not None and "text" in mime
+
+        _detect_cached.cache_clear()
+        run("mimetypes", guess_by_mime)
+        run("sniff(冷)", is_text)
+        run("sniff(缓存)", is_text)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,142 @@
+"""
+增量解析流式传输的 JSON
+"""
+import re
+from typing import Dict, List, Optional
+
+# 字符串中需要特殊处理的字符
+STRING_SPECIAL = re.compile(r'[\\"]')
+
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JsonObjectStream:
+    """
+    增量解析一个 JSON 对象，在数据尚未完整时就能读取顶层字符串字段的已有部分。
+    原始文本以分块列表的形式保存，避免反复拼接字符串。
+    """
+    chunks: List[str]  # 收到的原始文本
+    fields: Dict[str, List[str]]  # 顶层字符串字段已解码的内容
+
+    _depth: int
+    _in_string: bool
+    _escape: bool
+    _unicode: Optional[str]  # 正在读取的 \uXXXX 转义
+    _high_surrogate: Optional[int]  # 等待配对的高位代理
+    _role: Optional[str]  # 当前字符串的作用："key"、"value" 或 None（嵌套内容）
+    _key: List[str]  # 正在读取的键
+    _current_key: str
+    _expect_key: bool
+
+    def __init__(self) -> None:
+        self.chunks = []
+        self.fields = {}
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode = None
+        self._high_surrogate = None
+        self._role = None
+        self._key = []
+        self._current_key = ""
+        self._expect_key = True
+
+    def text(self) -> str:
+        """获取目前收到的完整原始文本"""
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    def get(self, key: str) -> Optional[str]:
+        """获取顶层字符串字段目前已解码的内容，字段尚未出现时返回 None"""
+        if (parts := self.fields.get(key)) is None:
+            return None
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    def feed(self, chunk: str) -> Dict[str, str]:
+        """输入一段文本，返回本次新解码出的顶层字符串字段内容"""
+        self.chunks.append(chunk)
+        deltas: Dict[str, List[str]] = {}
+        pos = 0
+        length = len(chunk)
+        while pos < length:
+            if self._in_string and not self._escape and self._unicode is None:
+                # 快速路径：一次性读取到下一个反斜杠或引号为止
+                match = STRING_SPECIAL.search(chunk, pos)
+                end = match.start() if match else length
+                if end > pos:
+                    self._emit(chunk[pos:end], deltas)
+                    pos = end
+                    continue
+            self._step(chunk[pos], deltas)
+            pos += 1
+        return {key: "".join(parts) for key, parts in deltas.items()}
+
+    def _emit(self, text: str, deltas: Dict[str, List[str]]) -> None:
+        """输出字符串内容"""
+        if self._high_surrogate is not None:  # 未配对的代理，原样丢弃
+            self._high_surrogate = None
+        if self._role == "key":
+            self._key.append(text)
+        elif self._role == "value":
+            self.fields[self._current_key].append(text)
+            deltas.setdefault(self._current_key, []).append(text)
+
+    def _step(self, char: str, deltas: Dict[str, List[str]]) -> None:
+        """处理单个字符"""
+        if self._in_string:
+            if self._unicode is not None:
+                self._unicode += char
+                if len(self._unicode) == 4:
+                    self._emit_code_point(int(self._unicode, 16), deltas)
+                    self._unicode = None
+            elif self._escape:
+                self._escape = False
+                if char == "u":
+                    self._unicode = ""
+                else:
+                    self._emit(ESCAPES.get(char, char), deltas)
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._role == "key":
+                    self._current_key = "".join(self._key)
+                self._role = None
+            else:
+                self._emit(char, deltas)
+            return
+
+        if char == '"':
+            self._in_string = True
+            if self._depth == 1 and self._expect_key:
+                self._role = "key"
+                self._key = []
+            elif self._depth == 1:
+                self._role = "value"
+                self.fields[self._current_key] = []
+            else:
+                self._role = None
+        elif char in "{[":
+            self._depth += 1
+            if self._depth == 1:
+                self._expect_key = True
+        elif char in "}]":
+            self._depth -= 1
+        elif self._depth == 1 and char == ":":
+            self._expect_key = False
+        elif self._depth == 1 and char == ",":
+            self._expect_key = True
+
+    def _emit_code_point(self, code_point: int, deltas: Dict[str, List[str]]) -> None:
+        """处理 \\uXXXX 转义，包括 UTF-16 代理对"""
+        if 0xD800 <= code_point < 0xDC00:
+            self._high_surrogate = code_point
+            return
+        if 0xDC00 <= code_point < 0xE000 and self._high_surrogate is not None:
+            high = self._high_surrogate
+            self._high_surrogate = None
+            code_point = 0x10000 + ((high - 0xD800) << 10) + (code_point - 0xDC00)
+        self._emit(chr(code_point), deltas)